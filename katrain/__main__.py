@@ -19,7 +19,7 @@ import kivy
 kivy.require("2.0.0")
 
 # next, icon
-from katrain.core.utils import find_package_resource, PATHS
+from katrain.core.utils import find_package_resource, PATHS, PendingUpdate
 from kivy.config import Config
 
 if kivy_platform == "macosx":
@@ -99,9 +99,11 @@ from katrain.gui.popups import (
 )
 from katrain.gui.sound import play_sound
 from katrain.core.base_katrain import KaTrainBase
+from katrain.core.engine import resolve_engine_backend
 from katrain.core.remote_engine import make_engine
 from katrain.core.contribute_engine import KataGoContributeEngine
 from katrain.core.game import Game, IllegalMoveException, KaTrainSGF, BaseGame
+from katrain.core.game_node import GameNode
 from katrain.core.sgf_parser import Move, ParseError
 from katrain.gui.popups import ConfigPopup, LoadSGFPopup, NewGamePopup, ConfigAIPopup
 from katrain.gui.theme import Theme
@@ -123,6 +125,7 @@ class KaTrainGui(Screen, KaTrainBase):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.engine = None
+        self.startup_timer = None
         self.contributing = False
 
         self.new_game_popup = None
@@ -138,6 +141,11 @@ class KaTrainGui(Screen, KaTrainBase):
 
         self.animate_contributing = False
         self.message_queue = Queue()
+        self.pending_state_update = PendingUpdate()  # at most one update_state message queued at a time
+        self.pending_gui_update = PendingUpdate()
+        self.update_gui_trigger = Clock.create_trigger(
+            self._do_pending_gui_update, 1 / (Config.getint("graphics", "maxfps") or 60)
+        )  # at most one refresh per frame
 
         self.last_key_down = None
         self.last_focus_event = 0
@@ -189,11 +197,11 @@ class KaTrainGui(Screen, KaTrainBase):
         self.show_move_num = not self.show_move_num
         self.update_state()
 
-    def start(self):
+    def start(self, engine=None):
         if self.engine:
             return
         self.board_gui.trainer_config = self.config("trainer")
-        self.engine = make_engine(self, self.config("engine"))
+        self.engine = engine or make_engine(self, self.config("engine"))
         threading.Thread(target=self._message_loop_thread, daemon=True).start()
         sgf_args = [
             f
@@ -206,6 +214,9 @@ class KaTrainGui(Screen, KaTrainBase):
             self._do_new_game()
 
         Clock.schedule_interval(self.handle_animations, 0.1)
+        autosave_interval = self.config("general/autosave_interval", 0)
+        if autosave_interval:
+            Clock.schedule_interval(self.trigger_autosave, autosave_interval)
         Window.request_keyboard(None, self, "").bind(on_key_down=self._on_keyboard_down, on_key_up=self._on_keyboard_up)
 
         def set_focus_event(*args):
@@ -263,16 +274,21 @@ class KaTrainGui(Screen, KaTrainBase):
         # update move tree
         self.controls.move_tree.current_node = self.game.current_node
 
-    def update_state(self, redraw_board=False):  # redirect to message queue thread
-        self("update_state", redraw_board=redraw_board)
+    def update_state(self, redraw_board=False):  # redirect to message queue thread, merged with one still queued
+        if self.game and self.pending_state_update.request(redraw_board=redraw_board):
+            self("update_state")
 
     def _do_update_state(
         self, redraw_board=False
     ):  # is called after every message and on receiving analyses and config changes
+        redraw_board = (self.pending_state_update.take() or {}).get("redraw_board") or redraw_board
         # AI and Trainer/auto-undo handlers
         if not self.game or not self.game.current_node:
             return
         cn = self.game.current_node
+        if self.startup_timer and cn.analysis_exists:
+            self.startup_timer.mark("first analysis", self.log)
+            self.startup_timer = None
         if not self.contributing:
             last_player, next_player = self.players_info[cn.player], self.players_info[cn.next_player]
             if self.play_analyze_mode == MODE_PLAY and self.nav_drawer.state != "open" and self.popup_open is None:
@@ -307,7 +323,13 @@ class KaTrainGui(Screen, KaTrainBase):
                     self.game.analyze_extra("ponder")
                 else:
                     self.engine.stop_pondering()
-        Clock.schedule_once(lambda _dt: self.update_gui(cn, redraw_board=redraw_board), -1)  # trigger?
+        self.pending_gui_update.request(redraw_board=redraw_board)
+        self.update_gui_trigger()
+
+    def _do_pending_gui_update(self, _dt):
+        flags = self.pending_gui_update.take()
+        if flags is not None and self.game:
+            self.update_gui(self.game.current_node, **flags)
 
     def update_player(self, bw, **kwargs):
         super().update_player(bw, **kwargs)
@@ -329,7 +351,7 @@ class KaTrainGui(Screen, KaTrainBase):
             game, msg, args, kwargs = self.message_queue.get()
             try:
                 self.log(f"Message Loop Received {msg}: {args} for Game {game}", OUTPUT_EXTRA_DEBUG)
-                if game != self.game.game_id:
+                if game != self.game.game_id and msg != "update_state":  # state updates are for the current game
                     self.log(
                         f"Message skipped as it is outdated (current game is {self.game.game_id}", OUTPUT_EXTRA_DEBUG
                     )
@@ -579,7 +601,9 @@ class KaTrainGui(Screen, KaTrainBase):
             return
         try:
             file = os.path.abspath(file)
-            move_tree = KaTrainSGF.parse_file(file)
+            move_tree = KaTrainSGF.parse_file(  # variations are parsed by the analysis thread
+                file, lazy=True, on_error=lambda e: self.log(i18n._("Failed to load SGF").format(error=e), OUTPUT_ERROR)
+            )
         except (ParseError, FileNotFoundError) as e:
             self.log(i18n._("Failed to load SGF").format(error=e), OUTPUT_ERROR)
             return
@@ -622,6 +646,19 @@ class KaTrainGui(Screen, KaTrainBase):
         except Exception as e:
             self.log(f"Failed to save SGF to {filename}: {e}", OUTPUT_ERROR)
 
+    def trigger_autosave(self, *_args):
+        if not self.contributing:
+            self("autosave")
+
+    def _do_autosave(self):
+        if not self.game.root.children:
+            return  # nothing played yet
+        try:
+            filename = self.game.autosave()
+            self.log(f"Autosaved game to {filename}", OUTPUT_DEBUG)
+        except Exception as e:
+            self.log(f"Failed to autosave game: {e}", OUTPUT_ERROR)
+
     def _do_save_game_as_popup(self):
         popup_contents = SaveSGFPopup(suggested_filename=self.game.generate_filename())
         save_game_popup = I18NPopup(
@@ -855,12 +892,68 @@ class KaTrainGui(Screen, KaTrainBase):
             self.play_mode.switch_ui_mode()
 
 
+class StartupTimer:
+    """Logs how long startup took up to several stages, such as the window appearing and the first analysis."""
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.stages = {}
+
+    def mark(self, stage, log):
+        if stage not in self.stages:
+            self.stages[stage] = time.time() - self.start_time
+            log(f"Startup: {stage} after {self.stages[stage]:.2f}s", OUTPUT_INFO)
+
+
+class EarlyEngineStart(KaTrainBase):
+    """Starts a local KataGo while the GUI is still being built, as loading the model and tuning can take a while, and
+    sends a small query to warm it up. Logs go to the console until the GUI takes over the engine. Errors are not
+    reported, since the GUI starts the engine again if this one did not come up, and that reports them properly."""
+
+    def __init__(self, startup_timer):
+        super().__init__()
+        self.startup_timer = startup_timer
+        self.engine = None
+        config = self.config("engine")
+        if resolve_engine_backend(config) == "remote":
+            return  # no model to load
+        try:
+            self.engine = make_engine(self, config)
+            self.engine.request_analysis(
+                GameNode(properties={"SZ": self.config("game/size", 19)}),
+                callback=lambda analysis, partial_result: self.startup_timer.mark("engine ready", self.log),
+                visits=1,
+                time_limit=False,
+                ownership=False,
+                include_policy=False,
+            )
+        except Exception as e:
+            self.log(f"Could not start engine early: {e}", OUTPUT_DEBUG)
+
+    def __call__(self, message, *args, **kwargs):  # e.g. the recovery popup, see above
+        self.log(f"Not handling {message} during early engine start", OUTPUT_DEBUG)
+
+    def take_engine(self, katrain):
+        """Hands the engine over to the GUI, or returns None if it did not start."""
+        engine, self.engine = self.engine, None
+        if engine is None:
+            return None
+        if not engine.check_alive():
+            engine.shutdown(finish=None)
+            return None
+        for part in [engine] + getattr(engine, "workers", []):
+            part.katrain = katrain
+        return engine
+
+
 class KaTrainApp(MDApp):
     gui = ObjectProperty(None)
     language = StringProperty(DEFAULT_LANGUAGE)
 
-    def __init__(self):
+    def __init__(self, startup_timer=None, early_engine=None):
         super().__init__()
+        self.startup_timer = startup_timer
+        self.early_engine = early_engine
 
     def is_valid_window_position(self, left, top, width, height):
         try:
@@ -911,6 +1004,7 @@ class KaTrainApp(MDApp):
         Window.bind(on_request_close=self.on_request_close)
         Window.bind(on_dropfile=lambda win, file: self.gui.load_sgf_file(file.decode("utf8")))
         self.gui = KaTrainGui()
+        self.gui.startup_timer = self.startup_timer
         Builder.load_file(popup_kv_file)
 
         win_left = win_top = win_size = None
@@ -961,7 +1055,9 @@ class KaTrainApp(MDApp):
 
     def on_start(self):
         self.language = self.gui.config("general/lang")
-        self.gui.start()
+        if self.startup_timer:
+            Clock.schedule_once(lambda _dt: self.startup_timer.mark("window", self.gui.log), 0)  # on the first frame
+        self.gui.start(engine=self.early_engine and self.early_engine.take_engine(self.gui))
 
     def on_request_close(self, *_args, source=None):
         if source == "keyboard":
@@ -1004,7 +1100,9 @@ def run_app():
             return ExceptionManager.PASS
 
     ExceptionManager.add_handler(CrashHandler())
-    app = KaTrainApp()
+    startup_timer = StartupTimer()
+    early_engine = EarlyEngineStart(startup_timer)  # runs in parallel with building the GUI
+    app = KaTrainApp(startup_timer, early_engine)
     signal.signal(signal.SIGINT, app.signal_handler)
     app.run()
 
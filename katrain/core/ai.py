@@ -290,7 +290,7 @@ class DefaultStrategy(AIStrategy):
         
         if not candidate_moves:
             self.game.katrain.log(f"[DefaultStrategy] No candidate moves found, will play pass", OUTPUT_DEBUG)
-            top_cand = Move(is_pass=True, player=self.cn.next_player)
+            top_cand = Move(None, player=self.cn.next_player)
         else:
             top_move_data = candidate_moves[0]
             top_cand = Move.from_gtp(top_move_data["move"], player=self.cn.next_player)
@@ -405,7 +405,7 @@ class JigoStrategy(AIStrategy):
         
         if not candidate_moves:
             self.game.katrain.log(f"[JigoStrategy] No candidate moves found, will play pass", OUTPUT_DEBUG)
-            return Move(is_pass=True, player=self.cn.next_player), "No candidate moves found, passing"
+            return Move(None, player=self.cn.next_player), "No candidate moves found, passing"
         
         # Get top engine move for reference
         top_cand = Move.from_gtp(candidate_moves[0]["move"], player=self.cn.next_player)
@@ -457,7 +457,7 @@ class ScoreLossStrategy(AIStrategy):
         
         if not candidate_moves:
             self.game.katrain.log(f"[ScoreLossStrategy] No candidate moves found, will play pass", OUTPUT_DEBUG)
-            return Move(is_pass=True, player=self.cn.next_player), "No candidate moves found, passing"
+            return Move(None, player=self.cn.next_player), "No candidate moves found, passing"
         
         top_cand = Move.from_gtp(candidate_moves[0]["move"], player=self.cn.next_player)
         self.game.katrain.log(f"[ScoreLossStrategy] Top engine move would be: {top_cand.gtp()}", OUTPUT_DEBUG)
@@ -643,7 +643,7 @@ class SimpleOwnershipStrategy(OwnershipBaseStrategy):
         
         if not candidate_moves:
             self.game.katrain.log(f"[SimpleOwnershipStrategy] No candidate moves found, will play pass", OUTPUT_DEBUG)
-            return Move(is_pass=True, player=self.cn.next_player), "No candidate moves found, passing"
+            return Move(None, player=self.cn.next_player), "No candidate moves found, passing"
         
         top_cand = Move.from_gtp(candidate_moves[0]["move"], player=self.cn.next_player)
         self.game.katrain.log(f"[SimpleOwnershipStrategy] Top engine move would be: {top_cand.gtp()}", OUTPUT_DEBUG)
@@ -716,7 +716,7 @@ class SettleStonesStrategy(OwnershipBaseStrategy):
         
         if not candidate_moves:
             self.game.katrain.log(f"[SettleStonesStrategy] No candidate moves found, will play pass", OUTPUT_DEBUG)
-            return Move(is_pass=True, player=self.cn.next_player), "No candidate moves found, passing"
+            return Move(None, player=self.cn.next_player), "No candidate moves found, passing"
         
         top_cand = Move.from_gtp(candidate_moves[0]["move"], player=self.cn.next_player)
         self.game.katrain.log(f"[SettleStonesStrategy] Top engine move would be: {top_cand.gtp()}", OUTPUT_DEBUG)
@@ -0,0 +1,157 @@
+"""Persistent cache of KataGo analysis results, keyed by position.
+
+Positions are identified by their canonical hash, the smallest Zobrist hash over the symmetries of the board, so
+a result is shared between all orientations of a position. Results are stored in the canonical orientation and
+transformed back for the node asking for them. Entries are evicted in least recently used order under a size cap.
+Lookups for single nodes run on the cache's own thread, so the GUI never waits for the database.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from katrain.core.board_state import BoardState
+from katrain.core.sgf_parser import Move
+
+
+def transform_analysis(analysis: Dict, permutation: List[int], board_size: Tuple[int, int]) -> Dict:
+    """Returns a copy of a KataGo analysis result with all moves and board arrays mapped by a point permutation,
+    as returned by BoardState.symmetries. Arrays are ordered from the top row, as KataGo sends them."""
+    width, height = board_size
+
+    def move(gtp):
+        coords = Move.from_gtp(gtp).coords
+        if coords is None:
+            return gtp
+        p = permutation[coords[1] * width + coords[0]]
+        return Move((p % width, p // width)).gtp()
+
+    def board_array(values):
+        if values is None:
+            return None
+        mapped = list(values)
+        for row in range(height):
+            for x in range(width):
+                p = permutation[(height - 1 - row) * width + x]
+                mapped[(height - 1 - p // width) * width + p % width] = values[row * width + x]
+        return mapped  # for the policy, pass stays at the end
+
+    transformed = {**analysis}
+    for key in ["ownership", "policy", "humanPolicy"]:
+        if key in analysis:
+            transformed[key] = board_array(analysis[key])
+    move_infos = []
+    for move_info in analysis.get("moveInfos", []):
+        move_info = {**move_info, "move": move(move_info["move"]), "pv": [move(m) for m in move_info.get("pv", [])]}
+        if "isSymmetryOf" in move_info:
+            move_info["isSymmetryOf"] = move(move_info["isSymmetryOf"])
+        if "ownership" in move_info:
+            move_info["ownership"] = board_array(move_info["ownership"])
+        move_infos.append(move_info)
+    transformed["moveInfos"] = move_infos
+    return transformed
+
+
+class AnalysisCache:
+    """Analysis results on disk in an sqlite database, with hit and miss counters.
+    An entry serves any request for at most the number of visits it reached, with the same engine settings."""
+
+    def __init__(self, filename: str, max_bytes: int, engine_id: str = ""):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.engine_id = hashlib.blake2b(engine_id.encode(), digest_size=8).hexdigest()  # results depend on model
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="analysis_cache")
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS analysis "
+            "(key TEXT PRIMARY KEY, visits INTEGER, ownership INTEGER, last_used INTEGER, data BLOB)"
+        )
+        num_bytes, last_used = self._db.execute("SELECT SUM(LENGTH(data)), MAX(last_used) FROM analysis").fetchone()
+        self.num_bytes = num_bytes or 0
+        self._clock = last_used or 0
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM analysis").fetchone()[0]
+
+    def __repr__(self):
+        return f"AnalysisCache({self.filename}: {self.hits} hits, {self.misses} misses, {self.num_bytes} bytes)"
+
+    def close(self):
+        self._worker.shutdown(wait=True)
+        with self._lock:
+            self._db.close()
+
+    def submit(self, fn: Callable, *args) -> Future:
+        """Runs fn(*args) on the cache's thread, in the order submitted."""
+        return self._worker.submit(fn, *args)
+
+    def key(self, node, settings: Optional[Dict] = None) -> Tuple[str, int]:
+        """Returns the cache key for a node's position and engine settings which change results, and the index of the
+        symmetry that maps it to the canonical orientation."""
+        canonical_hash, symmetry = node.canonical_position_hash()
+        settings_id = hashlib.blake2b(json.dumps(settings or {}, sort_keys=True).encode(), digest_size=8).hexdigest()
+        return f"{canonical_hash:016x}:{node.komi}:{self.engine_id}:{settings_id}", symmetry
+
+    def get(self, node, visits: int, ownership: bool = False, settings: Optional[Dict] = None) -> Optional[Dict]:
+        """Returns the analysis for the node's position if it was computed with at least this many visits and the same
+        settings, and has ownership if required, oriented for the node. Counts as a hit or a miss."""
+        key, symmetry = self.key(node, settings)
+        with self._lock:
+            row = self._db.execute("SELECT visits, ownership, data FROM analysis WHERE key = ?", (key,)).fetchone()
+            if row is None or row[0] < visits or (ownership and not row[1]):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._clock += 1
+            self._db.execute("UPDATE analysis SET last_used = ? WHERE key = ?", (self._clock, key))
+            self._db.commit()
+        permutation = BoardState.symmetries(*node.board_size)[symmetry]
+        inverse = [0] * len(permutation)
+        for p, q in enumerate(permutation):
+            inverse[q] = p
+        return transform_analysis(json.loads(zlib.decompress(row[2])), inverse, node.board_size)
+
+    def put(self, node, analysis: Dict, settings: Optional[Dict] = None):
+        """Stores a final analysis result for the node's position, unless one with more visits is already stored.
+        It is stored with the visits it reached, so one cut short by maxTime does not serve requests for more."""
+        key, symmetry = self.key(node, settings)
+        visits = analysis["rootInfo"]["visits"]
+        has_ownership = analysis.get("ownership") is not None
+        permutation = BoardState.symmetries(*node.board_size)[symmetry]
+        data = zlib.compress(json.dumps(transform_analysis(analysis, permutation, node.board_size)).encode())
+        with self._lock:
+            row = self._db.execute(
+                "SELECT visits, ownership, LENGTH(data) FROM analysis WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                if (row[0], row[1]) > (visits, has_ownership):
+                    return
+                self.num_bytes -= row[2]
+            self._clock += 1
+            self._db.execute(
+                "INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?, ?)",
+                (key, visits, has_ownership, self._clock, data),
+            )
+            self.num_bytes += len(data)
+            while self.num_bytes > self.max_bytes:
+                evicted = self._db.execute(
+                    "SELECT key, LENGTH(data) FROM analysis ORDER BY last_used LIMIT 64"
+                ).fetchall()
+                if not evicted:
+                    break
+                for evicted_key, evicted_bytes in evicted:
+                    if self.num_bytes <= self.max_bytes:
+                        break
+                    self._db.execute("DELETE FROM analysis WHERE key = ?", (evicted_key,))
+                    self.num_bytes -= evicted_bytes
+            self._db.commit()
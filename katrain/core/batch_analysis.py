@@ -0,0 +1,223 @@
+"""Headless batch analysis of SGF/GIB/NGF files.
+
+Analyzes many games at once through a single engine, without a Kivy window, and writes them as SGFs with the analysis
+embedded in `KT` properties, as the GUI does with the `save_analysis` option. Several games are kept in progress so
+the engine always has queries queued. Games in progress are checkpointed to `<output>.partial.sgf`, so an interrupted
+run resumes where it left off: finished games are skipped and checkpointed positions are not analyzed again.
+"""
+
+import argparse
+import os
+import sys
+import time
+from typing import Dict, List, Set
+
+from katrain.core.base_katrain import KaTrainBase
+from katrain.core.constants import OUTPUT_ERROR, OUTPUT_INFO
+from katrain.core.game import Game, KaTrainSGF
+from katrain.core.remote_engine import make_engine
+from katrain.core.sgf_import import find_game_files
+
+PARTIAL_SUFFIX = ".partial.sgf"
+
+
+def output_filename(filename: str, input_root: str, output_dir: str) -> str:
+    """Mirrors the input directory structure in the output directory, always with an .sgf extension."""
+    relative = os.path.relpath(os.path.abspath(filename), input_root)
+    return os.path.join(output_dir, os.path.splitext(relative)[0] + ".sgf")
+
+
+def pending_nodes(engine) -> Set:
+    """Nodes with queries queued for or running on the engine, or on any of the workers of an engine pool."""
+    nodes = set()
+    for part in getattr(engine, "workers", None) or [engine]:
+        nodes.update(entry[-1] for entry in list(part.queries.values()))
+        nodes.update(entry[-1][-1] for entry in list(part.write_queue.heap))
+    return nodes
+
+
+class BatchGame:
+    """A game being analyzed, with the files it is read from and written to."""
+
+    STALLED_AFTER = 10.0  # seconds without progress or queries before giving up on the remaining positions
+
+    def __init__(self, katrain, engine, filename: str, output: str):
+        self.filename = filename
+        self.output = output
+        self.partial = output + PARTIAL_SUFFIX
+        resume = os.path.exists(self.partial)
+        move_tree = KaTrainSGF.parse_file(self.partial if resume else filename)
+        self.game = Game(katrain, engine, move_tree=move_tree, sgf_filename=filename)  # starts analysis
+        self.game.external_game = True  # keep player names, as loaded
+        self.nodes = self.game.root.nodes_in_tree
+        self.resumed = resume
+        self.num_complete = 0
+        self.last_progress = time.time()
+
+    def progress(self, pending: Set) -> bool:
+        """Updates the count of analyzed positions, and returns whether the game is finished."""
+        num_complete = sum(node.analysis_complete for node in self.nodes)
+        if num_complete != self.num_complete:
+            self.num_complete = num_complete
+            self.last_progress = time.time()
+        if num_complete == len(self.nodes):
+            return True
+        stalled = time.time() - self.last_progress > self.STALLED_AFTER
+        return stalled and not any(node in pending for node in self.nodes)  # e.g. illegal moves
+
+    @property
+    def analyzed_nodes(self) -> List:
+        """Nodes analyzed in this run, rather than loaded from the file."""
+        return [node for node in self.nodes if node.analysis_complete and node.analysis_visits_requested]
+
+    def write(self, trainer_config: Dict, partial=False):
+        self.game.write_sgf(self.partial if partial else self.output, trainer_config=trainer_config)
+        if not partial and os.path.exists(self.partial):
+            os.remove(self.partial)
+
+
+class BatchAnalysis:
+    """Analyzes files with up to max_games at a time, and keeps count of the positions and visits analyzed."""
+
+    def __init__(
+        self,
+        katrain,
+        engine,
+        filenames: List[str],
+        output_dir: str,
+        max_games: int = 8,
+        checkpoint_every: float = 60.0,
+        force: bool = False,
+        report_every: float = 10.0,
+    ):
+        self.katrain = katrain
+        self.engine = engine
+        self.max_games = max_games
+        self.checkpoint_every = checkpoint_every
+        self.report_every = report_every
+        self.trainer_config = {**katrain.config("trainer", {}), "save_analysis": True}
+        input_root = os.path.commonpath([os.path.dirname(os.path.abspath(f)) for f in filenames]) if filenames else ""
+        self.todo = []
+        for filename in filenames:
+            output = output_filename(filename, input_root, output_dir)
+            if force or not os.path.exists(output):
+                self.todo.append((filename, output))
+        self.num_files = len(self.todo)
+        self.active = []  # type: List[BatchGame]
+        self.num_errors = self.num_games = self.num_positions = self.num_visits = 0
+        self.start_time = self.last_report = self.last_checkpoint = time.time()
+        katrain.log(f"Analyzing {len(self.todo)} of {len(filenames)} files, others were done before", OUTPUT_INFO)
+
+    def run(self, poll_interval: float = 0.5) -> int:
+        """Analyzes all files, returning the number which failed. Games in progress are checkpointed if interrupted."""
+        try:
+            while self.todo or self.active:
+                self.step()
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            self.checkpoint()
+            raise
+        self.report(final=True)
+        return self.num_errors
+
+    def step(self):
+        while self.todo and len(self.active) < self.max_games:
+            filename, output = self.todo.pop(0)
+            try:
+                self.active.append(BatchGame(self.katrain, self.engine, filename, output))
+            except Exception as e:  # report per file, never stop the batch
+                self.num_errors += 1
+                self.katrain.log(f"Could not load {filename}: {e.__class__.__name__}: {e}", OUTPUT_ERROR)
+        pending = pending_nodes(self.engine)
+        for batch_game in list(self.active):
+            if batch_game.progress(pending):
+                self.active.remove(batch_game)
+                self.finish(batch_game)
+        if time.time() - self.last_checkpoint > self.checkpoint_every:
+            self.checkpoint()
+        if time.time() - self.last_report > self.report_every:
+            self.report()
+
+    def finish(self, batch_game: BatchGame):
+        analyzed = batch_game.analyzed_nodes
+        self.num_games += 1
+        self.num_positions += len(analyzed)
+        self.num_visits += sum(node.root_visits for node in analyzed)
+        missing = len(batch_game.nodes) - batch_game.num_complete
+        try:
+            batch_game.write(self.trainer_config)
+        except OSError as e:
+            self.num_errors += 1
+            self.katrain.log(f"Could not write {batch_game.output}: {e}", OUTPUT_ERROR)
+            return
+        self.katrain.log(
+            f"Wrote {batch_game.output} ({len(analyzed)} positions analyzed"
+            + (f", {missing} could not be analyzed)" if missing else ")"),
+            OUTPUT_INFO,
+        )
+
+    def checkpoint(self):
+        self.last_checkpoint = time.time()
+        for batch_game in self.active:
+            try:
+                batch_game.write(self.trainer_config, partial=True)
+            except OSError as e:
+                self.katrain.log(f"Could not write {batch_game.partial}: {e}", OUTPUT_ERROR)
+
+    def report(self, final=False):
+        self.last_report = time.time()
+        time_taken = max(time.time() - self.start_time, 1e-9)
+        self.katrain.log(
+            f"{'Finished' if final else 'Progress'}: {self.num_games}/{self.num_files} games, "
+            f"{self.num_positions} positions, {self.num_positions / time_taken:.1f} positions/s, "
+            f"{self.num_visits / time_taken:.0f} visits/s",
+            OUTPUT_INFO,
+        )
+
+
+class BatchKaTrain(KaTrainBase):
+    def __call__(self, message, *args, **kwargs):  # e.g. the recovery popup
+        self.log(f"Not handling {message} in batch analysis", OUTPUT_INFO)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyze SGF/GIB/NGF files with KataGo and save the analysis.")
+    parser.add_argument("paths", nargs="+", help="Files, directories or glob patterns")
+    parser.add_argument("-o", "--output", default="analyzed", help="Output directory (default: analyzed)")
+    parser.add_argument("-c", "--config", help="KaTrain config.json to take engine and trainer settings from")
+    parser.add_argument("-v", "--visits", type=int, default=None, help="Visits per position (default: engine setting)")
+    parser.add_argument("-g", "--games", type=int, default=8, help="Number of games to analyze at once")
+    parser.add_argument("-f", "--force", action="store_true", help="Analyze files again if their output exists")
+    parser.add_argument("--checkpoint", type=float, default=60.0, help="Seconds between saving games in progress")
+    args = parser.parse_args(argv)
+    sys.argv = [sys.argv[0]] + ([args.config] if args.config else [])  # read by KaTrainBase
+
+    katrain = BatchKaTrain()
+    engine_config = katrain.config("engine")
+    if args.visits:
+        engine_config = {**engine_config, "max_visits": args.visits}
+    engine = make_engine(katrain, engine_config)
+    if not engine.check_alive():
+        katrain.log("Could not start the engine", OUTPUT_ERROR)
+        return 1
+    try:
+        batch = BatchAnalysis(
+            katrain,
+            engine,
+            find_game_files(args.paths),
+            args.output,
+            max_games=args.games,
+            checkpoint_every=args.checkpoint,
+            force=args.force,
+        )
+        num_errors = batch.run()
+    except KeyboardInterrupt:
+        katrain.log("Interrupted, run again to resume", OUTPUT_INFO)
+        num_errors = 1
+    finally:
+        engine.shutdown(finish=None)
+    return 1 if num_errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,317 @@
+"""Board position with incremental chain tracking.
+
+Chains are kept in a union-find structure, each with its set of liberties, so playing a move only touches the
+neighbouring chains and any captured stones, rather than the whole board.
+A 64-bit Zobrist hash of the stones is maintained alongside for each symmetry of the board, from which position
+hashes and the canonical hash identifying a position in any orientation are derived.
+"""
+
+import hashlib
+import json
+import random
+from typing import Dict, List, Optional, Tuple, Union
+
+from katrain.core.sgf_parser import Move
+
+
+class IllegalMoveException(Exception):
+    pass
+
+
+class BoardState:
+    """Stones, chains and captures for a single position. Points are indexed as y * width + x."""
+
+    __slots__ = (
+        "width",
+        "height",
+        "stone_at",
+        "parent",
+        "chain_points",
+        "liberties",
+        "prisoners",
+        "last_capture",
+        "ko_point",
+        "symmetric_zobrist",
+        "_view",
+    )
+
+    _NEIGHBOURS = {}  # board size -> neighbouring points for each point
+    _ZOBRIST = {}  # board size -> (black stone keys, white stone keys, ko keys, white to move key)
+    _SYMMETRIES = {}  # board size -> point permutations
+    _SYMMETRIC_ZOBRIST = {}  # board size -> black and white stone keys for each point, as a tuple over symmetries
+
+    def __init__(self, board_size: Tuple[int, int]):
+        self.width, self.height = board_size
+        num_points = self.width * self.height
+        self.stone_at = [None] * num_points  # point -> Move
+        self.parent = list(range(num_points))  # union-find forest, the root of a chain is its own parent
+        self.chain_points = {}  # type: Dict[int, List[int]]  # root -> points in the chain
+        self.liberties = {}  # type: Dict[int, set]  # root -> empty points next to the chain
+        self.prisoners = []  # type: List[Move]
+        self.last_capture = []  # type: List[Move]
+        self.ko_point = None  # type: Optional[int]  # point the player to move can not play due to ko
+        self.symmetric_zobrist = [0] * len(self.symmetries(self.width, self.height))  # of the stones only
+        self._view = None
+
+    @classmethod
+    def _neighbour_table(cls, width, height) -> List[Tuple[int, ...]]:
+        table = cls._NEIGHBOURS.get((width, height))
+        if table is None:
+            table = [
+                tuple(
+                    (y + dy) * width + x + dx
+                    for dx, dy in [(-1, 0), (1, 0), (0, -1), (0, 1)]
+                    if 0 <= x + dx < width and 0 <= y + dy < height
+                )
+                for y in range(height)
+                for x in range(width)
+            ]
+            cls._NEIGHBOURS[(width, height)] = table
+        return table
+
+    @classmethod
+    def _zobrist_table(cls, width, height) -> Tuple[List[int], List[int], List[int], int]:
+        table = cls._ZOBRIST.get((width, height))
+        if table is None:
+            rng = random.Random(f"zobrist {width}x{height}")  # fixed seed, so hashes can be stored and compared
+            num_points = width * height
+            black, white, ko = ([rng.getrandbits(64) for _ in range(num_points)] for _ in range(3))
+            table = (black, white, ko, rng.getrandbits(64))
+            cls._ZOBRIST[(width, height)] = table
+        return table
+
+    @classmethod
+    def _symmetric_zobrist_table(cls, width, height) -> Tuple[List[Tuple[int, ...]], List[Tuple[int, ...]]]:
+        table = cls._SYMMETRIC_ZOBRIST.get((width, height))
+        if table is None:
+            black, white, _, _ = cls._zobrist_table(width, height)
+            permutations = cls.symmetries(width, height)
+            table = tuple(
+                [tuple(keys[permutation[p]] for permutation in permutations) for p in range(width * height)]
+                for keys in [black, white]
+            )
+            cls._SYMMETRIC_ZOBRIST[(width, height)] = table
+        return table
+
+    @property
+    def zobrist(self) -> int:
+        """Hash of the stones only, as placed."""
+        return self.symmetric_zobrist[0]
+
+    def _toggle_stone_keys(self, player: str, point: int):
+        black, white = self._symmetric_zobrist_table(self.width, self.height)
+        keys = (black if player == "B" else white)[point]
+        self.symmetric_zobrist = [h ^ key for h, key in zip(self.symmetric_zobrist, keys)]
+
+    @classmethod
+    def symmetries(cls, width, height) -> List[List[int]]:
+        """For each symmetry of the board, the point every point maps to. The first is the identity.
+        Square boards have 8 symmetries, others only the 4 which keep the board's shape."""
+        table = cls._SYMMETRIES.get((width, height))
+        if table is None:
+            transforms = [
+                lambda x, y: (x, y),
+                lambda x, y: (width - 1 - x, y),
+                lambda x, y: (x, height - 1 - y),
+                lambda x, y: (width - 1 - x, height - 1 - y),
+            ]
+            if width == height:
+                transforms += [
+                    lambda x, y: (y, x),
+                    lambda x, y: (height - 1 - y, x),
+                    lambda x, y: (y, width - 1 - x),
+                    lambda x, y: (height - 1 - y, width - 1 - x),
+                ]
+            table = []
+            for transform in transforms:
+                points = [transform(p % width, p // width) for p in range(width * height)]
+                table.append([y * width + x for x, y in points])
+            cls._SYMMETRIES[(width, height)] = table
+        return table
+
+    @staticmethod
+    def rules_hash(rules: Union[str, Dict]) -> int:
+        """Stable 64-bit hash of a ruleset, as returned by KataGoEngine.get_rules"""
+        rules_json = json.dumps(rules, sort_keys=True)
+        return int.from_bytes(hashlib.blake2b(rules_json.encode(), digest_size=8).digest(), "little")
+
+    @staticmethod
+    def suicide_allowed(rules: Union[str, Dict]) -> bool:
+        return (isinstance(rules, str) and rules in ["tromp-taylor", "new zealand"]) or (
+            isinstance(rules, dict) and rules.get("suicide", False)
+        )
+
+    def position_hash(self, next_player: str, rules_hash: int = 0) -> int:
+        """64-bit hash of stones, player to move, ko point and ruleset."""
+        _, _, ko, white_to_move = self._zobrist_table(self.width, self.height)
+        position_hash = self.zobrist ^ rules_hash
+        if next_player == "W":
+            position_hash ^= white_to_move
+        if self.ko_point is not None:
+            position_hash ^= ko[self.ko_point]
+        return position_hash
+
+    def canonical_hash(self, next_player: str, rules_hash: int = 0) -> Tuple[int, int]:
+        """The smallest position hash over all symmetries of the board, and the index of that symmetry.
+        For the identity, this is the same as position_hash."""
+        _, _, ko, white_to_move = self._zobrist_table(self.width, self.height)
+        base_hash = rules_hash ^ (white_to_move if next_player == "W" else 0)
+        best = None
+        permutations = self.symmetries(self.width, self.height)
+        for symmetry, (stones_hash, permutation) in enumerate(zip(self.symmetric_zobrist, permutations)):
+            position_hash = base_hash ^ stones_hash
+            if self.ko_point is not None:
+                position_hash ^= ko[permutation[self.ko_point]]
+            if best is None or position_hash < best[0]:
+                best = (position_hash, symmetry)
+        return best
+
+    def copy(self) -> "BoardState":
+        state = BoardState.__new__(BoardState)
+        state.width, state.height = self.width, self.height
+        state.stone_at = self.stone_at[:]
+        state.parent = self.parent[:]
+        state.chain_points = {root: points[:] for root, points in self.chain_points.items()}
+        state.liberties = {root: set(liberties) for root, liberties in self.liberties.items()}
+        state.prisoners = self.prisoners[:]
+        state.last_capture = self.last_capture[:]
+        state.ko_point = self.ko_point
+        state.symmetric_zobrist = self.symmetric_zobrist  # replaced rather than changed in place, so can be shared
+        state._view = self._view
+        return state
+
+    @property
+    def num_bytes(self) -> int:
+        """Approximate memory use, for cache limits"""
+        num_stones = sum(len(points) for points in self.chain_points.values())
+        num_liberties = sum(len(liberties) for liberties in self.liberties.values())
+        return 8 * (
+            2 * len(self.stone_at)
+            + 30 * len(self.chain_points)
+            + num_stones
+            + 4 * num_liberties
+            + len(self.prisoners)
+            + len(self.last_capture)
+            + len(self.symmetric_zobrist)
+        )
+
+    def find(self, point: int) -> int:
+        """Returns the root of the chain at point"""
+        parent = self.parent
+        while parent[point] != point:
+            parent[point] = parent[parent[point]]  # path halving
+            point = parent[point]
+        return point
+
+    def _union(self, root: int, other_root: int) -> int:
+        if root == other_root:
+            return root
+        if len(self.chain_points[root]) < len(self.chain_points[other_root]):
+            root, other_root = other_root, root
+        self.parent[other_root] = root
+        self.chain_points[root] += self.chain_points.pop(other_root)
+        self.liberties[root] |= self.liberties.pop(other_root)
+        return root
+
+    def _remove_chain(self, root: int) -> List[Move]:
+        points = self.chain_points.pop(root)
+        del self.liberties[root]
+        stone_at, parent = self.stone_at, self.parent
+        removed = [stone_at[p] for p in points]
+        for p in points:
+            self._toggle_stone_keys(stone_at[p].player, p)
+            stone_at[p] = None
+            parent[p] = p
+        neighbours = self._neighbour_table(self.width, self.height)
+        for p in points:
+            for n in neighbours[p]:
+                if stone_at[n] is not None:
+                    self.liberties[self.find(n)].add(p)
+        return removed
+
+    def play(self, move: Move, ignore_ko: bool = False, suicide_allowed: bool = False):
+        """Plays a move, or raises IllegalMoveException and leaves the position unchanged."""
+        ko_or_snapback = len(self.last_capture) == 1 and self.last_capture[0] == move
+        if move.is_pass:
+            self.last_capture = []
+            self.ko_point = None
+            return
+        x, y = move.coords
+        point = y * self.width + x
+        stone_at = self.stone_at
+        if stone_at[point] is not None:
+            raise IllegalMoveException("Space occupied")
+
+        # check legality before changing anything
+        neighbours = self._neighbour_table(self.width, self.height)[point]
+        empty, own_roots, opponent_roots = [], set(), set()
+        for n in neighbours:
+            stone = stone_at[n]
+            if stone is None:
+                empty.append(n)
+            elif stone.player == move.player:
+                own_roots.add(self.find(n))
+            else:
+                opponent_roots.add(self.find(n))
+        captured_roots = [r for r in opponent_roots if len(self.liberties[r]) == 1]  # the only liberty is point
+        if ko_or_snapback and not ignore_ko and sum(len(self.chain_points[r]) for r in captured_roots) == 1:
+            raise IllegalMoveException("Ko")
+        suicide = not empty and not captured_roots and all(len(self.liberties[r]) == 1 for r in own_roots)
+        if suicide:
+            if not own_roots:  # even in new zealand rules, single stone suicide is not allowed
+                raise IllegalMoveException("Single stone suicide")
+            elif not suicide_allowed:
+                raise IllegalMoveException("Suicide")
+
+        self._view = None
+        stone_at[point] = move
+        self._toggle_stone_keys(move.player, point)
+        root = point
+        self.chain_points[point] = [point]
+        self.liberties[point] = set(empty)
+        for own_root in own_roots:
+            root = self._union(root, own_root)
+        self.liberties[root].discard(point)
+        self.last_capture = []
+        for opponent_root in opponent_roots:
+            self.liberties[opponent_root].discard(point)
+        for captured_root in captured_roots:
+            self.last_capture += self._remove_chain(captured_root)
+        if suicide:
+            self.last_capture += self._remove_chain(root)
+        self.prisoners += self.last_capture
+        self.ko_point = None
+        if len(self.last_capture) == 1 and len(self.chain_points.get(root, ())) == 1 and len(self.liberties[root]) == 1:
+            captured_x, captured_y = self.last_capture[0].coords
+            self.ko_point = captured_y * self.width + captured_x  # recapturing would only take back a single stone
+
+    def play_node(self, node, suicide_allowed: bool = False) -> "BoardState":
+        """Plays the moves and placements of an SGF node, ignoring ko since we can not know if it was forced.
+        Returns the resulting state, which is a new one if placements were cleared."""
+        for m in node.move_with_placements:
+            self.play(m, ignore_ko=True, suicide_allowed=suicide_allowed)
+        if node.clear_placements:  # handle AE by playing all moves left from empty board
+            clear_coords = {c.coords for c in node.clear_placements}
+            state = BoardState((self.width, self.height))
+            for m in self.stones():
+                if m.coords not in clear_coords:
+                    state.play(m, ignore_ko=True, suicide_allowed=suicide_allowed)
+            return state
+        return self
+
+    def stones(self) -> List[Move]:
+        """Returns all stones on the board"""
+        return [m for m in self.stone_at if m is not None]
+
+    def chain_view(self) -> Tuple[List[List[int]], List[List[Move]]]:
+        """Returns a grid of chain ids, with board[y][x] = -1 for empty points, and the chains as lists of moves.
+        Built on demand and shared until the next move, so should not be modified."""
+        if self._view is None:
+            board = [[-1] * self.width for _ in range(self.height)]
+            chains = []
+            for chain_id, points in enumerate(self.chain_points.values()):
+                chains.append([self.stone_at[p] for p in points])
+                for p in points:
+                    board[p // self.width][p % self.width] = chain_id
+            self._view = (board, chains)
+        return self._view
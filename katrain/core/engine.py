@@ -1,17 +1,22 @@
-import copy
+import collections
+import heapq
+import itertools
 import json
 import os
 import platform
 import queue
+import re
 import shlex
+import sqlite3
 import subprocess
 import threading
 import time
 import traceback
-from typing import Callable, Dict, List, Optional
+from typing import Callable, Dict, List, Optional, Tuple
 
 from kivy.utils import platform as kivy_platform
 
+from katrain.core.analysis_cache import AnalysisCache
 from katrain.core.constants import (
     OUTPUT_DEBUG,
     OUTPUT_ERROR,
@@ -20,6 +25,7 @@ from katrain.core.constants import (
     DATA_FOLDER,
     KATAGO_EXCEPTION,
     PONDERING_REPORT_DT,
+    PRIORITY_GAME_ANALYSIS,
 )
 from katrain.core.game_node import GameNode
 from katrain.core.lang import i18n
@@ -29,6 +35,14 @@ from katrain.core.utils import find_package_resource, json_truncate_arrays
 ENGINE_BACKENDS = ("local", "remote", "custom")
 
 
+def remote_urls(config) -> List[str]:
+    """The endpoints in `engine/remote_url`, a list or a string with URLs separated by spaces or commas."""
+    urls = config.get("remote_url") or []
+    if isinstance(urls, str):
+        urls = re.split(r"[\s,]+", urls)
+    return [url.strip() for url in urls if url and url.strip()]
+
+
 def resolve_engine_backend(config) -> str:
     """Which engine backend to use: 'local', 'remote' or 'custom'.
 
@@ -39,7 +53,7 @@ def resolve_engine_backend(config) -> str:
     backend = (config.get("backend") or "").strip().lower()
     if backend in ENGINE_BACKENDS:
         return backend
-    if (config.get("remote_url") or "").strip():
+    if remote_urls(config):
         return "remote"
     if (config.get("altcommand") or "").strip():
         return "custom"
@@ -110,17 +124,243 @@ class BaseEngine:  # some common elements between analysis and contribute engine
         print("ERROR", message, code)
 
 
+class QueryQueue:
+    """Queries waiting to be sent to KataGo, highest priority first. Background analysis queries are held back while
+    the engine has no capacity for them, so that they can still be overtaken by more urgent ones, re-prioritized or
+    cancelled. Queries above HELD_UP_TO_PRIORITY, such as for moves played and AI moves, are sent at once, and
+    actions such as terminate are always released first. Items are (query, callback, error_callback, next_move, node)
+    tuples, as with the queue.Queue it replaces."""
+
+    HELD_UP_TO_PRIORITY = PRIORITY_GAME_ANALYSIS
+
+    def __init__(self, has_capacity: Callable[[], bool] = lambda: True):
+        self.has_capacity = has_capacity
+        self.condition = threading.Condition()
+        self.heap = []
+        self.counter = itertools.count()  # first in first out for equal priority
+
+    def _entry(self, item, order=None):
+        query = item[0]
+        order = next(self.counter) if order is None else order
+        if query.get("action"):
+            return 0, 0, order, item
+        return 1, -query.get("priority", 0), order, item
+
+    def put(self, item):
+        with self.condition:
+            heapq.heappush(self.heap, self._entry(item))
+            self.condition.notify_all()
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while True:
+                if self.heap and (
+                    self.heap[0][0] == 0 or -self.heap[0][1] > self.HELD_UP_TO_PRIORITY or self.has_capacity()
+                ):
+                    return heapq.heappop(self.heap)[-1]
+                remaining = None if deadline is None else deadline - time.time()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise queue.Empty
+                self.condition.wait(remaining)
+
+    def notify(self):
+        """Wakes up waiting get calls, e.g. when capacity is freed up."""
+        with self.condition:
+            self.condition.notify_all()
+
+    def reprioritize(self, priority_fn: Optional[Callable] = None):
+        """Re-sorts after the priority of queued queries was changed in place, or sets it to priority_fn(query, node)
+        for analysis queries where that is not None."""
+        with self.condition:
+            if priority_fn:
+                for query, *_, node in [entry[-1] for entry in self.heap if entry[0]]:
+                    priority = priority_fn(query, node)
+                    if priority is not None:
+                        query["priority"] = priority
+            self.heap = [self._entry(item, order) for _, _, order, item in self.heap]
+            heapq.heapify(self.heap)
+
+    def remove(self, predicate: Callable) -> List:
+        """Removes and returns queued analysis queries for which predicate(query, node) is true."""
+        with self.condition:
+            kept, removed = [], []
+            for entry in self.heap:
+                query, *_, node = entry[-1]
+                (removed if entry[0] and predicate(query, node) else kept).append(entry)
+            if removed:
+                self.heap = kept
+                heapq.heapify(self.heap)
+            return [entry[-1] for entry in removed]
+
+    def empty(self):
+        return not self.heap
+
+    def qsize(self):
+        return len(self.heap)
+
+
+class InFlightQuery:
+    """An analysis query sent or queued for KataGo, with the callbacks of all identical requests attached to it."""
+
+    __slots__ = ("engine", "key", "query", "next_move", "node", "callbacks", "num_results", "turns_remaining")
+
+    def __init__(self, engine, key, query, callback, error_callback, next_move, node):
+        self.engine = engine
+        self.key = key
+        self.query = query
+        self.next_move = next_move
+        self.node = node
+        self.callbacks = [(callback, error_callback)]
+        self.num_results = 0
+        self.turns_remaining = len(query.get("analyzeTurns") or [0])
+
+    def on_result(self, analysis, partial_result):
+        self.num_results += 1
+        if not partial_result:
+            self.turns_remaining -= 1
+            if self.turns_remaining <= 0:
+                self.engine._release_query(self)
+        for callback, _ in list(self.callbacks):
+            if callback:
+                callback(analysis, partial_result)
+
+    def on_error(self, analysis):
+        self.engine._release_query(self)
+        error_callbacks = [error_callback for _, error_callback in self.callbacks if error_callback]
+        for error_callback in error_callbacks:
+            error_callback(analysis)
+        if not error_callbacks and not (self.next_move and "Illegal move" in analysis["error"]):  # sweep
+            self.engine.katrain.log(f"{analysis} received from KataGo", OUTPUT_ERROR)
+
+
+class CallbackMetrics:
+    __slots__ = ("calls", "total_time", "max_time", "total_wait")
+
+    def __init__(self):
+        self.calls = 0
+        self.total_time = self.max_time = self.total_wait = 0.0
+
+    def as_dict(self) -> Dict:
+        return {
+            "calls": self.calls,
+            "mean_time": self.total_time / self.calls,
+            "max_time": self.max_time,
+            "mean_wait": self.total_wait / self.calls,
+        }
+
+
+class CallbackDispatcher:
+    """Runs analysis callbacks on threads of its own, so reading engine output never waits for application code.
+
+    Callbacks for the same node run one at a time, in the order their results arrived. A partial result still waiting
+    to be handled is replaced by a newer one for the same query, so the queue holds at most a final result per turn
+    and one partial result per query in flight. Threads are started when needed and stop when idle.
+    Logs and GUI updates go to the katrain of the engine it belongs to, which changes when the engine is handed over."""
+
+    IDLE_TIMEOUT = 10.0
+    SLOW_CALLBACK = 0.1  # seconds, logged
+
+    def __init__(self, engine, num_threads: int = 1):
+        self.engine = engine
+        self.num_threads = max(1, num_threads)
+        self.condition = threading.Condition()
+        self.pending = {}  # node -> deque of (query id, partial, callback, args, name, time queued) while any are left
+        self.ready = collections.deque()  # nodes with callbacks queued and none running
+        self.num_workers = 0
+        self.num_idle = 0
+        self.num_superseded = 0
+        self.metrics = {}  # type: Dict[str, CallbackMetrics]
+
+    @property
+    def katrain(self):
+        return self.engine.katrain
+
+    @staticmethod
+    def callback_name(callback) -> str:
+        owner = getattr(callback, "__self__", None)
+        if isinstance(owner, InFlightQuery) and owner.callbacks:  # name it after the first request's callback
+            callback = owner.callbacks[0][0] or owner.callbacks[0][1]
+        return getattr(callback, "__qualname__", None) or repr(callback)
+
+    def dispatch(self, node, query_id, callback, *args, partial=False):
+        task = (query_id, partial, callback, args, self.callback_name(callback), time.time())
+        with self.condition:
+            tasks = self.pending.get(node)
+            if tasks is None:
+                tasks = self.pending[node] = collections.deque()
+                self.ready.append(node)
+            elif partial and tasks and tasks[-1][1] and tasks[-1][0] == query_id:
+                tasks[-1] = task  # superseded before it was handled
+                self.num_superseded += 1
+                return
+            tasks.append(task)
+            if self.num_idle:
+                self.condition.notify()
+            elif self.num_workers < self.num_threads:
+                self.num_workers += 1
+                threading.Thread(target=self._dispatch_thread, daemon=True).start()
+
+    def qsize(self) -> int:
+        with self.condition:
+            return sum(len(tasks) for tasks in self.pending.values())
+
+    def is_idle(self) -> bool:
+        return not self.pending
+
+    def callback_metrics(self) -> Dict[str, Dict]:
+        """Number of calls, and mean and maximum seconds taken, and mean seconds waited in the queue, per callback."""
+        with self.condition:
+            return {name: metrics.as_dict() for name, metrics in self.metrics.items()}
+
+    def _dispatch_thread(self):
+        while True:
+            with self.condition:
+                if not self.ready:
+                    self.num_idle += 1
+                    self.condition.wait(timeout=self.IDLE_TIMEOUT)
+                    self.num_idle -= 1
+                    if not self.ready:
+                        self.num_workers -= 1
+                        return
+                node = self.ready.popleft()
+                query_id, _, callback, args, name, queued = self.pending[node].popleft()
+            start = time.time()
+            try:
+                callback(*args)
+            except Exception as e:
+                self.katrain.log(f"Error in engine callback {name} for query {query_id}: {e}", OUTPUT_ERROR)
+                traceback.print_exc()
+            time_taken = time.time() - start
+            if time_taken > self.SLOW_CALLBACK:
+                self.katrain.log(f"Engine callback {name} for query {query_id} took {time_taken:.2f}s", OUTPUT_DEBUG)
+            with self.condition:
+                metrics = self.metrics.get(name) or self.metrics.setdefault(name, CallbackMetrics())
+                metrics.calls += 1
+                metrics.total_time += time_taken
+                metrics.max_time = max(metrics.max_time, time_taken)
+                metrics.total_wait += start - queued
+                if self.pending[node]:
+                    self.ready.append(node)
+                else:
+                    del self.pending[node]
+            if getattr(self.katrain, "update_state", None):  # easier mocking etc
+                self.katrain.update_state()
+
+
 class KataGoEngine(BaseEngine):
     """Starts and communicates with the KataGO analysis engine"""
 
     PONDER_KEY = "_kt_continuous"
     ENGINE_TYPE = "local"  # passed to the recovery popup so it can tailor its advice
+    DEFAULT_QUERY_WINDOW = 16
 
     def __init__(self, katrain, config):
         super().__init__(katrain, config)
 
         self.allow_recovery = self.config.get("allow_recovery", True)  # if false, don't give popups
         self.queries = {}  # outstanding query id -> start time and callback
+        self.turns_remaining = {}  # query id -> final results still to come, for queries analyzing several turns
         self.ponder_query = None
         self.query_counter = 0
         self.katago_process = None
@@ -130,14 +370,22 @@ class KataGoEngine(BaseEngine):
         self.stderr_thread = None
         self.write_stdin_thread = None
         self.shell = False
-        self.write_queue = queue.Queue()
+        self.query_window = self.config.get("max_queries_in_flight") or self.DEFAULT_QUERY_WINDOW
+        self.write_queue = QueryQueue(self.has_query_capacity)
         self.thread_lock = threading.Lock()
+        self.in_flight = {}  # type: Dict[str, InFlightQuery]  # canonical query -> query sent or queued for it
+        self.in_flight_lock = threading.Lock()
+        self.num_duplicate_queries = 0
+        self.callback_dispatcher = self._create_callback_dispatcher()
+        self.analysis_cache = None
         if resolve_engine_backend(config) == "custom":
             self.command = config["altcommand"]
             self.shell = True
         else:
             model = find_package_resource(config["model"])
             cfg = find_package_resource(config["config"])
+            if not self.config.get("max_queries_in_flight"):
+                self.query_window = self.query_window_for_config(cfg)
             exe = self.get_engine_path(config.get("katago", "").strip())
             
             if not exe:
@@ -161,6 +409,7 @@ class KataGoEngine(BaseEngine):
                 self.command = shlex.split(
                     f'"{exe}" analysis -model "{model}" -config "{cfg}" -override-config "homeDataDir={os.path.expanduser(DATA_FOLDER)}"'
                 )
+        self.analysis_cache = self.open_analysis_cache(engine_id=str(self.command))
         self.start()
 
     def on_error(self, message, code=None, allow_popup=True):
@@ -168,9 +417,39 @@ class KataGoEngine(BaseEngine):
         if self.allow_recovery and allow_popup:
             self.katrain("engine_recovery_popup", message, code, self.ENGINE_TYPE)
 
+    def _create_callback_dispatcher(self) -> CallbackDispatcher:
+        return CallbackDispatcher(self, self.config.get("callback_threads", 1))
+
+    def open_analysis_cache(self, engine_id: str) -> Optional[AnalysisCache]:
+        """Opens the shared on-disk analysis cache, or returns None if it is disabled or can not be opened."""
+        cache_mb = self.config.get("analysis_cache_mb", 256)
+        if not cache_mb:
+            return None
+        filename = os.path.join(os.path.expanduser(DATA_FOLDER), "analysis_cache.sqlite")
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            return AnalysisCache(filename, max_bytes=int(cache_mb * 1024 * 1024), engine_id=engine_id)
+        except (OSError, sqlite3.Error) as e:
+            self.katrain.log(f"Could not open analysis cache {filename}: {e}", OUTPUT_ERROR)
+            return None
+
+    @classmethod
+    def query_window_for_config(cls, cfg: str) -> int:
+        """Twice the number of positions KataGo analyzes in parallel, so one is ready whenever a search finishes."""
+        try:
+            with open(cfg, encoding="utf-8") as f:
+                threads = re.search(r"^\s*numAnalysisThreads\s*=\s*(\d+)", f.read(), re.MULTILINE)
+        except OSError:
+            threads = None
+        return 2 * int(threads.group(1)) if threads else cls.DEFAULT_QUERY_WINDOW
+
+    def has_query_capacity(self) -> bool:
+        """Whether to send more analysis queries, with those covering several turns counting once per turn."""
+        return sum(self.turns_remaining.get(query_id, 1) for query_id in list(self.queries)) < self.query_window
+
     def start(self):
         with self.thread_lock:
-            self.write_queue = queue.Queue()
+            self.write_queue = QueryQueue(self.has_query_capacity)
             try:
                 self.katrain.log(f"Starting KataGo with {self.command}", OUTPUT_DEBUG)
                 startupinfo = None
@@ -199,19 +478,48 @@ class KataGoEngine(BaseEngine):
         self.base_priority += 1
         if not self.is_idle():
             with self.thread_lock:
-                self.write_queue = queue.Queue()
+                self.write_queue = QueryQueue(self.has_query_capacity)
                 self.terminate_queries(only_for_node=None, lock=False)
                 self.ponder_query = None
                 self.queries = {}
+                self.turns_remaining = {}
+                with self.in_flight_lock:
+                    self.in_flight = {}
 
     def terminate_queries(self, only_for_node=None, lock=True):
         if lock:
             with self.thread_lock:
                 return self.terminate_queries(only_for_node=only_for_node, lock=False)
+        cancelled = self.write_queue.remove(lambda query, node: only_for_node is None or only_for_node is node)
+        with self.in_flight_lock:
+            for query, *_ in cancelled:
+                in_flight = self.in_flight.get(self._query_key(query))
+                if in_flight is not None and in_flight.query is query:
+                    del self.in_flight[in_flight.key]
         for query_id, (_, _, _, _, node) in list(self.queries.items()):
             if only_for_node is None or only_for_node is node:
                 self.terminate_query(query_id)
 
+    def terminate_queries_where(self, predicate: Callable) -> List[Tuple[Dict, GameNode]]:
+        """Drops queued and terminates sent analysis queries for which predicate(query, node) is true, returning them as
+        (query, node), e.g. to send their turns again in another order."""
+        with self.thread_lock:
+            removed = [(query, node) for query, *_, node in self.write_queue.remove(predicate)]
+            removed_queries = {id(query) for query, _ in removed}
+            sent_ids = []
+            with self.in_flight_lock:
+                for in_flight in list(self.in_flight.values()):
+                    query = in_flight.query
+                    if id(query) in removed_queries:
+                        del self.in_flight[in_flight.key]
+                    elif query.get("id") in self.queries and predicate(query, in_flight.node):
+                        del self.in_flight[in_flight.key]
+                        removed.append((query, in_flight.node))
+                        sent_ids.append(query["id"])
+            for query_id in sent_ids:
+                self.terminate_query(query_id)
+        return removed
+
     def stop_pondering(self):
         pq = self.ponder_query
         if pq:
@@ -224,10 +532,13 @@ class KataGoEngine(BaseEngine):
         if query_id is not None:
             self.send_query({"action": "terminate", "terminateId": query_id}, None, None)
             if ignore_further_results:
-                self.queries.pop(query_id, None)
+                self._forget_query(query_id)
 
     def restart(self):
         self.queries = {}
+        self.turns_remaining = {}
+        with self.in_flight_lock:
+            self.in_flight = {}
         self.shutdown(finish=False)
         self.start()
 
@@ -248,7 +559,7 @@ class KataGoEngine(BaseEngine):
         return ok
 
     def wait_to_finish(self):
-        while self.queries and self.katago_process and self.katago_process.poll() is None:
+        while not self.is_idle() and self.katago_process and self.katago_process.poll() is None:
             time.sleep(0.1)
 
     def shutdown(self, finish=False):
@@ -266,10 +577,14 @@ class KataGoEngine(BaseEngine):
                     t.join()
 
     def is_idle(self):
-        return not self.queries and self.write_queue.empty()
+        return not self.queries and self.write_queue.empty() and self.callback_dispatcher.is_idle()
 
     def queries_remaining(self):
-        return len(self.queries) + int(not self.write_queue.empty())
+        return len(self.queries) + self.write_queue.qsize()
+
+    def has_pending_queries(self) -> bool:
+        """Whether any queries are queued, or sent and still waiting for results."""
+        return bool(self.queries) or not self.write_queue.empty()
 
     def _read_stderr_thread(self):
         while self.katago_process is not None:
@@ -319,11 +634,12 @@ class KataGoEngine(BaseEngine):
                             f"Query result {query_id} discarded -- recent new game or node reset?", OUTPUT_DEBUG
                         )
                     continue
-                callback, error_callback, start_time, next_move, _ = self.queries[query_id]
+                callback, error_callback, start_time, next_move, node = self.queries[query_id]
                 if "error" in analysis:
-                    del self.queries[query_id]
+                    self._forget_query(query_id)
                     if error_callback:
-                        error_callback(analysis)
+                        self.callback_dispatcher.dispatch(node, query_id, error_callback, analysis)
+                        continue
                     elif not (next_move and "Illegal move" in analysis["error"]):  # sweep
                         self.katrain.log(f"{analysis} received from KataGo", OUTPUT_ERROR)
                 elif "warning" in analysis:
@@ -333,7 +649,7 @@ class KataGoEngine(BaseEngine):
                 else:
                     partial_result = analysis.get("isDuringSearch", False)
                     if not partial_result:
-                        del self.queries[query_id]
+                        self._finish_turn(query_id)
                     time_taken = time.time() - start_time
                     results_exist = not analysis.get("noResults", False)
                     self.katrain.log(
@@ -341,12 +657,11 @@ class KataGoEngine(BaseEngine):
                         OUTPUT_DEBUG,
                     )
                     self.katrain.log(json_truncate_arrays(analysis), OUTPUT_EXTRA_DEBUG)
-                    try:
-                        if callback and results_exist:
-                            callback(analysis, partial_result)
-                    except Exception as e:
-                        self.katrain.log(f"Error in engine callback for query {query_id}: {e}", OUTPUT_ERROR)
-                        traceback.print_exc()
+                    if callback and results_exist:  # update_state is called once it ran
+                        self.callback_dispatcher.dispatch(
+                            node, query_id, callback, analysis, partial_result, partial=partial_result
+                        )
+                        continue
                 if getattr(self.katrain, "update_state", None):  # easier mocking etc
                     self.katrain.update_state()
             except Exception as e:
@@ -385,6 +700,8 @@ class KataGoEngine(BaseEngine):
                 terminate = query.get("action") == "terminate"
                 if not terminate:
                     self.queries[query["id"]] = (callback, error_callback, time.time(), next_move, node)
+                    if len(query.get("analyzeTurns", [])) > 1:
+                        self.turns_remaining[query["id"]] = len(query["analyzeTurns"])
                 tag = "ponder " if ponder else ("terminate " if terminate else "")
                 self.katrain.log(f"Sending {tag}query {query['id']}: {json.dumps(query)}", OUTPUT_DEBUG)
                 try:
@@ -394,9 +711,194 @@ class KataGoEngine(BaseEngine):
                     self.katrain.log(f"Exception in writing to katago: {e}", OUTPUT_DEBUG)
                     return  # some other thread will take care of this
 
+    def _finish_turn(self, query_id):
+        """Called on final results, and forgets the query once all turns it analyzes have them."""
+        remaining = self.turns_remaining.pop(query_id, 1) - 1
+        if remaining > 0:
+            self.turns_remaining[query_id] = remaining
+            self.write_queue.notify()  # turns count towards the query window
+        else:
+            self._forget_query(query_id)
+
+    def _forget_query(self, query_id):
+        self.queries.pop(query_id, None)
+        self.turns_remaining.pop(query_id, None)
+        self.write_queue.notify()
+
+    def analysis_settings(self) -> Dict:
+        """Settings sent with every analysis query which change its results, part of the analysis cache key."""
+        return {**self.override_settings, "wideRootNoise": self.config["wide_root_noise"]}
+
+    def requested_visits(self, visits: Optional[int] = None, analyze_fast: bool = False) -> int:
+        if visits is None:
+            visits = self.config["max_visits"]
+            if analyze_fast and self.config.get("fast_visits"):
+                visits = self.config["fast_visits"]
+        return visits
+
+    @classmethod
+    def _query_key(cls, query) -> Optional[str]:
+        """Canonical form of an analysis query, identical for requests which would give the same results."""
+        if query.get("action") or query.get(cls.PONDER_KEY):
+            return None
+        return json.dumps({k: v for k, v in query.items() if k not in ["id", "priority"]}, sort_keys=True)
+
     def send_query(self, query, callback, error_callback, next_move=None, node=None):
+        """Queues a query for KataGo. Analysis queries identical to one still in flight, apart from id and priority,
+        are not sent again, but get their callbacks attached to it."""
+        key = self._query_key(query)
+        if key is not None:
+            with self.in_flight_lock:
+                in_flight = self.in_flight.get(key)
+                sent_id = in_flight and in_flight.query.get("id")
+                if in_flight is not None and (sent_id is None or sent_id in self.queries):
+                    self.num_duplicate_queries += 1
+                    in_flight.callbacks.append((callback, error_callback))
+                    if query.get("priority", 0) > in_flight.query.get("priority", 0):
+                        self._raise_priority(in_flight, query["priority"])
+                    return
+                in_flight = InFlightQuery(self, key, query, callback, error_callback, next_move, node)
+                self.in_flight[key] = in_flight
+            callback, error_callback = in_flight.on_result, in_flight.on_error
         self.write_queue.put((query, callback, error_callback, next_move, node))
 
+    def _raise_priority(self, in_flight: InFlightQuery, priority: int):
+        sent_id = in_flight.query.get("id")
+        if sent_id is None:  # still queued, so just send it with the higher priority
+            in_flight.query["priority"] = priority
+            self.write_queue.reprioritize()
+        elif not in_flight.num_results:  # likely still queued in KataGo, re-send it with the higher priority
+            in_flight.query = {k: v for k, v in in_flight.query.items() if k != "id"}
+            in_flight.query["priority"] = priority
+            self._forget_query(sent_id)
+            self.write_queue.put(
+                (in_flight.query, in_flight.on_result, in_flight.on_error, in_flight.next_move, in_flight.node)
+            )
+            self.write_queue.put(({"action": "terminate", "terminateId": sent_id}, None, None, None, None))
+
+    def reprioritize_queries(self, priority_fn: Callable):
+        """Sets the priority of queries not sent yet to priority_fn(priority, query, node), with priorities relative to
+        the base priority of the current game, or leaves it if that returns None."""
+        base_priority = self.base_priority
+
+        def absolute_priority(query, node):
+            priority = priority_fn(query.get("priority", 0) - base_priority, query, node)
+            return None if priority is None else base_priority + priority
+
+        self.write_queue.reprioritize(absolute_priority)
+
+    def _release_query(self, in_flight: InFlightQuery):
+        with self.in_flight_lock:
+            if self.in_flight.get(in_flight.key) is in_flight:
+                del self.in_flight[in_flight.key]
+
+    def _analysis_query(
+        self,
+        analysis_node: GameNode,
+        moves: List[Move],
+        initial_stones: List[Move],
+        analyze_turns: List[int],
+        visits: int,
+        priority: int,
+        ownership: bool,
+        time_limit: bool,
+        include_policy: bool,
+        extra_settings: Optional[Dict],
+    ) -> Dict:
+        size_x, size_y = analysis_node.board_size
+        settings = self.analysis_settings()
+        if time_limit:
+            settings["maxTime"] = self.config["max_time"]
+        return {
+            "rules": self.get_rules(analysis_node.ruleset),
+            "priority": self.base_priority + priority,
+            "analyzeTurns": analyze_turns,
+            "maxVisits": visits,
+            "komi": analysis_node.komi,
+            "boardXSize": size_x,
+            "boardYSize": size_y,
+            "includeOwnership": ownership,
+            "includeMovesOwnership": ownership,
+            "includePolicy": include_policy,
+            "initialStones": [[m.player, m.gtp()] for m in initial_stones],
+            "initialPlayer": analysis_node.initial_player,
+            "moves": [[m.player, m.gtp()] for m in moves],
+            "overrideSettings": {**settings, **(extra_settings or {})},
+        }
+
+    def request_branch_analysis(
+        self,
+        nodes: List[GameNode],
+        callback: Callable,
+        error_callback: Optional[Callable] = None,
+        visits: int = None,
+        analyze_fast: bool = False,
+        time_limit=True,
+        priority: int = 0,
+        ownership: Optional[bool] = None,
+        include_policy=True,
+        report_every: Optional[float] = None,
+    ):
+        """Analyzes nodes on a single branch, ordered from the root down, with one query listing all their turns.
+        Results are passed on as callback(node, analysis, partial_result), routed by turn number.
+        Nodes above setup stones in the branch can not share its initial stones, and are analyzed one by one."""
+        path = nodes[-1].nodes_from_root
+        if any(node.clear_placements for node in path):
+            self.katrain.log(f"Not analyzing branch {nodes[-1]} as there are AE commands in the path", OUTPUT_DEBUG)
+            return
+        last_setup = max(i for i, node in enumerate(path) if i == 0 or node.placements)
+        turns = {}  # turn number -> nodes
+        moves = []
+        selected = set(nodes)
+        for i, node in enumerate(path):
+            moves += node.moves
+            if node not in selected:
+                continue
+            if i < last_setup:
+                self.request_analysis(
+                    node,
+                    callback=lambda analysis, partial_result, node=node: callback(node, analysis, partial_result),
+                    error_callback=error_callback,
+                    visits=visits,
+                    analyze_fast=analyze_fast,
+                    time_limit=time_limit,
+                    priority=priority,
+                    ownership=ownership,
+                    include_policy=include_policy,
+                    report_every=report_every,
+                )
+            else:
+                turns.setdefault(len(moves), []).append(node)
+        if not turns:
+            return
+
+        def on_result(analysis, partial_result):
+            for node in turns.get(analysis.get("turnNumber"), []):
+                callback(node, analysis, partial_result)
+
+        visits = self.requested_visits(visits, analyze_fast)
+        if ownership is None:
+            ownership = self.config["_enable_ownership"]
+        initial_stones = [m for node in path for m in node.placements]
+        query = self._analysis_query(
+            nodes[-1],
+            moves,
+            initial_stones,
+            sorted(turns),
+            visits,
+            priority,
+            ownership,
+            time_limit,
+            include_policy,
+            None,
+        )
+        if report_every is not None:
+            query["reportDuringSearchEvery"] = report_every
+        self.send_query(query, on_result, error_callback, None, nodes[-1])
+        for turn_nodes in turns.values():
+            for node in turn_nodes:
+                node.analysis_visits_requested = max(node.analysis_visits_requested, visits)
+
     def request_analysis(
         self,
         analysis_node: GameNode,
@@ -428,10 +930,7 @@ class KataGoEngine(BaseEngine):
         if ownership is None:
             ownership = self.config["_enable_ownership"] and not next_move
 
-        if visits is None:
-            visits = self.config["max_visits"]
-            if analyze_fast and self.config.get("fast_visits"):
-                visits = self.config["fast_visits"]
+        visits = self.requested_visits(visits, analyze_fast)
 
         size_x, size_y = analysis_node.board_size
 
@@ -461,28 +960,19 @@ class KataGoEngine(BaseEngine):
         else:
             avoid = []
 
-        settings = copy.copy(self.override_settings)
-        settings["wideRootNoise"] = self.config["wide_root_noise"]
-        if time_limit:
-            settings["maxTime"] = self.config["max_time"]
-
-        query = {
-            "rules": self.get_rules(analysis_node.ruleset),
-            "priority": self.base_priority + priority,
-            "analyzeTurns": [len(moves)],
-            "maxVisits": visits,
-            "komi": analysis_node.komi,
-            "boardXSize": size_x,
-            "boardYSize": size_y,
-            "includeOwnership": ownership and not next_move,
-            "includeMovesOwnership": ownership and not next_move,
-            "includePolicy": include_policy,
-            "initialStones": [[m.player, m.gtp()] for m in initial_stones],
-            "initialPlayer": analysis_node.initial_player,
-            "moves": [[m.player, m.gtp()] for m in moves],
-            "overrideSettings": {**settings, **(extra_settings or {})},
-            self.PONDER_KEY: ponder,
-        }
+        query = self._analysis_query(
+            analysis_node,
+            moves,
+            initial_stones,
+            [len(moves)],
+            visits,
+            priority,
+            ownership and not next_move,
+            time_limit,
+            include_policy,
+            extra_settings,
+        )
+        query[self.PONDER_KEY] = ponder
         if report_every is not None:
             query["reportDuringSearchEvery"] = report_every
         if avoid:
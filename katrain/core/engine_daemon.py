@@ -0,0 +1,426 @@
+"""Shared KataGo daemon.
+
+Keeps a single KataGo analysis process, with its loaded model and neural net cache, running across KaTrain sessions.
+It serves the KataGo analysis JSON protocol over a WebSocket on localhost, the same protocol RemoteKataGoEngine speaks,
+so new KaTrain instances and headless tools attach to it without waiting for the model to load again. The daemon
+exits once no client has been connected and no query has been running for `engine/daemon_idle_timeout` seconds.
+
+make_engine starts it on demand when `engine/daemon` is set, and it can also be started with `katrain-daemon`.
+The server only uses the standard library, so the daemon starts quickly and does not need a WebSocket server package.
+"""
+
+import argparse
+import base64
+import hashlib
+import itertools
+import json
+import os
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from katrain.core.constants import OUTPUT_DEBUG, OUTPUT_ERROR, OUTPUT_INFO
+from katrain.core.engine import resolve_engine_backend
+
+DAEMON_HOST = "127.0.0.1"  # never reachable from other machines
+DEFAULT_DAEMON_PORT = 6510
+DEFAULT_IDLE_TIMEOUT = 600
+DAEMON_START_TIMEOUT = 10.0  # seconds to wait for a newly started daemon to accept connections
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+OPCODE_CONTINUATION, OPCODE_TEXT, OPCODE_BINARY, OPCODE_CLOSE, OPCODE_PING, OPCODE_PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+MAX_MESSAGE_BYTES = 16 * 1024 * 1024
+DAEMON_HEADER = "X-KaTrain-Daemon"  # carries the fingerprint in plain HTTP responses, see probe_daemon
+
+ENGINE_IDENTITY_KEYS = ("backend", "katago", "altcommand", "model", "humanlike_model", "config")
+
+
+def engine_fingerprint(config) -> str:
+    """Identifies the engine settings a daemon runs with, so clients with a different model do not attach to it."""
+    identity = {key: config.get(key) or "" for key in ENGINE_IDENTITY_KEYS}
+    identity["backend"] = resolve_engine_backend(config)
+    return hashlib.sha1(json.dumps(identity, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def daemon_url(config) -> str:
+    port = int(config.get("daemon_port") or DEFAULT_DAEMON_PORT)
+    return f"ws://{DAEMON_HOST}:{port}/{engine_fingerprint(config)}"
+
+
+def websocket_accept_key(key: str) -> str:
+    return base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+
+
+def encode_frame(opcode: int, payload: bytes) -> bytes:
+    """A single unmasked frame, as sent by servers."""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def _read_exact(rfile, num_bytes: int) -> bytes:
+    data = rfile.read(num_bytes)
+    if len(data) < num_bytes:
+        raise EOFError("Connection closed")
+    return data
+
+
+def read_frame(rfile) -> Tuple[bool, int, bytes]:
+    """Reads one frame, returning (final fragment, opcode, unmasked payload)."""
+    first, second = _read_exact(rfile, 2)
+    length = second & 0x7F
+    if length == 126:
+        (length,) = struct.unpack("!H", _read_exact(rfile, 2))
+    elif length == 127:
+        (length,) = struct.unpack("!Q", _read_exact(rfile, 8))
+    if length > MAX_MESSAGE_BYTES:
+        raise ValueError(f"Frame of {length} bytes is too large")
+    mask = _read_exact(rfile, 4) if second & 0x80 else None
+    payload = _read_exact(rfile, length)
+    if mask and length:
+        key = int.from_bytes((mask * (length // 4 + 1))[:length], "big")
+        payload = (int.from_bytes(payload, "big") ^ key).to_bytes(length, "big")
+    return bool(first & 0x80), first & 0x0F, payload
+
+
+class DaemonClient:
+    """A connected KaTrain instance or tool, with the queries it has running on the daemon's engine."""
+
+    def __init__(self, name: str, wfile):
+        self.name = name
+        self.wfile = wfile
+        self.send_lock = threading.Lock()
+        self.queries = {}  # type: Dict[str, List]  # client query id -> [engine query id, turns remaining]
+        self.closed = False
+
+    def send_frame(self, opcode: int, payload: bytes):
+        with self.send_lock:
+            if self.closed:
+                return
+            try:
+                self.wfile.write(encode_frame(opcode, payload))
+                self.wfile.flush()
+            except OSError:
+                self.closed = True
+
+    def send(self, message: Dict):
+        self.send_frame(OPCODE_TEXT, json.dumps(message).encode())
+
+
+class _WebSocketHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        daemon = self.server.engine_daemon
+        if not self._handshake(daemon):
+            return
+        client = daemon.connect(self.wfile)
+        try:
+            message = b""
+            while not client.closed:
+                fin, opcode, payload = read_frame(self.rfile)
+                if opcode == OPCODE_CLOSE:
+                    client.send_frame(OPCODE_CLOSE, payload[:2])
+                    return
+                if opcode == OPCODE_PING:
+                    client.send_frame(OPCODE_PONG, payload)
+                elif opcode in (OPCODE_TEXT, OPCODE_BINARY, OPCODE_CONTINUATION):
+                    message += payload
+                    if len(message) > MAX_MESSAGE_BYTES:
+                        raise ValueError("Message is too large")
+                    if fin:
+                        for line in message.decode("utf-8", errors="replace").splitlines():
+                            if line.strip():
+                                daemon.handle_message(client, line)
+                        message = b""
+        except (EOFError, OSError, ValueError) as e:
+            daemon.katrain.log(f"Client {client.name} disconnected: {e}", OUTPUT_DEBUG)
+        finally:
+            daemon.disconnect(client)
+
+    def _handshake(self, daemon: "EngineDaemon") -> bool:
+        request_line = self.rfile.readline(65537).decode("latin-1").split()
+        headers = {}
+        while True:
+            line = self.rfile.readline(65537).decode("latin-1").strip()
+            if not line:
+                break
+            key, _, value = line.partition(":")
+            headers[key.strip().lower()] = value.strip()
+        path = request_line[1] if len(request_line) > 1 else ""
+        if path.strip("/") != daemon.fingerprint:
+            self._respond("409 Conflict", "This KataGo daemon runs with different engine settings.", daemon)
+            daemon.stop_if_unused()  # so a client with the new settings can start a daemon of its own
+            return False
+        # browsers always send the origin of the page, which must not be able to use the engine
+        origin = headers.get("origin")
+        if origin and origin not in (f"http://{DAEMON_HOST}:{daemon.port}", f"http://localhost:{daemon.port}"):
+            self._respond("403 Forbidden", "Web pages can not use the KataGo daemon.", daemon)
+            return False
+        if headers.get("upgrade", "").lower() != "websocket" or "sec-websocket-key" not in headers:
+            self._respond("200 OK", "KataGo daemon, connect with a WebSocket.", daemon)  # e.g. probe_daemon
+            return False
+        self.wfile.write(
+            (
+                "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                f"Sec-WebSocket-Accept: {websocket_accept_key(headers['sec-websocket-key'])}\r\n\r\n"
+            ).encode()
+        )
+        self.wfile.flush()
+        return True
+
+    def _respond(self, status: str, body: str, daemon: "EngineDaemon"):
+        self.wfile.write(
+            (
+                f"HTTP/1.1 {status}\r\n{DAEMON_HEADER}: {daemon.fingerprint}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n{body}"
+            ).encode()
+        )
+        self.wfile.flush()
+
+
+class _DaemonServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = sys.platform != "win32"  # on windows this would allow two daemons on one port
+
+
+class EngineDaemon:
+    """Serves one KataGoEngine to any number of WebSocket clients. Each client's query ids are prefixed with the
+    client name on the way to KataGo and restored on results, and a client's queries are terminated when it
+    disconnects. Queries keep their priority across clients, as they share the engine's query queue."""
+
+    def __init__(self, katrain, fingerprint: str = "", port: int = DEFAULT_DAEMON_PORT, idle_timeout: float = 0):
+        self.katrain = katrain
+        self.fingerprint = fingerprint
+        self.idle_timeout = idle_timeout
+        self.engine = None
+        self.clients = []  # type: List[DaemonClient]
+        self.clients_lock = threading.Lock()
+        self.client_counter = itertools.count(1)
+        self.server = _DaemonServer((DAEMON_HOST, port), _WebSocketHandler)  # bound before loading the engine
+        self.server.engine_daemon = self
+        self.port = self.server.server_address[1]
+        self.last_active = time.time()
+
+    def serve(self, engine):
+        """Serves clients until stopped or idle for too long, then shuts down the engine."""
+        self.engine = engine
+        self.last_active = time.time()
+        threading.Thread(target=self._idle_thread, daemon=True).start()
+        self.katrain.log(f"KataGo daemon listening on {DAEMON_HOST}:{self.port}", OUTPUT_INFO)
+        try:
+            self.server.serve_forever(poll_interval=0.2)
+        finally:
+            self.server.server_close()
+            engine.shutdown(finish=False)
+
+    def stop(self):
+        threading.Thread(target=self.server.shutdown, daemon=True).start()  # blocks until serve_forever returns
+
+    def stop_if_unused(self):
+        if not self.clients and self.engine.is_idle():
+            self.katrain.log("Asked for different engine settings while unused, stopping daemon", OUTPUT_INFO)
+            self.stop()
+
+    def _idle_thread(self):
+        while True:
+            time.sleep(min(1.0, self.idle_timeout or 1.0))
+            if not self.engine.check_alive():
+                self.katrain.log("KataGo process stopped, stopping daemon", OUTPUT_ERROR)
+                break
+            if self.clients or not self.engine.is_idle():
+                self.last_active = time.time()
+            elif self.idle_timeout and time.time() - self.last_active > self.idle_timeout:
+                self.katrain.log(f"Idle for {self.idle_timeout}s, stopping daemon", OUTPUT_INFO)
+                break
+        self.stop()
+
+    def connect(self, wfile) -> DaemonClient:
+        client = DaemonClient(f"C{next(self.client_counter)}", wfile)
+        with self.clients_lock:
+            self.clients.append(client)
+        self.katrain.log(f"Client {client.name} connected ({len(self.clients)} connected)", OUTPUT_INFO)
+        return client
+
+    def disconnect(self, client: DaemonClient):
+        client.closed = True
+        with self.clients_lock:
+            if client in self.clients:
+                self.clients.remove(client)
+        self.engine.terminate_queries(only_for_node=client)
+        client.queries = {}
+        self.last_active = time.time()
+        self.katrain.log(f"Client {client.name} disconnected ({len(self.clients)} connected)", OUTPUT_INFO)
+
+    def handle_message(self, client: DaemonClient, line: str):
+        try:
+            query = json.loads(line)
+        except json.JSONDecodeError as e:
+            client.send({"error": f"Could not parse query: {e}"})
+            return
+        query_id = query.get("id") if isinstance(query, dict) else None
+        if query_id is None:
+            client.send({"error": "Query without id"})
+            return
+        action = query.get("action")
+        if action == "terminate":
+            self.terminate(client, query.get("terminateId"))
+            client.send({"id": query_id, "action": "terminate", "terminateId": query.get("terminateId")})
+        elif action:
+            client.send({"id": query_id, "error": f"Action {action} is not supported by the KataGo daemon"})
+        else:
+            self.analyze(client, query)
+
+    def analyze(self, client: DaemonClient, query: Dict):
+        query_id = query["id"]
+        engine_query = {**query, "id": f"{client.name}:{query_id}"}
+        client.queries[query_id] = [engine_query["id"], len(query.get("analyzeTurns") or [0])]
+
+        def on_result(analysis, partial_result):
+            if not partial_result:
+                running = client.queries.get(query_id)
+                if running and running[0] == engine_query["id"]:
+                    running[1] -= 1
+                    if running[1] <= 0:
+                        del client.queries[query_id]
+            client.send({**analysis, "id": query_id})
+
+        def on_error(analysis):
+            client.queries.pop(query_id, None)
+            client.send({**analysis, "id": query_id})
+
+        # straight onto the queue rather than send_query, as coalescing identical queries from different clients
+        # would answer one with the other's results, and a terminate from either would cancel both
+        self.engine.write_queue.put((engine_query, on_result, on_error, None, client))
+
+    def terminate(self, client: DaemonClient, query_id):
+        running = client.queries.get(query_id)
+        if not running:
+            return
+        engine_id = running[0]
+        if self.engine.write_queue.remove(lambda query, node: query.get("id") == engine_id):
+            client.queries.pop(query_id, None)  # never sent
+        else:  # the final result still comes, as it would from KataGo itself
+            self.engine.terminate_query(engine_id, ignore_further_results=False)
+
+
+def probe_daemon(port: int, fingerprint: str, timeout: float = 1.0) -> Optional[str]:
+    """The fingerprint of the daemon listening on this port, an empty string if some other service is listening, or
+    None if nothing is. Probing with other settings than those of an unused daemon makes it stop."""
+    try:
+        sock = socket.create_connection((DAEMON_HOST, port), timeout=timeout)
+    except OSError:
+        return None
+    with sock:
+        try:
+            sock.sendall(f"GET /{fingerprint} HTTP/1.1\r\nHost: {DAEMON_HOST}:{port}\r\n\r\n".encode())
+            response = sock.makefile("rb")
+            while True:
+                line = response.readline(65537).decode("latin-1").strip()
+                if not line:
+                    return ""
+                key, _, value = line.partition(":")
+                if key.strip().lower() == DAEMON_HEADER.lower():
+                    return value.strip()
+        except OSError:  # e.g. a service that does not speak HTTP
+            return ""
+
+
+def ensure_daemon(katrain, config, timeout: float = DAEMON_START_TIMEOUT) -> Optional[str]:
+    """Returns the url of a daemon running with these engine settings, starting one if needed, or None if none
+    can be used, e.g. when another daemon with a different model is still in use. Can take seconds, so call it from
+    a background thread."""
+    port = int(config.get("daemon_port") or DEFAULT_DAEMON_PORT)
+    fingerprint = engine_fingerprint(config)
+    deadline = time.time() + timeout
+    running = probe_daemon(port, fingerprint)
+    if running == "":
+        katrain.log(f"Port {port} is in use by something other than the KataGo daemon", OUTPUT_ERROR)
+        return None
+    if running not in (None, fingerprint):
+        katrain.log(f"KataGo daemon on port {port} runs with different engine settings, waiting for it", OUTPUT_INFO)
+        while running not in (None, fingerprint) and time.time() < deadline:
+            time.sleep(0.1)
+            running = probe_daemon(port, fingerprint)
+        if running not in (None, fingerprint):
+            katrain.log(f"KataGo daemon on port {port} is still used with different engine settings", OUTPUT_ERROR)
+            return None
+    if running is None:
+        if getattr(sys, "frozen", False):
+            katrain.log("The KataGo daemon can not be started from a packaged build", OUTPUT_ERROR)
+            return None
+        command = [sys.executable, "-m", "katrain.core.engine_daemon", "--port", str(port)]
+        config_file = getattr(katrain, "config_file", None)
+        if config_file:
+            command.insert(3, os.path.abspath(config_file))
+        katrain.log(f"Starting KataGo daemon with {command}", OUTPUT_DEBUG)
+        try:
+            subprocess.Popen(
+                command,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,  # outlives this KaTrain
+                creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0),
+            )
+        except OSError as e:
+            katrain.log(f"Could not start KataGo daemon: {e}", OUTPUT_ERROR)
+            return None
+        while running is None and time.time() < deadline:
+            time.sleep(0.1)
+            running = probe_daemon(port, fingerprint)
+        if running != fingerprint:
+            katrain.log(f"KataGo daemon did not start within {timeout:.0f}s", OUTPUT_ERROR)
+            return None
+    return daemon_url(config)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Keep a KataGo analysis engine running for KaTrain to attach to.")
+    parser.add_argument("config_file", nargs="?", help="KaTrain config.json to take engine settings from")
+    parser.add_argument("--port", type=int, default=None, help=f"Port on {DAEMON_HOST} (default: engine/daemon_port)")
+    parser.add_argument(
+        "--idle-timeout", type=float, default=None, help="Seconds without clients before exiting, 0 for never"
+    )
+    args = parser.parse_args(argv)
+    sys.argv = [sys.argv[0]] + ([args.config_file] if args.config_file else [])  # read by KaTrainBase
+
+    from katrain.core.base_katrain import KaTrainBase  # imports kivy, so only where needed
+    from katrain.core.engine import KataGoEngine
+
+    class DaemonKaTrain(KaTrainBase):
+        def __call__(self, message, *args, **kwargs):  # e.g. the recovery popup, the daemon stops instead
+            self.log(f"Not handling {message} in the KataGo daemon", OUTPUT_DEBUG)
+
+    katrain = DaemonKaTrain()
+    config = katrain.config("engine")
+    if resolve_engine_backend(config) == "remote":
+        katrain.log("The KataGo daemon needs a local engine, not a remote one", OUTPUT_ERROR)
+        return 1
+    port = args.port or int(config.get("daemon_port") or DEFAULT_DAEMON_PORT)
+    idle_timeout = args.idle_timeout
+    if idle_timeout is None:
+        idle_timeout = config.get("daemon_idle_timeout", DEFAULT_IDLE_TIMEOUT)
+    try:
+        daemon = EngineDaemon(katrain, engine_fingerprint(config), port=port, idle_timeout=idle_timeout)
+    except OSError as e:
+        katrain.log(f"Could not listen on port {port}, is a daemon already running? ({e})", OUTPUT_ERROR)
+        return 1
+    engine = KataGoEngine(katrain, {**config, "allow_recovery": False})
+    if not engine.check_alive():
+        daemon.server.server_close()
+        return 1
+    daemon.serve(engine)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+"""Pool of local KataGo analysis processes behind the KataGoEngine interface.
+
+A single process with a fixed number of search threads can leave cores idle while a long backlog of queries
+drains. The pool shards queries over several processes: new positions go to the worker with the fewest outstanding
+visits, while refinement queries for a node (alternatives, regions of interest, sweeps, pondering) follow the node's
+earlier analysis to the same worker, whose neural net cache already holds its evaluations.
+Workers that die are restarted, and their unfinished queries are sent again.
+"""
+
+import itertools
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Set
+
+from katrain.core.constants import OUTPUT_DEBUG, OUTPUT_ERROR
+from katrain.core.engine import BaseEngine, CallbackDispatcher, KataGoEngine
+from katrain.core.game_node import GameNode
+from katrain.core.lang import i18n
+
+
+class PoolWorker(KataGoEngine):
+    """A KataGo process in an EnginePool, which reports errors to the pool instead of opening the recovery popup."""
+
+    def __init__(self, pool: "EnginePool", index: int, katrain, config):
+        self.pool = pool
+        self.index = index
+        super().__init__(katrain, {**config, "analysis_cache_mb": 0})  # the pool checks the cache
+
+    def on_error(self, message, code=None, allow_popup=True):
+        self.katrain.log(f"[worker {self.index}] {message}", OUTPUT_ERROR)
+        self.pool.worker_failed(self.index, message, code)
+
+    def _create_callback_dispatcher(self):
+        return self.pool.callback_dispatcher  # keeps results for a node in order across workers
+
+
+class EnginePool(BaseEngine):
+    """Runs queries on several KataGo processes, with the request_analysis interface of KataGoEngine."""
+
+    ENGINE_TYPE = "local"
+    MAX_RESTARTS = 3  # in a row without results, before giving up on a worker and reporting the error
+    MAX_NODE_AFFINITY = 10_000
+
+    def __init__(self, katrain, config, num_workers: int):
+        super().__init__(katrain, config)
+        self.allow_recovery = self.config.get("allow_recovery", True)
+        self._lock = threading.RLock()
+        self._tokens = itertools.count()
+        self._pending = [{} for _ in range(num_workers)]  # worker -> token -> (visits, node, request arguments)
+        self._node_worker = OrderedDict()  # node -> worker which last analyzed it
+        self._restarts = [0] * num_workers
+        self._restarting = set()
+        self.callback_dispatcher = CallbackDispatcher(self, self.config.get("callback_threads", 1))
+        self.workers = []  # type: List[KataGoEngine]
+        for index in range(num_workers):
+            self.workers.append(self._create_worker(index))
+        self.analysis_cache = self.workers[0].open_analysis_cache(engine_id=self.engine_id())
+
+    def _create_worker(self, index: int) -> KataGoEngine:
+        return PoolWorker(self, index, self.katrain, self.config)
+
+    def engine_id(self) -> str:
+        return str(getattr(self.workers[0], "command", ""))  # same engine id as a single KataGoEngine
+
+    def analysis_settings(self) -> Dict:
+        return self.workers[0].analysis_settings()
+
+    def requested_visits(self, visits: Optional[int] = None, analyze_fast: bool = False) -> int:
+        return self.workers[0].requested_visits(visits, analyze_fast)
+
+    def outstanding_visits(self, index: int) -> int:
+        with self._lock:
+            if index not in self._restarting and self.workers[index].is_idle():  # e.g. terminated queries
+                self._pending[index].clear()
+            return sum(visits for visits, _, _ in self._pending[index].values())
+
+    def worker_load(self, index: int) -> float:
+        """Used to send new queries to the least loaded worker."""
+        return self.outstanding_visits(index)
+
+    def unavailable_workers(self) -> Set[int]:
+        return self._restarting
+
+    def _select_worker(self, node: GameNode, refinement: bool) -> int:
+        with self._lock:
+            index = self._node_worker.get(node)
+            unavailable = self.unavailable_workers()
+            if index is None or not refinement or index in unavailable:
+                available = [i for i in range(len(self.workers)) if i not in unavailable]
+                index = min(available or range(len(self.workers)), key=lambda i: (self.worker_load(i), i))
+            self._node_worker[node] = index
+            self._node_worker.move_to_end(node)
+            if len(self._node_worker) > self.MAX_NODE_AFFINITY:
+                self._node_worker.popitem(last=False)
+            return index
+
+    def request_analysis(
+        self,
+        analysis_node: GameNode,
+        callback: Callable,
+        error_callback: Optional[Callable] = None,
+        visits: int = None,
+        analyze_fast: bool = False,
+        **kwargs,
+    ):
+        refinement = any(kwargs.get(arg) for arg in ["next_move", "find_alternatives", "region_of_interest", "ponder"])
+        index = self._select_worker(analysis_node, refinement)
+        token = next(self._tokens)
+
+        def on_result(analysis, partial_result):
+            if not partial_result:
+                self._finished(index, token)
+            callback(analysis, partial_result)
+
+        def on_error(analysis):
+            self._finished(index, token)
+            if error_callback:
+                error_callback(analysis)
+            elif not (kwargs.get("next_move") and "Illegal move" in analysis["error"]):  # sweep
+                self.katrain.log(f"{analysis} received from KataGo", OUTPUT_ERROR)
+
+        request = dict(
+            analysis_node=analysis_node,
+            callback=on_result,
+            error_callback=on_error,
+            visits=visits,
+            analyze_fast=analyze_fast,
+            **kwargs,
+        )
+        with self._lock:
+            self._pending[index][token] = (self.requested_visits(visits, analyze_fast), analysis_node, request)
+        self.katrain.log(f"Sending query for {analysis_node} to worker {index}", OUTPUT_DEBUG)
+        self.workers[index].request_analysis(**request)
+
+    def _finished(self, index: int, token: int):
+        with self._lock:
+            for pending in self._pending:  # the query may have been moved to another worker
+                pending.pop(token, None)
+            self._restarts[index] = 0
+
+    def worker_failed(self, index: int, message: str, code=None):
+        """Called by a worker on errors, which are assumed fatal. Restarts it in the background."""
+        with self._lock:
+            if index in self._restarting:
+                return
+            self._restarts[index] += 1
+            give_up = self._restarts[index] > self.MAX_RESTARTS or index >= len(self.workers)  # or failed to start
+            if not give_up:
+                self._restarting.add(index)
+        if give_up:
+            self.on_error(message, code)
+        else:  # not in the calling thread, which may be one the restart waits for
+            threading.Thread(target=self._restart_worker, args=(index,), daemon=True).start()
+
+    def _restart_worker(self, index: int):
+        self.katrain.log(f"Restarting KataGo worker {index}", OUTPUT_DEBUG)
+        worker = self.workers[index]
+        worker.restart()
+        with self._lock:
+            self._restarting.discard(index)
+            requests = [request for _, _, request in self._pending[index].values()]
+        for request in requests:
+            worker.request_analysis(**request)
+
+    def on_error(self, message, code=None, allow_popup=True):
+        self.katrain.log(message, OUTPUT_ERROR)
+        if self.allow_recovery and allow_popup:
+            self.katrain("engine_recovery_popup", message, code, self.ENGINE_TYPE)
+
+    def on_new_game(self):
+        with self._lock:
+            for pending in self._pending:
+                pending.clear()
+            self._node_worker.clear()
+        for worker in self.workers:
+            worker.on_new_game()
+
+    def terminate_queries(self, only_for_node=None, lock=True):
+        with self._lock:
+            for pending in self._pending:
+                for token, (_, node, _) in list(pending.items()):
+                    if only_for_node is None or only_for_node is node:
+                        del pending[token]
+        for worker in self.workers:
+            worker.terminate_queries(only_for_node=only_for_node, lock=lock)
+
+    def reprioritize_queries(self, priority_fn: Callable):
+        for worker in self.workers:
+            worker.reprioritize_queries(priority_fn)
+
+    def stop_pondering(self):
+        for worker in self.workers:
+            worker.stop_pondering()
+
+    def restart(self):
+        with self._lock:
+            for pending in self._pending:
+                pending.clear()
+            self._restarts = [0] * len(self.workers)
+        for worker in self.workers:
+            worker.restart()
+
+    def check_alive(self, os_error="", exception_if_dead=False, maybe_open_recovery=False):
+        """Alive while any worker is, since dead ones are restarted."""
+        ok = any(worker.check_alive() for worker in self.workers) or bool(self._restarting)
+        if not ok and exception_if_dead:
+            self.on_error(i18n._("Engine died unexpectedly").format(error=os_error), allow_popup=maybe_open_recovery)
+        return ok
+
+    def wait_to_finish(self):
+        for worker in self.workers:
+            worker.wait_to_finish()
+
+    def shutdown(self, finish=False):
+        for worker in self.workers:
+            worker.shutdown(finish=finish)
+
+    def is_idle(self):
+        return all(worker.is_idle() for worker in self.workers)
+
+    def has_pending_queries(self) -> bool:
+        return any(worker.has_pending_queries() for worker in self.workers)
+
+    def queries_remaining(self):
+        return sum(worker.queries_remaining() for worker in self.workers)
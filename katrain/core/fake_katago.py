@@ -0,0 +1,244 @@
+"""Deterministic stand-in for the KataGo analysis engine, for tests and benchmarks without KataGo or a GPU.
+
+Speaks the analysis JSON protocol on stdin/stdout: multi-turn queries (`analyzeTurns`), partial results
+(`reportDuringSearchEvery`), `terminate`, query priorities, `maxVisits` and `overrideSettings.maxTime`, with ownership,
+moves ownership and policy arrays of the real sizes. Searches take `--latency` seconds plus `maxVisits` divided by
+`--visits-per-second`, on `--threads` positions at a time. Results depend only on the position and settings, not on
+timing or query ids. Go rules are not implemented, candidate moves are just empty points.
+
+Use it through the custom engine backend, e.g. `engine/altcommand` set to `fake_katago_command()`.
+Only the standard library is used, so it starts quickly.
+"""
+
+import argparse
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import random
+import shlex
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+GTP_COLUMNS = "ABCDEFGHJKLMNOPQRSTUVWXYZ"
+NUM_CANDIDATE_MOVES = 10
+PV_LENGTH = 8
+
+
+def fake_katago_command(
+    visits_per_second: float = 0,
+    latency: float = 0.0,
+    threads: int = 2,
+    log: Optional[str] = None,
+) -> str:
+    """A shell command running the fake engine, for `engine/altcommand`. Zero visits per second means instant."""
+    args = [
+        sys.executable,
+        os.path.abspath(__file__),
+        "--visits-per-second",
+        str(visits_per_second),
+        "--latency",
+        str(latency),
+        "--threads",
+        str(threads),
+    ]
+    if log:
+        args += ["--log", str(log)]
+    command = " ".join(shlex.quote(arg) for arg in args)
+    return command if sys.platform == "win32" else f"exec {command}"  # so terminating the shell stops it
+
+
+class FakeKataGo:
+    def __init__(self, visits_per_second: float = 0, latency: float = 0.0, threads: int = 2, log=None, out=None):
+        self.visits_per_second = visits_per_second
+        self.latency = latency
+        self.num_threads = threads
+        self.log = log
+        self.out = out or sys.stdout
+        self.out_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.jobs = []  # heap of (-priority, order, query, turn)
+        self.order = itertools.count()
+        self.terminated = set()  # query ids
+        self.closed = False
+
+    def send(self, message: Dict):
+        line = json.dumps(message)
+        with self.out_lock:
+            self.out.write(line + "\n")
+            self.out.flush()
+
+    def run(self, lines):
+        workers = [threading.Thread(target=self._search_thread, daemon=True) for _ in range(self.num_threads)]
+        for worker in workers:
+            worker.start()
+        print("Started, ready to begin handling requests", file=sys.stderr, flush=True)
+        for line in lines:
+            if line.strip():
+                self.handle(line)
+        with self.condition:
+            self.closed = True  # finish what was queued, as KataGo does on end of input
+            self.condition.notify_all()
+        for worker in workers:
+            worker.join()
+
+    def handle(self, line: str):
+        try:
+            query = json.loads(line)
+        except json.JSONDecodeError as e:
+            self.send({"error": f"Could not parse input line as json request: {e}"})
+            return
+        if self.log:
+            self.log.write(line.strip() + "\n")
+            self.log.flush()
+        query_id = query.get("id")
+        if query_id is None:
+            self.send({"error": "Request field 'id' is missing", "field": "id"})
+            return
+        action = query.get("action")
+        if action == "terminate":
+            self.terminate(query)
+        elif action == "query_version":
+            self.send({"id": query_id, "action": action, "version": "fake", "git_hash": "fake"})
+        elif action:
+            self.send({"id": query_id, "error": f"Unknown action {action}"})
+        else:
+            for field in ["moves", "rules", "boardXSize", "boardYSize"]:
+                if field not in query:
+                    self.send({"id": query_id, "error": f"Request field '{field}' is missing", "field": field})
+                    return
+            turns = query.get("analyzeTurns") or [len(query["moves"])]
+            with self.condition:
+                self.terminated.discard(query_id)
+                for turn in turns:
+                    heapq.heappush(self.jobs, (-query.get("priority", 0), next(self.order), query, turn))
+                self.condition.notify()
+
+    def terminate(self, query: Dict):
+        terminate_id = query.get("terminateId")
+        with self.condition:
+            self.terminated.add(terminate_id)
+            cancelled = [job for job in self.jobs if job[2]["id"] == terminate_id]
+            self.jobs = [job for job in self.jobs if job[2]["id"] != terminate_id]
+            heapq.heapify(self.jobs)
+        for *_, turn in cancelled:  # never started
+            self.send({"id": terminate_id, "isDuringSearch": False, "turnNumber": turn, "noResults": True})
+        self.send({"id": query["id"], "action": "terminate", "terminateId": terminate_id})
+
+    def _search_thread(self):
+        while True:
+            with self.condition:
+                while not self.jobs and not self.closed:
+                    self.condition.wait()
+                if not self.jobs:
+                    return
+                _, _, query, turn = heapq.heappop(self.jobs)
+            self.search(query, turn)
+
+    def search(self, query: Dict, turn: int):
+        max_visits = max(1, int(query.get("maxVisits") or 1))
+        max_time = (query.get("overrideSettings") or {}).get("maxTime") or 0
+        report_every = query.get("reportDuringSearchEvery") or 0
+        search_time = self.latency + (max_visits / self.visits_per_second if self.visits_per_second else 0)
+        if max_time:
+            search_time = min(search_time, max_time)
+        start = time.time()
+        next_report = start + report_every if report_every else None
+        while True:
+            now = time.time()
+            if query["id"] in self.terminated or now >= start + search_time:
+                break
+            if next_report and now >= next_report:
+                self.send(self.result(query, turn, self.visits_after(now - start, max_visits), during_search=True))
+                next_report += report_every
+            time.sleep(max(0.0, min(0.01, start + search_time - now)))
+        self.send(self.result(query, turn, self.visits_after(time.time() - start, max_visits)))
+
+    def visits_after(self, elapsed: float, max_visits: int) -> int:
+        if not self.visits_per_second:
+            return max_visits
+        return max(1, min(max_visits, int((elapsed - self.latency) * self.visits_per_second)))
+
+    @staticmethod
+    def result(query: Dict, turn: int, visits: int, during_search=False) -> Dict:
+        size_x, size_y = query["boardXSize"], query["boardYSize"]
+        moves = query["moves"][:turn]
+        position = json.dumps([query.get("initialStones", []), moves, size_x, size_y, query.get("komi")])
+        seed = hashlib.sha1(position.encode()).digest()
+        rng = random.Random(seed)  # same position, same results
+        payload_rng = random.Random(seed + b"payload")  # separate, so results do not depend on the arrays requested
+        occupied = {gtp for _, gtp in query.get("initialStones", []) + moves}
+        points = [f"{GTP_COLUMNS[x]}{y + 1}" for x in range(size_x) for y in range(size_y)]
+        empty = [point for point in points if point not in occupied]
+        candidates = rng.sample(empty, min(NUM_CANDIDATE_MOVES, len(empty))) or ["pass"]
+        current_player = ("W" if moves[-1][0] == "B" else "B") if moves else query.get("initialPlayer", "B")
+        winrate, score = rng.random(), rng.gauss(0, 10)
+        include_moves_ownership = query.get("includeMovesOwnership")
+        visits_left = visits
+        move_infos = []
+        for order, move in enumerate(candidates):
+            move_visits = visits_left // 2 if order < len(candidates) - 1 else visits_left
+            visits_left -= move_visits
+            move_winrate = max(0.0, min(1.0, winrate - 0.02 * order * rng.random()))
+            move_score = score - order * rng.random()
+            move_info = {
+                "move": move,
+                "order": order,
+                "visits": move_visits,
+                "winrate": move_winrate,
+                "scoreLead": move_score,
+                "scoreMean": move_score,
+                "scoreSelfplay": move_score,
+                "scoreStdev": 10 + rng.random(),
+                "utility": move_winrate - 0.5,
+                "lcb": move_winrate - 0.01,
+                "prior": rng.random() / (order + 1),
+                "pv": [move] + rng.sample(empty, min(PV_LENGTH - 1, len(empty))),
+            }
+            if include_moves_ownership:
+                move_info["ownership"] = [round(payload_rng.uniform(-1, 1), 6) for _ in range(size_x * size_y)]
+            move_infos.append(move_info)
+        result = {
+            "id": query["id"],
+            "isDuringSearch": during_search,
+            "turnNumber": turn,
+            "moveInfos": move_infos,
+            "rootInfo": {
+                "visits": visits,
+                "winrate": winrate,
+                "scoreLead": score,
+                "scoreSelfplay": score,
+                "utility": winrate - 0.5,
+                "currentPlayer": current_player,
+            },
+        }
+        if query.get("includeOwnership"):
+            result["ownership"] = [round(payload_rng.uniform(-1, 1), 6) for _ in range(size_x * size_y)]
+        if query.get("includePolicy"):
+            policy = [payload_rng.random() for _ in range(size_x * size_y + 1)]
+            total = sum(policy)
+            result["policy"] = [round(p / total, 8) for p in policy]
+        return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Deterministic stand-in for the KataGo analysis engine.")
+    parser.add_argument("--visits-per-second", type=float, default=0, help="Search speed, 0 for instant results")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every search")
+    parser.add_argument("--threads", type=int, default=2, help="Number of positions searched at a time")
+    parser.add_argument("--log", help="File to append the queries received to")
+    args = parser.parse_args(argv)
+    log = open(args.log, "a", encoding="utf-8") if args.log else None
+    try:
+        FakeKataGo(args.visits_per_second, args.latency, max(1, args.threads), log=log).run(sys.stdin)
+    finally:
+        if log:
+            log.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,12 +3,15 @@ import math
 import os
 import re
 import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
-from typing import Dict, List, Optional, Union
+from typing import Dict, List, Optional, Set, Union
 
 from kivy.clock import Clock
 
 from katrain.core.constants import (
+    DATA_FOLDER,
     OUTPUT_DEBUG,
     OUTPUT_EXTRA_DEBUG,
     OUTPUT_INFO,
@@ -27,6 +30,7 @@ from katrain.core.constants import (
     PRIORITY_EQUALIZE,
     PRIORITY_DEFAULT,
 )
+from katrain.core.board_state import BoardState, IllegalMoveException
 from katrain.core.engine import KataGoEngine
 from katrain.core.game_node import GameNode
 from katrain.core.lang import i18n, rank_label
@@ -34,14 +38,56 @@ from katrain.core.sgf_parser import SGF, Move
 from katrain.core.utils import var_to_grid, weighted_selection_without_replacement
 
 
-class IllegalMoveException(Exception):
-    pass
-
-
 class KaTrainSGF(SGF):
     _NODE_CLASS = GameNode
 
 
+class BoardSnapshotCache:
+    """Bounded cache of board states after a node, so navigating only replays the nodes since the closest cached
+    ancestor. The moves in the nodes in between serve as the diffs between snapshots.
+    Keyframes, taken every SNAPSHOT_INTERVAL nodes along a branch, bound the replay after a jump anywhere in the tree.
+    Other snapshots, such as those for nodes navigated to, are evicted first, both in least recently used order."""
+
+    SNAPSHOT_INTERVAL = 16
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.position_version = None  # of the tree when the snapshots were made
+        self._keyframes = OrderedDict()  # node -> (snapshot, size in bytes)
+        self._snapshots = OrderedDict()
+
+    def __len__(self):
+        return len(self._keyframes) + len(self._snapshots)
+
+    def get(self, node):
+        for snapshots in [self._snapshots, self._keyframes]:
+            entry = snapshots.get(node)
+            if entry is not None:
+                snapshots.move_to_end(node)
+                return entry[0]
+        return None
+
+    def put(self, node, snapshot, num_bytes: int, keyframe=False):
+        if keyframe and node in self._snapshots:
+            self._keyframes[node] = self._snapshots.pop(node)
+        if node in self._keyframes or node in self._snapshots:
+            return
+        (self._keyframes if keyframe else self._snapshots)[node] = (snapshot, num_bytes)
+        self.num_bytes += num_bytes
+        while self.num_bytes > self.max_bytes and len(self):
+            _, (_, evicted_bytes) = (self._snapshots or self._keyframes).popitem(last=False)
+            self.num_bytes -= evicted_bytes
+
+    def validate(self, position_version):
+        """Drops all snapshots if moves or placements in the tree changed since they were made."""
+        if position_version != self.position_version:
+            self._keyframes.clear()
+            self._snapshots.clear()
+            self.num_bytes = 0
+            self.position_version = position_version
+
+
 class BaseGame:
     """Represents a game of go, including an implementation of capture rules."""
 
@@ -57,6 +103,9 @@ class BaseGame:
     ):
         self.katrain = katrain
         self._lock = threading.Lock()
+        self._board_cache = BoardSnapshotCache(
+            max_bytes=int(katrain.config("general/board_cache_mb", 32) * 1024 * 1024)
+        )
         self.game_id = datetime.strftime(datetime.now(), "%Y-%m-%d %H %M %S")
         self.sgf_filename = sgf_filename
 
@@ -69,8 +118,8 @@ class BaseGame:
             handicap = int(self.root.handicap)
             num_starting_moves_black = 0
             node = self.root
-            while node.children:
-                node = node.children[0]
+            while node.main_child:  # rather than children, which parses variations left unparsed by a lazy load
+                node = node.main_child
                 if node.player == "B":
                     num_starting_moves_black += 1
                 else:
@@ -80,7 +129,7 @@ class BaseGame:
                 handicap >= 2
                 and not self.root.placements
                 and not (num_starting_moves_black == handicap)
-                and not (self.root.children and self.root.children[0].placements)
+                and not (self.root.main_child and self.root.main_child.placements)
             ):  # not really according to sgf, and not sure if still needed, last clause for fox
                 self.root.place_handicap_stones(handicap)
         else:
@@ -109,6 +158,9 @@ class BaseGame:
         self.set_current_node(self.root)
         self.main_time_used = 0
 
+        if move_tree:
+            self.root.compute_position_hashes()
+
         # restore shortcuts
         shortcut_id_to_node = {node.get_property("KTSID", None): node for node in self.root.nodes_in_tree}
         for node in self.root.nodes_in_tree:
@@ -118,106 +170,82 @@ class BaseGame:
 
     # -- move tree functions --
     def _init_state(self):
-        board_size_x, board_size_y = self.board_size
-        self.board = [
-            [-1 for _x in range(board_size_x)] for _y in range(board_size_y)
-        ]  # type: List[List[int]]  #  board pos -> chain id
-        self.chains = []  # type: List[List[Move]]  #   chain id -> chain
-        self.prisoners = []  # type: List[Move]
-        self.last_capture = []  # type: List[Move]
+        self.board_state = BoardState(self.board_size)
+
+    @property
+    def board(self) -> List[List[int]]:
+        """Board position -> chain id, or -1 if empty. Read only view."""
+        return self.board_state.chain_view()[0]
+
+    @property
+    def chains(self) -> List[List[Move]]:
+        """Chain id -> stones in the chain. Read only view."""
+        return self.board_state.chain_view()[1]
+
+    @property
+    def prisoners(self) -> List[Move]:
+        return self.board_state.prisoners
+
+    @property
+    def last_capture(self) -> List[Move]:
+        return self.board_state.last_capture
+
+    def _snapshot_state(self):
+        """Returns a copy of the board state and its approximate size in bytes."""
+        return self.board_state.copy(), self.board_state.num_bytes
+
+    def _restore_state(self, snapshot):
+        self.board_state = snapshot.copy()
 
     def _calculate_groups(self):
         with self._lock:
-            self._init_state()
+            cache = self._board_cache
+            cache.validate(self.root.tree_index.position_version)
+            nodes = self.current_node.nodes_from_root
+            start = 0
+            for i in range(len(nodes) - 1, -1, -1):  # closest ancestor with a snapshot
+                snapshot = cache.get(nodes[i])
+                if snapshot is not None:
+                    self._restore_state(snapshot)
+                    start = i + 1
+                    break
+            else:
+                self._init_state()
+            rules_hash = BoardState.rules_hash(self.rules)
             try:
-                for node in self.current_node.nodes_from_root:
+                for i in range(start, len(nodes)):
+                    node = nodes[i]
                     for m in node.move_with_placements:
                         self._validate_move_and_update_chains(
                             m, True
                         )  # ignore ko since we didn't know if it was forced
                     if node.clear_placements:  # handle AE by playing all moves left from empty board
                         clear_coords = {c.coords for c in node.clear_placements}
-                        stones = [m for c in self.chains for m in c if m.coords not in clear_coords]
+                        stones = [m for m in self.board_state.stones() if m.coords not in clear_coords]
                         self._init_state()
                         for m in stones:
                             self._validate_move_and_update_chains(m, True)
+                    node.set_position_hashes(self.board_state, rules_hash)
+                    if i % cache.SNAPSHOT_INTERVAL == 0:
+                        cache.put(node, *self._snapshot_state(), keyframe=True)
+                    elif i == len(nodes) - 1:
+                        cache.put(node, *self._snapshot_state())
             except IllegalMoveException as e:
                 raise Exception(f"Unexpected illegal move ({str(e)})")
 
     def _validate_move_and_update_chains(self, move: Move, ignore_ko: bool):
-        board_size_x, board_size_y = self.board_size
-
-        def neighbours(moves):
-            return {
-                self.board[m.coords[1] + dy][m.coords[0] + dx]
-                for m in moves
-                for dy, dx in [(-1, 0), (1, 0), (0, -1), (0, 1)]
-                if 0 <= m.coords[0] + dx < board_size_x and 0 <= m.coords[1] + dy < board_size_y
-            }
-
-        ko_or_snapback = len(self.last_capture) == 1 and self.last_capture[0] == move
-        self.last_capture = []
-
-        if move.is_pass:
-            return
-
-        if self.board[move.coords[1]][move.coords[0]] != -1:
-            raise IllegalMoveException("Space occupied")
-
-        # merge chains connected by this move, or create a new one
-        nb_chains = list({c for c in neighbours([move]) if c >= 0 and self.chains[c][0].player == move.player})
-        if nb_chains:
-            this_chain = nb_chains[0]
-            self.board = [[nb_chains[0] if sq in nb_chains else sq for sq in line] for line in self.board]
-            for oc in nb_chains[1:]:
-                self.chains[nb_chains[0]] += self.chains[oc]
-                self.chains[oc] = []
-            self.chains[nb_chains[0]].append(move)
-        else:
-            this_chain = len(self.chains)
-            self.chains.append([move])
-        self.board[move.coords[1]][move.coords[0]] = this_chain
-
-        # check captures
-        opp_nb_chains = {c for c in neighbours([move]) if c >= 0 and self.chains[c][0].player != move.player}
-        for c in opp_nb_chains:
-            if -1 not in neighbours(self.chains[c]):  # no liberties
-                self.last_capture += self.chains[c]
-                for om in self.chains[c]:
-                    self.board[om.coords[1]][om.coords[0]] = -1
-                self.chains[c] = []
-        if ko_or_snapback and len(self.last_capture) == 1 and not ignore_ko:
-            raise IllegalMoveException("Ko")
-        self.prisoners += self.last_capture
-
-        # suicide: check rules and throw exception if needed
-        if -1 not in neighbours(self.chains[this_chain]):
-            rules = self.rules
-            if len(self.chains[this_chain]) == 1:  # even in new zealand rules, single stone suicide is not allowed
-                raise IllegalMoveException("Single stone suicide")
-            elif (isinstance(rules, str) and rules in ["tromp-taylor", "new zealand"]) or (
-                isinstance(rules, dict) and rules.get("suicide", False)
-            ):
-                self.last_capture += self.chains[this_chain]
-                for om in self.chains[this_chain]:
-                    self.board[om.coords[1]][om.coords[0]] = -1
-                self.chains[this_chain] = []
-                self.prisoners += self.last_capture
-            else:  # suicide not allowed by rules
-                raise IllegalMoveException("Suicide")
+        suicide_allowed = BoardState.suicide_allowed(self.rules)
+        self.board_state.play(move, ignore_ko=ignore_ko, suicide_allowed=suicide_allowed)
 
     # Play a Move from the current position, raise IllegalMoveException if invalid.
     def play(self, move: Move, ignore_ko: bool = False):
         board_size_x, board_size_y = self.board_size
         if not move.is_pass and not (0 <= move.coords[0] < board_size_x and 0 <= move.coords[1] < board_size_y):
             raise IllegalMoveException(f"Move {move} outside of board coordinates")
-        try:
-            self._validate_move_and_update_chains(move, ignore_ko)
-        except IllegalMoveException:
-            self._calculate_groups()
-            raise
+        self._validate_move_and_update_chains(move, ignore_ko)  # leaves the position unchanged if illegal
         with self._lock:
             played_node = self.current_node.play(move)
+            played_node.set_position_hashes(self.board_state, BoardState.rules_hash(self.rules))
             self.current_node = played_node
         return played_node
 
@@ -301,7 +329,7 @@ class BaseGame:
     @property
     def stones(self):
         with self._lock:
-            return sum(self.chains, [])
+            return self.board_state.stones()
 
     @property
     def end_result(self):
@@ -406,6 +434,17 @@ class BaseGame:
         return f"{base_game_name} {self.game_id}.sgf"
 
     def write_sgf(self, filename: str, trainer_config: Optional[Dict] = None):
+        self._write_sgf_file(filename, trainer_config)
+        self.sgf_filename = filename
+        return i18n._("sgf written").format(file_name=filename)
+
+    def autosave(self, trainer_config: Optional[Dict] = None) -> str:
+        """Saves the game to the autosave folder. Only nodes changed since the previous autosave are serialized again."""
+        filename = os.path.join(os.path.expanduser(DATA_FOLDER), "autosave", self.generate_filename())
+        self._write_sgf_file(filename, trainer_config, incremental=True)
+        return filename
+
+    def _write_sgf_file(self, filename: str, trainer_config: Optional[Dict] = None, incremental=False):
         if trainer_config is None:
             trainer_config = self.katrain.config("trainer", {})
         save_feedback = trainer_config.get("save_feedback", False)
@@ -416,23 +455,33 @@ class BaseGame:
         show_dots_for = {
             bw: trainer_config.get("eval_show_ai", True) or self.katrain.players_info[bw].human for bw in "BW"
         }
-        sgf = self.root.sgf(
-            save_comments_player=show_dots_for,
-            save_comments_class=save_feedback,
-            eval_thresholds=eval_thresholds,
-            save_analysis=save_analysis,
-            save_marks=save_marks,
-        )
-        self.sgf_filename = filename
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        with open(filename, "w", encoding="utf-8") as f:
-            f.write(sgf)
-        return i18n._("sgf written").format(file_name=filename)
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp_filename = f"{filename}.tmp"  # write next to the target and swap in, so a failed save never truncates it
+        try:
+            with open(tmp_filename, "w", encoding="utf-8") as f:
+                self.root.write_sgf(
+                    f,
+                    incremental=incremental,
+                    save_comments_player=show_dots_for,
+                    save_comments_class=save_feedback,
+                    eval_thresholds=eval_thresholds,
+                    save_analysis=save_analysis,
+                    save_marks=save_marks,
+                )
+            os.replace(tmp_filename, filename)
+        finally:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
 
 
 class Game(BaseGame):
     """Extensions related to analysis etc."""
 
+    NEAR_CURRENT_NODE = 10  # moves either way on the current branch, which are analyzed first
+    OTHER_BRANCHES = 100_000  # priority offset for side variations
+    PRIORITIZE_INTERVAL = 0.25  # seconds, when navigating faster queries are re-prioritized once it stops
+
     def __init__(
         self,
         katrain,
@@ -442,6 +491,9 @@ class Game(BaseGame):
         game_properties: Optional[Dict] = None,
         sgf_filename=None,
     ):
+        self._prioritize_lock = threading.Lock()
+        self._prioritize_timer = None
+        self._last_prioritized = 0.0
         super().__init__(
             katrain=katrain, move_tree=move_tree, game_properties=game_properties, sgf_filename=sgf_filename
         )
@@ -459,17 +511,150 @@ class Game(BaseGame):
         ).start()  # return faster, but bypass Kivy Clock
 
     def analyze_all_nodes(self, priority=PRIORITY_GAME_ANALYSIS, analyze_fast=False, even_if_present=True):
+        nodes = []
         for node in self.root.nodes_in_tree:
             # forced, or not present, or something went wrong in loading
             if even_if_present or not node.analysis_from_sgf or not node.load_analysis():
                 node.clear_analysis()
+                nodes.append(node)
+        if self.engines["B"] is self.engines["W"]:
+            self.analyze_branches(nodes, self.engines["B"], priority=priority, analyze_fast=analyze_fast)
+        else:
+            for node in nodes:
                 node.analyze(self.engines[node.next_player], priority=priority, analyze_fast=analyze_fast)
+        self._reprioritize_queries()
+
+    def analyze_branches(self, nodes, engine, **kwargs):
+        """Analyzes nodes with a query per branch of the game tree, rather than one per node, which sends the moves of
+        a branch once instead of once for every position in it. The current branch is split into runs around the
+        current node, see runs_around. Takes the arguments of GameNode.analyze_branch."""
+        selected = set(nodes)
+        current_branch = self._current_branch()
+        depth = self.current_node.depth
+        branch = []
+        for node in self.root.nodes_in_preorder:  # nodes since the previous leaf are the path down to the next one
+            if node in selected:
+                branch.append(node)
+            if not node.children and branch:
+                for run in self.runs_around(branch, depth) if branch[-1] in current_branch else [branch]:
+                    GameNode.analyze_branch(engine, run, **kwargs)
+                branch = []
+
+    @classmethod
+    def runs_around(cls, nodes: List[GameNode], depth: int) -> List[List[GameNode]]:
+        """Splits nodes on a branch, in order, into a run within NEAR_CURRENT_NODE moves of depth, and runs doubling in
+        length either way from there. Each run is a query, so the turns near depth are not queued behind the others,
+        while the moves of the branch are still sent only a logarithmic number of times."""
+        runs = {}
+        for node in nodes:
+            distance = node.depth - depth
+            doublings = 0
+            while abs(distance) > cls.NEAR_CURRENT_NODE << doublings:
+                doublings += 1
+            runs.setdefault((doublings, doublings > 0 and distance > 0), []).append(node)
+        return [runs[key] for key in sorted(runs)]
+
+    def _current_branch(self) -> Set[GameNode]:
+        """Nodes from the root to the current node, and on along the main continuation."""
+        current_branch = set(self.current_node.nodes_from_root)
+        node = self.current_node
+        while node.main_child:
+            node = node.main_child
+            current_branch.add(node)
+        return current_branch
 
     def set_current_node(self, node):
         if self.insert_mode:
             self.katrain.controls.set_status(i18n._("finish inserting before navigating"), STATUS_ERROR)
             return
         super().set_current_node(node)
+        self.prioritize_analysis()
+
+    def prioritize_analysis(self):
+        """Re-prioritizes background analysis, for positions close to the current node on its branch first, then the
+        rest of that branch and the main line, then side variations. Queries for refining analysis and such have a
+        higher priority, and are left alone. Does nothing once all queries have their results, and at most once per
+        PRIORITIZE_INTERVAL, with a last time after that when called more often, e.g. while holding an arrow key."""
+        engines = getattr(self, "engines", None)  # not set yet while BaseGame initializes
+        if not engines or not any(
+            engine.has_pending_queries() for engine in engines.values() if hasattr(engine, "has_pending_queries")
+        ):
+            return
+        with self._prioritize_lock:
+            if self._prioritize_timer is not None:
+                return  # will run shortly
+            wait = self._last_prioritized + self.PRIORITIZE_INTERVAL - time.time()
+            if wait > 0:
+                self._prioritize_timer = threading.Timer(wait, self._prioritize_later)
+                self._prioritize_timer.daemon = True
+                self._prioritize_timer.start()
+                return
+            self._last_prioritized = time.time()
+        self._reprioritize_queries()
+
+    def _prioritize_later(self):
+        with self._prioritize_lock:
+            self._prioritize_timer = None
+            self._last_prioritized = time.time()
+        self._reprioritize_queries()
+
+    def _reprioritize_queries(self):
+        engines = getattr(self, "engines", None)
+        if not engines:
+            return
+        cn = self.current_node
+        current_branch = self._current_branch()
+        main_line = set()
+        node = self.root
+        while node is not None:
+            main_line.add(node)
+            node = node.main_child
+
+        def priority(query_priority, query, node):
+            if query_priority > PRIORITY_GAME_ANALYSIS or node is None:
+                return None
+            turns = query.get("analyzeTurns") or [0]
+            distance = max(node.depth - (turns[-1] - turns[0]) - cn.depth, cn.depth - node.depth, 0)
+            if node in current_branch and distance <= self.NEAR_CURRENT_NODE:
+                return PRIORITY_GAME_ANALYSIS - distance
+            if node in current_branch or node in main_line:
+                return PRIORITY_GAME_ANALYSIS - self.NEAR_CURRENT_NODE - 1 - distance
+            return PRIORITY_GAME_ANALYSIS - self.OTHER_BRANCHES - node.depth
+
+        for engine in set(engines.values()):
+            if hasattr(engine, "reprioritize_queries"):
+                engine.reprioritize_queries(priority)
+        if engines["B"] is engines["W"] and hasattr(engines["B"], "terminate_queries_where"):
+            self._split_queries_around(engines["B"], cn, current_branch)
+
+    def _split_queries_around(self, engine, cn: GameNode, current_branch: Set[GameNode]):
+        """Queries for runs of the current branch are analyzed from their first turn on, so once more than
+        NEAR_CURRENT_NODE positions without analysis precede those near the current node, the query is terminated and
+        its remaining turns are queried again in runs around the current node. Looks them up off the calling thread."""
+        near_start = cn.depth - self.NEAR_CURRENT_NODE
+        base_priority = getattr(engine, "base_priority", 0)
+
+        def waits_for_far_turns(query, node):
+            turns = query.get("analyzeTurns") or []
+            background = query.get("priority", 0) - base_priority <= PRIORITY_GAME_ANALYSIS
+            if not background or node not in current_branch or len(turns) < 2 or not turns[0] < near_start <= turns[-1]:
+                return False
+            far_turns = {turn for turn in turns if turn < near_start}
+            waiting = [n for n in node.nodes_from_root if n.depth in far_turns and not n.analysis_complete]
+            return len(waiting) > self.NEAR_CURRENT_NODE
+
+        def split():
+            num_split = 0
+            for query, node in engine.terminate_queries_where(waits_for_far_turns):
+                turns = set(query["analyzeTurns"])
+                remaining = [n for n in node.nodes_from_root if n.depth in turns and not n.analysis_complete]
+                for run in self.runs_around(remaining, cn.depth):
+                    GameNode.analyze_branch(engine, run, priority=PRIORITY_GAME_ANALYSIS, visits=query.get("maxVisits"))
+                num_split += 1
+            if num_split:
+                self._reprioritize_queries()  # for the new queries
+
+        threading.Thread(target=split, daemon=True).start()
 
     def undo(self, n_times=1, stop_on_mistake=None):
         if self.insert_mode:  # in insert mode, undo = delete
@@ -611,13 +796,17 @@ class Game(BaseGame):
             else:
                 min_visits = min(node.analysis_visits_requested for node in nodes)
                 visits = min_visits + engine.config["max_visits"]
+            selected = []
             for node in nodes:
                 max_point_loss = max(c.points_lost or 0 for c in [node] + node.children)
                 if only_mistakes and max_point_loss <= threshold:
                     continue
                 if move_range and (not node.depth - 1 in range(move_range[0], move_range[1] + 1)):
                     continue
-                node.analyze(engine, visits=visits, priority=-1_000_000, time_limit=False, report_every=None)
+                selected.append(node)
+            self.analyze_branches(
+                selected, engine, visits=visits, priority=-1_000_000, time_limit=False, report_every=None
+            )
             if not move_range:
                 self.katrain.controls.set_status(i18n._("game re-analysis").format(visits=visits), STATUS_ANALYSIS)
             else:
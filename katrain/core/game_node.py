@@ -3,8 +3,11 @@ import copy
 import gzip
 import json
 import random
+from types import MappingProxyType
 from typing import Dict, List, Optional, Tuple
 
+from katrain.core.analysis_cache import AnalysisCache
+from katrain.core.board_state import BoardState, IllegalMoveException
 from katrain.core.constants import (
     ANALYSIS_FORMAT_VERSION,
     PROGRAM_NAME,
@@ -17,9 +20,13 @@ from katrain.core.constants import (
 )
 from katrain.core.lang import i18n
 from katrain.core.sgf_parser import Move, SGFNode
-from katrain.core.utils import evaluation_class, pack_floats, unpack_floats, var_to_grid
+from katrain.core.utils import compact_floats, evaluation_class, pack_floats, unpack_floats
 from katrain.gui.theme import Theme
 
+EMPTY_ANALYSIS = MappingProxyType(
+    {"moves": MappingProxyType({}), "root": None, "ownership": None, "policy": None, "completed": False}
+)  # read-only, shared by all nodes without analysis
+
 
 def analysis_dumps(analysis):
     analysis = copy.deepcopy(analysis)
@@ -35,22 +42,62 @@ def analysis_dumps(analysis):
     ]
 
 
+class SparseAttribute:
+    """Node attribute that is rarely set, stored in the node's `_sparse` dict instead of a slot of its own."""
+
+    def __init__(self, default=None):
+        self.default = default
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, node, owner=None):
+        if node is None:
+            return self
+        if node._sparse is None:
+            return self.default
+        return node._sparse.get(self.name, self.default)
+
+    def __set__(self, node, value):
+        if node._sparse is None:
+            if value is self.default:
+                return
+            node._sparse = {}
+        node._sparse[self.name] = value
+
+
 class GameNode(SGFNode):
     """Represents a single game node, with one or more moves and placements."""
 
+    __slots__ = (
+        "auto_undo",
+        "note",
+        "_undo_threshold",
+        "_position_hashes",
+        "_sparse",
+        "_analysis_version",
+        "analysis_visits_requested",
+        "analysis",
+    )
+
+    played_mistake_sound = SparseAttribute(None)
+    ai_thoughts = SparseAttribute("")
+    time_used = SparseAttribute(0)
+    end_state = SparseAttribute(None)
+    shortcuts_to = SparseAttribute(())
+    shortcut_from = SparseAttribute(None)
+    analysis_from_sgf = SparseAttribute(None)
+
     def __init__(self, parent=None, properties=None, move=None):
+        self._sparse = None
+        self._position_hashes = None  # position hash, canonical hash and its symmetry
         super().__init__(parent=parent, properties=properties, move=move)
         self.auto_undo = None  # None = not analyzed. False: not undone (good move). True: undone (bad move)
-        self.played_mistake_sound = None
-        self.ai_thoughts = ""
         self.note = ""
-        self.move_number = 0
-        self.time_used = 0
-        self.undo_threshold = random.random()  # for fractional undos
-        self.end_state = None
-        self.shortcuts_to = []
-        self.shortcut_from = None
+        self._undo_threshold = None
         self.analysis_from_sgf = None
+        self._analysis_version = 0  # bumped whenever analysis changes, for incremental writes
         self.clear_analysis()
 
     def add_shortcut(self, to_node):  # collapses the branch between them
@@ -59,7 +106,7 @@ class GameNode(SGFNode):
             nodes.append(nodes[-1].parent)
         if nodes[-1] == self and len(nodes) > 2:
             via = nodes[-2]
-            self.shortcuts_to.append((to_node, via))  # and first child
+            self.shortcuts_to = [*self.shortcuts_to, (to_node, via)]  # and first child
             to_node.shortcut_from = self
 
     def remove_shortcut(self):
@@ -68,6 +115,86 @@ class GameNode(SGFNode):
             from_node.shortcuts_to = [(m, v) for m, v in from_node.shortcuts_to if m != self]
             self.shortcut_from = None
 
+    @property
+    def undo_threshold(self) -> float:
+        """Random threshold for fractional undos, drawn on first use."""
+        if self._undo_threshold is None:
+            self._undo_threshold = random.random()
+        return self._undo_threshold
+
+    def _clear_cache(self, property: Optional[str] = None):
+        super()._clear_cache(property)
+        if property in self.POSITION_PROPERTIES and self._position_hashes is not None:
+            stack = [self]
+            while stack:  # hashes are only set along paths from the root, so the first unset one ends a branch
+                node = stack.pop()
+                if node._position_hashes is not None:
+                    node._position_hashes = None
+                    stack.extend(node._children)
+
+    @property
+    def position_hash(self) -> int:
+        """64-bit Zobrist hash of the position after this node, covering stones, player to move, ko point and ruleset.
+        Set during board replay, otherwise computed on first use for the whole branch up to this node."""
+        if self._position_hashes is None:
+            self.replay_board()
+        return self._position_hashes[0]
+
+    def set_position_hashes(self, state: BoardState, rules_hash: int):
+        """Sets position_hash and the canonical position hash from the board state after this node."""
+        self._position_hashes = (
+            state.position_hash(self.next_player, rules_hash),
+            *state.canonical_hash(self.next_player, rules_hash),
+        )
+
+    def canonical_position_hash(self) -> Tuple[int, int]:
+        """The smallest position hash over the symmetries of the board, and the index of that symmetry in
+        BoardState.symmetries. Identifies a position regardless of orientation. Set along with position_hash."""
+        if self._position_hashes is None:
+            self.replay_board()
+        return self._position_hashes[1:]
+
+    def replay_board(self) -> BoardState:
+        """Returns the board state after this node, replayed from the root, setting position_hash along the way."""
+        nodes = self.nodes_from_root
+        next_node = dict(zip(nodes, nodes[1:]))  # by position on the path, as setup and markup nodes add no depth
+        state = self._hash_positions(nodes[0], lambda node: [next_node[node]] if node in next_node else [])
+        if self._position_hashes is None:
+            raise IllegalMoveException("Illegal move in branch")
+        return state
+
+    def compute_position_hashes(self):
+        """Sets position_hash for all nodes in the tree in a single pass, copying the board only where it branches.
+        Nodes after an illegal move are skipped, and raise on access."""
+        self._hash_positions(self.root, lambda node: node.children)
+
+    @staticmethod
+    def _rules(root: "GameNode"):
+        from katrain.core.engine import KataGoEngine  # engine imports this module
+
+        return KataGoEngine.get_rules(root.ruleset)
+
+    @classmethod
+    def _hash_positions(cls, root: "GameNode", next_nodes) -> BoardState:
+        """Replays the tree from the root depth first, visiting next_nodes(node) after each node.
+        Returns the state after the last node played."""
+        rules = cls._rules(root)
+        suicide_allowed = BoardState.suicide_allowed(rules)
+        rules_hash = BoardState.rules_hash(rules)
+        state = BoardState(root.board_size)
+        stack = [(root, state)]  # node and the state before it, which it is free to change
+        while stack:
+            node, state = stack.pop()
+            try:
+                state = state.play_node(node, suicide_allowed=suicide_allowed)
+            except IllegalMoveException:
+                continue
+            node.set_position_hashes(state, rules_hash)
+            children = next_nodes(node)
+            for i, child in enumerate(children):
+                stack.append((child, state if i == len(children) - 1 else state.copy()))
+        return state
+
     def load_analysis(self):
         if not self.analysis_from_sgf:
             return False
@@ -85,6 +212,7 @@ class GameNode(SGFNode):
                 "policy": unpack_floats(policy_data, board_squares + 1),
                 "ownership": unpack_floats(ownership_data, board_squares),
             }
+            self._analysis_version += 1
             return True
         except Exception as e:
             print(f"Error in loading analysis: {e}")
@@ -105,8 +233,29 @@ class GameNode(SGFNode):
             return super().add_list_property(property, values)
 
     def clear_analysis(self):
+        self._analysis_version += 1
         self.analysis_visits_requested = 0
-        self.analysis = {"moves": {}, "root": None, "ownership": None, "policy": None, "completed": False}
+        self.analysis = EMPTY_ANALYSIS  # shared until analysis arrives, see _writable_analysis
+
+    def _writable_analysis(self) -> Dict:
+        if self.analysis is EMPTY_ANALYSIS:
+            self.analysis = {"moves": {}, "root": None, "ownership": None, "policy": None, "completed": False}
+        return self.analysis
+
+    def sgf_cache_key(self):
+        if self.is_root:
+            return None  # root properties are updated in place before saving, and it is only one node
+        return (
+            self._version,
+            self._analysis_version,
+            self.parent._analysis_version,  # comments are based on the parent's analysis
+            self.note,
+            self.auto_undo,
+            self.ai_thoughts,
+            id(self.shortcut_from) if self.shortcut_from else None,
+            bool(self.shortcuts_to),
+            i18n.lang,
+        )
 
     def sgf_properties(
         self,
@@ -195,26 +344,121 @@ class GameNode(SGFNode):
         region_of_interest=None,
         report_every=REPORT_DT,
     ):
-        engine.request_analysis(
-            self,
-            callback=lambda result, partial_result: self.set_analysis(
-                result, refine_move, find_alternatives, region_of_interest, partial_result
-            ),
+        kwargs = dict(
             priority=priority,
             visits=visits,
             ponder=ponder,
-            analyze_fast=analyze_fast,
             time_limit=time_limit,
+            refine_move=refine_move,
+            analyze_fast=analyze_fast,
+            find_alternatives=find_alternatives,
+            region_of_interest=region_of_interest,
+            report_every=report_every,
+        )
+        cache = getattr(engine, "analysis_cache", None)
+        if isinstance(cache, AnalysisCache) and not (ponder or refine_move or find_alternatives or region_of_interest):
+            cache.submit(self._analyze_unless_cached, engine, kwargs)  # keeps database reads off the GUI thread
+        else:
+            self._request_analysis(engine, kwargs)
+
+    def _analyze_unless_cached(self, engine, kwargs):
+        requested_visits = engine.requested_visits(kwargs["visits"], kwargs["analyze_fast"])
+        settings = engine.analysis_settings()
+        if not self._load_cached_analysis(engine, requested_visits, settings):
+            self._request_analysis(engine, kwargs, cache_settings=settings)
+
+    def _request_analysis(self, engine, kwargs, cache_settings=None):
+        """Requests analysis from the engine, storing final results in its cache if cache_settings are given."""
+        refine_move, find_alternatives = kwargs["refine_move"], kwargs["find_alternatives"]
+        region_of_interest = kwargs["region_of_interest"]
+
+        def callback(result, partial_result):
+            if cache_settings is not None and not partial_result:
+                engine.analysis_cache.put(self, result, cache_settings)
+            self.set_analysis(result, refine_move, find_alternatives, region_of_interest, partial_result)
+
+        engine.request_analysis(
+            self,
+            callback=callback,
+            priority=kwargs["priority"],
+            visits=kwargs["visits"],
+            ponder=kwargs["ponder"],
+            analyze_fast=kwargs["analyze_fast"],
+            time_limit=kwargs["time_limit"],
             next_move=refine_move,
             find_alternatives=find_alternatives,
             region_of_interest=region_of_interest,
+            report_every=kwargs["report_every"],
+        )
+
+    def _load_cached_analysis(self, engine, requested_visits: int, settings: Dict) -> bool:
+        try:
+            ownership = engine.config["_enable_ownership"]
+            cached = engine.analysis_cache.get(self, requested_visits, ownership=ownership, settings=settings)
+        except IllegalMoveException:
+            cached = None  # leave it to the engine to report
+        if cached is None:
+            return False
+        self.set_analysis(cached)
+        self.analysis_visits_requested = max(self.analysis_visits_requested, requested_visits)
+        if getattr(engine.katrain, "update_state", None):
+            engine.katrain.update_state()
+        return True
+
+    @staticmethod
+    def analyze_branch(
+        engine,
+        nodes: List["GameNode"],
+        priority=PRIORITY_DEFAULT,
+        visits=None,
+        time_limit=True,
+        analyze_fast=False,
+        report_every=REPORT_DT,
+    ):
+        """Analyzes nodes on a single branch, ordered from the root down, with multi-turn queries where the engine
+        supports it, and one query per node otherwise. A single query per branch sends its moves only once, so it is
+        re-prioritized as a whole."""
+        cache = getattr(engine, "analysis_cache", None)
+        requested_visits = settings = None
+        if isinstance(cache, AnalysisCache):
+            requested_visits = engine.requested_visits(visits, analyze_fast)
+            settings = engine.analysis_settings()
+            nodes = [node for node in nodes if not node._load_cached_analysis(engine, requested_visits, settings)]
+        if len(nodes) < 2 or not hasattr(engine, "request_branch_analysis"):
+            for node in nodes:
+                node.analyze(
+                    engine,
+                    priority=priority,
+                    visits=visits,
+                    time_limit=time_limit,
+                    analyze_fast=analyze_fast,
+                    report_every=report_every,
+                )
+            return
+
+        def callback(node, result, partial_result):
+            if isinstance(cache, AnalysisCache) and not partial_result:
+                cache.put(node, result, settings)
+            node.set_analysis(result, partial_result=partial_result)
+
+        engine.request_branch_analysis(
+            nodes,
+            callback=callback,
+            priority=priority,
+            visits=visits,
+            time_limit=time_limit,
+            analyze_fast=analyze_fast,
             report_every=report_every,
         )
 
     def update_move_analysis(self, move_analysis, move_gtp):
-        cur = self.analysis["moves"].get(move_gtp)
+        self._analysis_version += 1
+        analysis = self._writable_analysis()
+        if isinstance(move_analysis.get("ownership"), list):  # the results may be shared with other nodes or the cache
+            move_analysis = {**move_analysis, "ownership": compact_floats(move_analysis["ownership"])}
+        cur = analysis["moves"].get(move_gtp)
         if cur is None:
-            self.analysis["moves"][move_gtp] = {
+            analysis["moves"][move_gtp] = {
                 "move": move_gtp,
                 "order": ADDITIONAL_MOVE_ORDER,
                 **move_analysis,
@@ -236,6 +480,8 @@ class GameNode(SGFNode):
         region_of_interest=None,
         partial_result: bool = False,
     ):
+        self._analysis_version += 1
+        self._writable_analysis()
         if refine_move:
             pvtail = analysis_json["moveInfos"][0]["pv"] if analysis_json["moveInfos"] else []
             self.update_move_analysis(
@@ -250,8 +496,8 @@ class GameNode(SGFNode):
                     move_dict["order"] = ADDITIONAL_MOVE_ORDER  # old moves to end
             for move_analysis in analysis_json["moveInfos"]:
                 self.update_move_analysis(move_analysis, move_analysis["move"])
-            self.analysis["ownership"] = analysis_json.get("ownership")
-            self.analysis["policy"] = analysis_json.get("policy")
+            self.analysis["ownership"] = compact_floats(analysis_json.get("ownership"))
+            self.analysis["policy"] = compact_floats(analysis_json.get("policy"))
             if not additional_moves and not region_of_interest:
                 self.analysis["root"] = analysis_json["rootInfo"]
                 if self.parent and self.move:
@@ -381,8 +627,9 @@ class GameNode(SGFNode):
         if self.ai_thoughts and (sgf or details):
             text += "\n" + i18n._("Info:AI thoughts").format(thoughts=self.ai_thoughts)
 
-        if "C" in self.properties:
-            text += "\n[u]SGF Comments:[/u]\n" + "\n".join(self.properties["C"])
+        sgf_comments = self.get_list_property("C")  # without switching to the dict store
+        if sgf_comments:
+            text += "\n[u]SGF Comments:[/u]\n" + "\n".join(sgf_comments)
 
         return text
 
@@ -451,8 +698,6 @@ class GameNode(SGFNode):
     @property
     def policy_ranking(self) -> Optional[List[Tuple[float, Move]]]:  # return moves from highest policy value to lowest
         if self.policy:
-            szx, szy = self.board_size
-            policy_grid = var_to_grid(self.policy, size=(szx, szy))
-            moves = [(policy_grid[y][x], Move((x, y), player=self.next_player)) for x in range(szx) for y in range(szy)]
-            moves.append((self.policy[-1], Move(None, player=self.next_player)))
+            policy = self.policy
+            moves = [(policy[ix], move) for ix, move in Move.policy_moves(self.board_size, player=self.next_player)]
             return sorted(moves, key=lambda mp: -mp[0])
@@ -7,6 +7,9 @@ Engine JSON protocol over a WebSocket.
 
 Generic transport — any KataGo-compatible server works. KaTrain has
 no awareness of who hosts the engine.
+
+With several URLs, separated by spaces or commas, a RemoteEnginePool
+keeps a connection to each server and spreads queries over them.
 """
 
 from __future__ import annotations
@@ -33,7 +36,9 @@ from katrain.core.constants import (
     OUTPUT_INFO,
     STATUS_INFO,
 )
-from katrain.core.engine import BaseEngine, KataGoEngine, resolve_engine_backend
+from katrain.core.engine import BaseEngine, KataGoEngine, QueryQueue, remote_urls, resolve_engine_backend
+from katrain.core.engine_daemon import daemon_url, ensure_daemon
+from katrain.core.engine_pool import EnginePool
 from katrain.core.lang import i18n
 from katrain.core.utils import json_truncate_arrays
 
@@ -63,6 +68,7 @@ class RemoteKataGoEngine(KataGoEngine):
         BaseEngine.__init__(self, katrain, config)
         self.allow_recovery = self.config.get("allow_recovery", True)
         self.queries = {}
+        self.turns_remaining = {}
         # query id -> JSON payload, kept so outstanding analyses can be
         # re-sent after a reconnect (the server loses them on disconnect).
         self.sent_payloads = {}
@@ -71,10 +77,16 @@ class RemoteKataGoEngine(KataGoEngine):
         self.katago_process = None  # rest of the codebase checks this
         self.base_priority = 0
         self.override_settings = {"reportAnalysisWinratesAs": "BLACK"}
-        self.write_queue = queue.Queue()
+        self.query_window = self.config.get("max_queries_in_flight") or self.DEFAULT_QUERY_WINDOW
+        self.write_queue = QueryQueue(self.has_query_capacity)
         self.thread_lock = threading.Lock()
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+        self.num_duplicate_queries = 0
+        self.callback_dispatcher = self._create_callback_dispatcher()
         self.shell = False
         self.command = "<remote websocket>"
+        self.analysis_cache = None
 
         self.remote_url = (config.get("remote_url") or "").strip()
         if not self.remote_url:
@@ -105,6 +117,7 @@ class RemoteKataGoEngine(KataGoEngine):
         # can't trigger a reconnect that would tear down a newer one.
         self._conn_id = 0
 
+        self.analysis_cache = self.open_analysis_cache(engine_id=self.remote_url)
         self.start()
 
     def _create_connection(self) -> WebSocket:
@@ -145,7 +158,7 @@ class RemoteKataGoEngine(KataGoEngine):
 
     def start(self):
         with self.thread_lock:
-            self.write_queue = queue.Queue()
+            self.write_queue = QueryQueue(self.has_query_capacity)
             self._closing = False
             self._reported_dead = False
             self._reconnecting = False
@@ -276,6 +289,42 @@ class RemoteKataGoEngine(KataGoEngine):
                 self.katrain.log(f"Failed to re-send query after reconnect: {e}", OUTPUT_ERROR)
                 return
 
+    def on_final_result(self, analysis, time_taken):
+        """Called with each final result, and the seconds since its query was sent."""
+
+    def take_outstanding(self):
+        """Remove and return the queries in flight or still queued, as
+        (query, callback, error_callback, next_move, node) items for
+        another engine's write_queue. Queries in flight are taken from
+        sent_payloads, as for a reconnect, without their ids."""
+        with self.thread_lock:
+            ponder_id = (self.ponder_query or {}).get("id")
+            items = []
+            for query_id, (callback, error_callback, _, next_move, node) in self.queries.items():
+                payload = self.sent_payloads.get(query_id)
+                if payload is not None:
+                    query = {k: v for k, v in payload.items() if k != "id"}
+                    if query_id == ponder_id:
+                        query[self.PONDER_KEY] = True  # so the other engine can stop it
+                    items.append((query, callback, error_callback, next_move, node))
+            items += self.write_queue.remove(lambda query, node: True)
+            self.queries = {}
+            self.turns_remaining = {}
+            self.sent_payloads = {}
+            self.ponder_query = None
+            with self.in_flight_lock:
+                self.in_flight = {}
+        return items
+
+    def _trim_sent_payload(self, query_id, turn):
+        """Drop a finished turn from the payload kept for re-sending, so
+        a reconnect only asks for the turns still to come, which is what
+        turns_remaining here and in InFlightQuery count."""
+        payload = self.sent_payloads.get(query_id)
+        if payload and turn in payload.get("analyzeTurns", []):
+            turns = [t for t in payload["analyzeTurns"] if t != turn]
+            self.sent_payloads[query_id] = {**payload, "analyzeTurns": turns}
+
     def _set_status(self, message):
         try:
             self.katrain.controls.set_status(message, STATUS_INFO)
@@ -306,7 +355,7 @@ class RemoteKataGoEngine(KataGoEngine):
                     t.join(timeout=2.0)
 
     def wait_to_finish(self):
-        while self.queries and self.ws is not None:
+        while not self.is_idle() and self.ws is not None:
             time.sleep(0.1)
 
     def _report_dead(self, os_error, allow_popup):
@@ -400,6 +449,8 @@ class RemoteKataGoEngine(KataGoEngine):
                         node,
                     )
                     self.sent_payloads[query["id"]] = query
+                    if len(query.get("analyzeTurns", [])) > 1:
+                        self.turns_remaining[query["id"]] = len(query["analyzeTurns"])
                 tag = "ponder " if ponder else ("terminate " if terminate else "")
                 self.katrain.log(
                     f"Sending {tag}query {query['id']}: {json.dumps(query)}",
@@ -510,7 +561,7 @@ class RemoteKataGoEngine(KataGoEngine):
                     )
                 return
 
-            callback, error_callback, start_time, next_move, _ = self.queries[query_id]
+            callback, error_callback, start_time, next_move, node = self.queries[query_id]
 
             # Handled BEFORE the dispatch chain so analysis data
             # alongside a warning still reaches the callback.
@@ -526,10 +577,11 @@ class RemoteKataGoEngine(KataGoEngine):
                     pass
 
             if "error" in analysis:
-                del self.queries[query_id]
+                self._forget_query(query_id)
                 self.sent_payloads.pop(query_id, None)
                 if error_callback:
-                    error_callback(analysis)
+                    self.callback_dispatcher.dispatch(node, query_id, error_callback, analysis)
+                    return
                 elif not (next_move and "Illegal move" in analysis["error"]):
                     self.katrain.log(
                         f"{analysis} received from remote KataGo",
@@ -543,10 +595,15 @@ class RemoteKataGoEngine(KataGoEngine):
             else:
                 partial_result = analysis.get("isDuringSearch", False)
                 if not partial_result:
-                    del self.queries[query_id]
-                    self.sent_payloads.pop(query_id, None)
+                    self._finish_turn(query_id)
+                    if query_id not in self.queries:
+                        self.sent_payloads.pop(query_id, None)
+                    else:
+                        self._trim_sent_payload(query_id, analysis.get("turnNumber"))
                 time_taken = time.time() - start_time
                 results_exist = not analysis.get("noResults", False)
+                if results_exist and not partial_result:
+                    self.on_final_result(analysis, time_taken)
                 self.katrain.log(
                     f"[{time_taken:.1f}][{query_id}][{'....' if partial_result else 'done'}] "
                     f"KataGo analysis received: {len(analysis.get('moveInfos', []))} "
@@ -555,15 +612,11 @@ class RemoteKataGoEngine(KataGoEngine):
                     OUTPUT_DEBUG,
                 )
                 self.katrain.log(json_truncate_arrays(analysis), OUTPUT_EXTRA_DEBUG)
-                try:
-                    if callback and results_exist:
-                        callback(analysis, partial_result)
-                except Exception as e:
-                    self.katrain.log(
-                        f"Error in engine callback for query {query_id}: {e}",
-                        OUTPUT_ERROR,
+                if callback and results_exist:  # update_state is called once it ran
+                    self.callback_dispatcher.dispatch(
+                        node, query_id, callback, analysis, partial_result, partial=partial_result
                     )
-                    traceback.print_exc()
+                    return
 
             if getattr(self.katrain, "update_state", None):
                 self.katrain.update_state()
@@ -575,10 +628,190 @@ class RemoteKataGoEngine(KataGoEngine):
             traceback.print_exc()
 
 
+class DaemonKataGoEngine(RemoteKataGoEngine):
+    """A local engine shared through the KataGo daemon (see engine_daemon). Finding or starting the daemon can take
+    seconds, so this attaches in the background, with queries waiting in the queue until it is connected."""
+
+    ENGINE_TYPE = "local"  # the daemon runs KataGo locally, so the usual advice applies
+
+    def __init__(self, katrain, config):
+        self.daemon_config = config
+        super().__init__(katrain, {**config, "backend": "remote", "remote_url": daemon_url(config)})
+
+    def start(self):
+        with self.thread_lock:
+            self.write_queue = QueryQueue(self.has_query_capacity)
+            self._closing = False
+            self._reported_dead = False
+            self._reconnecting = True  # alive while attaching, as while reconnecting
+        threading.Thread(target=self._attach_thread, daemon=True).start()
+
+    def _attach_thread(self):
+        url = ensure_daemon(self.katrain, self.daemon_config)
+        with self.thread_lock:
+            if self._closing:
+                return
+            try:
+                if not url:
+                    raise ConnectionError("no KataGo daemon with these engine settings")
+                self.katrain.log(f"Connecting to KataGo daemon at {url}", OUTPUT_DEBUG)
+                self.ws = self._create_connection()
+            except Exception as e:
+                self.ws = None
+                error = e
+            else:
+                self._reconnecting = False
+                self._start_threads()
+                return
+        self._reconnecting = False
+        self.on_error(i18n._("Connecting to remote KataGo failed").format(url=self.remote_url, error=error), "DAEMON")
+
+
+class RemoteWorker(RemoteKataGoEngine):
+    """A server in a RemoteEnginePool, which reports a lost connection to the pool instead of opening the recovery
+    popup, and its speed on each final result."""
+
+    def __init__(self, pool: "RemoteEnginePool", index: int, katrain, config):
+        self.pool = pool
+        self.index = index
+        super().__init__(katrain, {**config, "analysis_cache_mb": 0})  # the pool checks the cache
+
+    def _create_callback_dispatcher(self):
+        return self.pool.callback_dispatcher
+
+    def on_error(self, message, code=None, allow_popup=True):
+        self.katrain.log(f"[{self.remote_url}] {message}", OUTPUT_ERROR)
+        self.pool.worker_failed(self.index, message, code)
+
+    def on_final_result(self, analysis, time_taken):
+        self.pool.record_speed(self.index, time_taken, analysis["rootInfo"]["visits"])
+
+
+class RemoteEnginePool(EnginePool):
+    """Spreads queries over several remote servers, with a connection to each.
+
+    New positions go to the server expected to finish them first, going by its outstanding visits and the seconds per
+    visit measured from its results, which include network latency. A server that stays disconnected after the usual
+    reconnect attempts is taken out of use, and the queries it had are moved to the others as for a reconnect, from
+    sent_payloads. It is tried again every REVIVE_INTERVAL seconds. The recovery popup opens only once all are down."""
+
+    ENGINE_TYPE = "remote"
+    REVIVE_INTERVAL = 30.0
+    SPEED_SMOOTHING = 0.2  # weight of the latest result in the seconds per visit
+
+    def __init__(self, katrain, config, urls: List[str]):
+        self.urls = urls
+        self._dead = set()
+        self._seconds_per_visit = [None] * len(urls)
+        self._closing = False
+        self._reviving = False
+        super().__init__(katrain, config, num_workers=len(urls))
+
+    def _create_worker(self, index: int) -> RemoteWorker:
+        return RemoteWorker(self, index, self.katrain, {**self.config, "remote_url": self.urls[index]})
+
+    def engine_id(self) -> str:
+        return " ".join(sorted(self.urls))
+
+    def record_speed(self, index: int, seconds: float, visits: int):
+        seconds_per_visit = seconds / max(visits, 1)
+        with self._lock:
+            previous = self._seconds_per_visit[index]
+            if previous is not None:
+                seconds_per_visit = previous + self.SPEED_SMOOTHING * (seconds_per_visit - previous)
+            self._seconds_per_visit[index] = seconds_per_visit
+
+    def worker_load(self, index: int) -> float:
+        """Expected seconds to finish the outstanding visits. Servers without results yet count as the fastest."""
+        known = [speed for speed in self._seconds_per_visit if speed is not None]
+        seconds_per_visit = self._seconds_per_visit[index]
+        if seconds_per_visit is None:
+            seconds_per_visit = min(known, default=1.0)
+        return (self.outstanding_visits(index) + 1) * seconds_per_visit
+
+    def unavailable_workers(self) -> Set[int]:
+        return self._restarting | self._dead
+
+    def worker_failed(self, index: int, message: str, code=None):
+        """Called once a server could not be reconnected to, or not connected to at all."""
+        with self._lock:
+            if index in self._dead or self._closing:
+                return
+            self._dead.add(index)
+            all_dead = len(self._dead) == len(self.urls)
+            revive = not self._reviving
+            self._reviving = True
+        if all_dead:
+            self.on_error(message, code)
+        else:
+            threading.Thread(target=self._move_queries, args=(index,), daemon=True).start()
+        if revive:
+            threading.Thread(target=self._revive_thread, daemon=True).start()
+
+    def _move_queries(self, index: int):
+        if index >= len(self.workers):  # failed to connect while starting up, so nothing was sent yet
+            return
+        items = self.workers[index].take_outstanding()
+        if items:
+            self.katrain.log(f"Moving {len(items)} queries from {self.urls[index]} to other servers", OUTPUT_INFO)
+        by_node = {}
+        for item in items:
+            by_node.setdefault(item[-1], []).append(item)
+        with self._lock:
+            moved = self._pending[index]
+            self._pending[index] = {}
+        for node, node_items in by_node.items():  # all queries for a node to the same server, in order
+            with self._lock:
+                self._node_worker.pop(node, None)
+            target = self._select_worker(node, refinement=False)
+            with self._lock:
+                for token, pending in list(moved.items()):
+                    if pending[1] is node:
+                        self._pending[target][token] = moved.pop(token)
+            for item in node_items:
+                self.workers[target].write_queue.put(item)
+
+    def _revive_thread(self):
+        while True:
+            time.sleep(self.REVIVE_INTERVAL)
+            with self._lock:
+                dead = sorted(self._dead)
+                if not dead or self._closing:
+                    self._reviving = False
+                    return
+            for index in dead:
+                if index < len(self.workers):
+                    worker = self.workers[index]
+                    worker.start()  # calls worker_failed again on failure, which keeps it out of use
+                    if worker.ws is not None:
+                        self.katrain.log(f"Reconnected to {self.urls[index]}", OUTPUT_INFO)
+                        with self._lock:
+                            self._dead.discard(index)
+
+    def restart(self):
+        with self._lock:
+            self._dead.clear()
+        super().restart()
+
+    def shutdown(self, finish=False):
+        self._closing = True
+        super().shutdown(finish=finish)
+
+
 def make_engine(katrain, config):
     """Return the engine matching the selected backend (see resolve_engine_backend):
-    a RemoteKataGoEngine for the remote backend, otherwise a local-subprocess
-    KataGoEngine (which itself handles the local vs custom-command distinction)."""
+    a RemoteKataGoEngine for the remote backend, or a RemoteEnginePool with several URLs, otherwise a local-subprocess
+    KataGoEngine (which itself handles the local vs custom-command distinction),
+    or an EnginePool over several of them if `engine.num_processes` is above 1.
+    With `engine.daemon` set, a local engine is shared through the KataGo daemon instead (see DaemonKataGoEngine)."""
     if resolve_engine_backend(config) == "remote":
-        return RemoteKataGoEngine(katrain, config)
+        urls = remote_urls(config)
+        if len(urls) > 1:
+            return RemoteEnginePool(katrain, config, urls)
+        return RemoteKataGoEngine(katrain, {**config, "remote_url": urls[0] if urls else ""})
+    if config.get("daemon"):
+        return DaemonKataGoEngine(katrain, config)
+    num_processes = int(config.get("num_processes", 1) or 1)
+    if num_processes > 1:
+        return EnginePool(katrain, config, num_workers=num_processes)
     return KataGoEngine(katrain, config)
@@ -0,0 +1,118 @@
+"""Bulk import of SGF/GIB/NGF archives.
+
+Parsing is spread over a process pool and each file is reduced to a small picklable GameRecord
+(root properties and main line moves), so only compact records cross process boundaries.
+Kept free of kivy imports so worker processes start quickly.
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from katrain.core.sgf_parser import SGF
+
+SGF_EXTENSIONS = (".sgf", ".gib", ".ngf")
+
+
+class GameRecord:
+    """Compact summary of a parsed game file. If parsing failed, `error` is set and the other fields are empty."""
+
+    __slots__ = ("filename", "properties", "moves", "error")
+
+    def __init__(
+        self,
+        filename: str,
+        properties: Optional[Dict[str, List]] = None,
+        moves: Optional[List[Tuple[str, str]]] = None,
+        error: Optional[str] = None,
+    ):
+        self.filename = filename
+        self.properties = properties or {}
+        self.moves = moves or []  # main line as (player, gtp coords), as sent to KataGo
+        self.error = error
+
+    def __repr__(self):
+        if self.error:
+            return f"GameRecord({self.filename}: {self.error})"
+        return f"GameRecord({self.filename}: {len(self.moves)} moves)"
+
+    def to_json(self) -> Dict:
+        return {"filename": self.filename, "properties": self.properties, "moves": self.moves, "error": self.error}
+
+
+def parse_game_record(filename: str) -> GameRecord:
+    """Parse a single file into a GameRecord, capturing any error instead of raising."""
+    try:
+        root = SGF.parse_file(filename, lazy=True)  # side variations are never needed
+        moves = []
+        node = root
+        while node is not None:
+            moves += [(m.player, m.gtp()) for m in node.moves]
+            node = node.main_child
+        properties = {k: [str(v) for v in values] for k, values in root.properties.items()}
+        return GameRecord(filename, properties=properties, moves=moves)
+    except Exception as e:  # report per file, never stop the batch
+        return GameRecord(filename, error=f"{e.__class__.__name__}: {e}")
+
+
+def find_game_files(paths: Iterable[str]) -> List[str]:
+    """Expands directories (recursively) and glob patterns into a sorted list of game files."""
+    files = set()
+    for path in paths:
+        matches = glob.glob(os.path.expanduser(path), recursive=True) or [path]
+        for match in matches:
+            if os.path.isdir(match):
+                for dirpath, _, filenames in os.walk(match):
+                    files.update(os.path.join(dirpath, f) for f in filenames if f.lower().endswith(SGF_EXTENSIONS))
+            else:
+                files.add(match)
+    return sorted(files)
+
+
+def parse_files(filenames: List[str], max_workers: Optional[int] = None) -> Iterator[GameRecord]:
+    """Parses files in parallel, yielding GameRecords in the order of `filenames`."""
+    max_workers = max_workers or os.cpu_count() or 1
+    if max_workers == 1 or len(filenames) <= 1:
+        yield from map(parse_game_record, filenames)
+        return
+    chunksize = max(1, min(64, len(filenames) // (4 * max_workers)))  # amortize IPC, but keep workers balanced
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        yield from executor.map(parse_game_record, filenames, chunksize=chunksize)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parse SGF/GIB/NGF archives into JSON lines game records.")
+    parser.add_argument("paths", nargs="+", help="Files, directories or glob patterns")
+    parser.add_argument("-o", "--output", help="Output file (default: stdout)")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Number of worker processes")
+    args = parser.parse_args(argv)
+
+    filenames = find_game_files(args.paths)
+    start_time = time.time()
+    num_errors = 0
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for record in parse_files(filenames, max_workers=args.workers):
+            if record.error:
+                num_errors += 1
+                print(f"ERROR: {record.filename}: {record.error}", file=sys.stderr)
+            out.write(json.dumps(record.to_json(), ensure_ascii=False) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    time_taken = time.time() - start_time
+    print(
+        f"Parsed {len(filenames)} files ({num_errors} errors) in {time_taken:.1f}s: "
+        f"{len(filenames) / max(time_taken, 1e-9):.1f} files/s",
+        file=sys.stderr,
+    )
+    return 1 if num_errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,15 @@
+import bisect
 import copy
 import chardet
+import io
 import math
+import mmap
+import os
 import re
-from collections import defaultdict
-from typing import Any, Dict, List, Optional, Tuple
+import sys
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
 
 
 class ParseError(Exception):
@@ -13,57 +19,122 @@ class ParseError(Exception):
 
 
 class Move:
+    """Immutable move. Instances are interned, so creating or converting a move is a dictionary lookup once
+    it has been seen, and no new objects are allocated on hot paths."""
+
+    __slots__ = ("player", "coords", "_gtp")
+
     GTP_COORD = list("ABCDEFGHJKLMNOPQRSTUVWXYZ") + [
         xa + c for xa in "ABCDEFGH" for c in "ABCDEFGHJKLMNOPQRSTUVWXYZ"
     ]  # board size 52+ support
     PLAYERS = "BW"
     SGF_COORD = list("ABCDEFGHIJKLMNOPQRSTUVWXYZ".lower()) + list("ABCDEFGHIJKLMNOPQRSTUVWXYZ")  # sgf goes to 52
 
+    # interning tables, filled on first use: (coords, player) -> move, (gtp, player) -> move,
+    # (sgf, board size, player) -> move, (coords, board height) -> sgf string and (board size, player) -> policy moves
+    _INTERNED = {}
+    _FROM_GTP = {}
+    _FROM_SGF = {}
+    _SGF_STR = {}
+    _POLICY_MOVES = {}
+
     @classmethod
     def from_gtp(cls, gtp_coords, player="B"):
         """Initialize a move from GTP coordinates and player"""
-        if "pass" in gtp_coords.lower():
-            return cls(coords=None, player=player)
-        match = re.match(r"([A-Z]+)(\d+)", gtp_coords)
-        return cls(coords=(Move.GTP_COORD.index(match[1]), int(match[2]) - 1), player=player)
+        move = cls._FROM_GTP.get((gtp_coords, player))
+        if move is None:
+            if "pass" in gtp_coords.lower():
+                move = cls(coords=None, player=player)
+            else:
+                match = re.match(r"([A-Z]+)(\d+)", gtp_coords)
+                move = cls(coords=(Move.GTP_COORD.index(match[1]), int(match[2]) - 1), player=player)
+            cls._FROM_GTP[(gtp_coords, player)] = move
+        return move
 
     @classmethod
     def from_sgf(cls, sgf_coords, board_size, player="B"):
         """Initialize a move from SGF coordinates and player"""
-        if sgf_coords == "" or (
-            sgf_coords == "tt" and board_size[0] <= 19 and board_size[1] <= 19
-        ):  # [tt] can be used as "pass" for <= 19x19 board
-            return cls(coords=None, player=player)
-        return cls(
-            coords=(Move.SGF_COORD.index(sgf_coords[0]), board_size[1] - Move.SGF_COORD.index(sgf_coords[1]) - 1),
-            player=player,
-        )
+        key = (sgf_coords, tuple(board_size), player)
+        move = cls._FROM_SGF.get(key)
+        if move is None:
+            if sgf_coords == "" or (
+                sgf_coords == "tt" and board_size[0] <= 19 and board_size[1] <= 19
+            ):  # [tt] can be used as "pass" for <= 19x19 board
+                move = cls(coords=None, player=player)
+            else:
+                move = cls(
+                    coords=(
+                        Move.SGF_COORD.index(sgf_coords[0]),
+                        board_size[1] - Move.SGF_COORD.index(sgf_coords[1]) - 1,
+                    ),
+                    player=player,
+                )
+            cls._FROM_SGF[key] = move
+        return move
+
+    @classmethod
+    def policy_moves(cls, board_size, player="B") -> List[Tuple[int, "Move"]]:
+        """Returns (index into a KataGo policy/ownership array, move) for every point on the board and pass.
+        The list is shared between calls and should not be modified."""
+        key = (tuple(board_size), player)
+        moves = cls._POLICY_MOVES.get(key)
+        if moves is None:
+            szx, szy = board_size
+            moves = [((szy - y - 1) * szx + x, cls((x, y), player=player)) for x in range(szx) for y in range(szy)]
+            moves.append((szx * szy, cls(None, player=player)))
+            cls._POLICY_MOVES[key] = moves
+        return moves
+
+    def __new__(cls, coords: Optional[Tuple[int, int]] = None, player: str = "B"):
+        """Returns the move for zero-based coordinates and player"""
+        try:
+            return cls._INTERNED[(coords, player)]
+        except (KeyError, TypeError):
+            pass
+        if coords is not None:
+            coords = (coords[0], coords[1])  # normalize lists and other sequences
+        move = cls._INTERNED.get((coords, player))
+        if move is None:
+            move = object.__new__(cls)
+            object.__setattr__(move, "player", player)
+            object.__setattr__(move, "coords", coords)
+            object.__setattr__(
+                move, "_gtp", "pass" if coords is None else Move.GTP_COORD[coords[0]] + str(coords[1] + 1)
+            )
+            move = cls._INTERNED.setdefault((coords, player), move)
+        return move
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Move is immutable")
 
-    def __init__(self, coords: Optional[Tuple[int, int]] = None, player: str = "B"):
-        """Initialize a move from zero-based coordinates and player"""
-        self.player = player
-        self.coords = coords
+    def __reduce__(self):
+        return self.__class__, (self.coords, self.player)
 
     def __repr__(self):
         return f"Move({self.player or ''}{self.gtp()})"
 
     def __eq__(self, other):
-        return self.coords == other.coords and self.player == other.player
+        return self is other or (
+            isinstance(other, Move) and self.coords == other.coords and self.player == other.player
+        )
 
     def __hash__(self):
         return hash((self.coords, self.player))
 
     def gtp(self):
         """Returns GTP coordinates of the move"""
-        if self.is_pass:
-            return "pass"
-        return Move.GTP_COORD[self.coords[0]] + str(self.coords[1] + 1)
+        return self._gtp
 
     def sgf(self, board_size):
         """Returns SGF coordinates of the move"""
-        if self.is_pass:
+        if self.coords is None:
             return ""
-        return f"{Move.SGF_COORD[self.coords[0]]}{Move.SGF_COORD[board_size[1] - self.coords[1] - 1]}"
+        key = (self.coords, board_size[1])
+        sgf_str = Move._SGF_STR.get(key)
+        if sgf_str is None:
+            sgf_str = f"{Move.SGF_COORD[self.coords[0]]}{Move.SGF_COORD[board_size[1] - self.coords[1] - 1]}"
+            Move._SGF_STR[key] = sgf_str
+        return sgf_str
 
     @property
     def is_pass(self):
@@ -81,35 +152,271 @@ class Move:
         return self.opponent_player(self.player)
 
 
+class TreeIndex:
+    """Cached traversal orders and root paths for a tree, kept by its root node.
+    The orders are tuples, so they can be handed out without copying. A new node, which is always the last child of
+    its parent, is inserted next to its predecessor in each order. Removing or reordering nodes drops the cached
+    orders, which are rebuilt in linear time when next needed. Nodes never move to another parent, so root paths
+    stay valid: they are kept for recently used nodes, and the path of a new node is extended from its closest
+    cached ancestor."""
+
+    MAX_PATHS = 16  # paths can be long in deep trees, and typically only nodes around the current one are needed
+
+    def __init__(self, root: "SGFNode"):
+        self.root = root
+        self.version = 0  # bumped on every change in tree structure
+        self.position_version = 0  # bumped when properties that affect board positions change
+        self._breadth_first = None
+        self._preorder = None
+        self._paths = OrderedDict()
+        self._lock = root._MATERIALIZE_LOCK  # traversals can parse lazily loaded variations, which adds nodes
+
+    @staticmethod
+    def _inserted(order: Tuple["SGFNode", ...], predecessor: "SGFNode", node: "SGFNode") -> Tuple["SGFNode", ...]:
+        if order[-1] is predecessor:
+            return order + (node,)
+        ix = order.index(predecessor) + 1
+        return order[:ix] + (node,) + order[ix:]
+
+    def _breadth_first_predecessor(self, node: "SGFNode") -> "SGFNode":
+        siblings = node.parent._children
+        if len(siblings) > 1:
+            return siblings[-2]
+        # first child: after the children of the closest node to its left on the parent's level
+        order = self._breadth_first
+        ix = order.index(node.parent)
+        depth = node.parent.depth
+        for left in reversed(order[bisect.bisect_left(order, depth, hi=ix, key=lambda n: n.depth) : ix]):
+            if left._children:
+                return left._children[-1]
+        # otherwise first on its level, after all nodes up to the parent's level
+        return order[bisect.bisect_left(order, depth + 1, lo=ix, key=lambda n: n.depth) - 1]
+
+    def _preorder_predecessor(self, node: "SGFNode") -> "SGFNode":
+        siblings = node.parent._children
+        if len(siblings) == 1:
+            return node.parent
+        predecessor = siblings[-2]  # after the subtree of the previous sibling
+        while predecessor._children:
+            predecessor = predecessor._children[-1]
+        return predecessor
+
+    def node_added(self, node: "SGFNode"):
+        with self._lock:
+            self.version += 1
+            if self._breadth_first is not None:
+                self._breadth_first = self._inserted(self._breadth_first, self._breadth_first_predecessor(node), node)
+            if self._preorder is not None:
+                self._preorder = self._inserted(self._preorder, self._preorder_predecessor(node), node)
+
+    def structure_changed(self):
+        with self._lock:
+            self.version += 1
+            self._breadth_first = None
+            self._preorder = None
+
+    def position_changed(self):
+        self.position_version += 1
+
+    def breadth_first(self) -> Tuple["SGFNode", ...]:
+        """Returns all nodes in breadth first order."""
+        with self._lock:
+            if self._breadth_first is None:
+                self._breadth_first = tuple(self.root._walk_breadth_first())
+            return self._breadth_first
+
+    def preorder(self) -> Tuple["SGFNode", ...]:
+        """Returns all nodes in depth first preorder, children in SGF order."""
+        with self._lock:
+            if self._preorder is None:
+                self._preorder = tuple(self.root._walk_preorder())
+            return self._preorder
+
+    def path_from_root(self, node: "SGFNode") -> Tuple["SGFNode", ...]:
+        """Returns the nodes from the root up to and including node."""
+        with self._lock:
+            path = self._paths.get(node)
+            if path is None:
+                tail = []
+                ancestor = node
+                path = ()
+                while ancestor is not None:
+                    cached_path = self._paths.get(ancestor)
+                    if cached_path is not None:
+                        path = cached_path
+                        break
+                    tail.append(ancestor)
+                    ancestor = ancestor.parent
+                path += tuple(reversed(tail))
+                self._paths[node] = path
+                if len(self._paths) > self.MAX_PATHS:
+                    self._paths.popitem(last=False)
+            else:
+                self._paths.move_to_end(node)
+            return path
+
+
 class SGFNode:
+    """A node in an SGF tree. Properties are kept in a compact flat tuple (key, values, key, values, ...), where a
+    single string value is stored as is, until the `properties` dict is requested. Large trees mostly consist of
+    nodes that are never edited, so this keeps their memory use low."""
+
+    __slots__ = (
+        "_children",
+        "_unparsed_branches",
+        "_version",
+        "_sgf_cache",
+        "_properties",
+        "_parent",
+        "_root",
+        "_depth",
+        "_tree_index",
+        "moves_cache",
+    )
+
+    POSITION_PROPERTIES = {"B", "W", "AB", "AW", "AE", "SZ", "RU"}  # properties that can change board positions
+    _MATERIALIZE_LOCK = threading.RLock()  # guards lazily parsed variations
+    _INTERN_MAX_LENGTH = 5  # short values such as coordinates are shared between nodes
+
     def __init__(self, parent=None, properties=None, move=None):
-        self.children = []
-        self.properties = defaultdict(list)
+        self._children = []
+        self._unparsed_branches = None  # (parser, start offsets) of variations left unparsed by a lazy parse
+        self._version = 0  # bumped on property changes, for incremental writes
+        self._sgf_cache = None  # (key, serialized node) from the last incremental write
+        self._properties = ()
+        self._tree_index = None  # only set on the root, see tree_index
+        self._root = None
         if properties:
             for k, v in properties.items():
                 self.set_property(k, v)
         self.parent = parent
         if self.parent:
-            self.parent.children.append(self)
+            siblings = self.parent.children if self.parent._unparsed_branches else self.parent._children
+            if siblings:  # after any variations left unparsed, as in the file
+                siblings.append(self)
+            else:  # exactly sized list for the common case of a single child
+                self.parent._children = [self]
+            index = self._root._tree_index
+            if index is not None:
+                index.node_added(self)
         if parent and move:
             self.set_property(move.player, move.sgf(self.board_size))
         self._clear_cache()
 
-    def _clear_cache(self):
+    def _clear_cache(self, property: Optional[str] = None):
         self.moves_cache = None
+        self._version += 1
+        if property in self.POSITION_PROPERTIES and self._root is not None:
+            index = self._root._tree_index
+            if index is not None:
+                index.position_changed()
 
     def __repr__(self):
-        return f"SGFNode({dict(self.properties)})"
+        return f"SGFNode({dict(self._property_items())})"
+
+    @property
+    def properties(self) -> Dict[str, List]:
+        """Returns the properties as a dict of lists, which can be modified in place.
+        The node switches from the compact store to this dict on first access, and as in-place changes do not bump
+        its version, it is then always serialized again by incremental writes."""
+        if isinstance(self._properties, tuple):
+            self._properties = defaultdict(list, self._property_items())
+        return self._properties
+
+    @properties.setter
+    def properties(self, properties: Dict[str, List]):
+        for property in self.POSITION_PROPERTIES:
+            if properties.get(property) != self.get_list_property(property):
+                self._clear_cache(property)
+        self._clear_cache()
+        self._properties = defaultdict(list, properties)
+
+    def _property_items(self) -> Iterator[Tuple[str, List]]:
+        """Iterates over (property, values) without switching to the dict store."""
+        store = self._properties
+        if isinstance(store, tuple):
+            for i in range(0, len(store), 2):
+                values = store[i + 1]
+                yield store[i], [values] if isinstance(values, str) else list(values)
+        else:
+            yield from store.items()
+
+    @classmethod
+    def _compact_values(cls, values: List) -> Any:
+        if len(values) == 1 and isinstance(values[0], str):
+            value = values[0]
+            return sys.intern(value) if len(value) <= cls._INTERN_MAX_LENGTH and type(value) is str else value
+        return tuple(values)
+
+    def _store_values(self, property: str, values: List):
+        store = self._properties
+        if not isinstance(store, tuple):
+            store[property] = values
+            return
+        for i in range(0, len(store), 2):
+            if store[i] == property:
+                self._properties = store[: i + 1] + (self._compact_values(values),) + store[i + 2 :]
+                return
+        self._properties = store + (property, self._compact_values(values))
 
     def sgf_properties(self, **xargs) -> Dict:
         """For hooking into in a subclass and overriding/formatting any additional properties to be output."""
-        return copy.deepcopy(self.properties)
+        return copy.deepcopy(defaultdict(list, self._property_items()))
 
     @staticmethod
     def order_children(children):
         """For hooking into in a subclass and overriding branch order."""
         return children
 
+    @property
+    def children(self) -> List["SGFNode"]:
+        """Returns the child nodes, parsing any variations left unparsed by a lazy parse on first access."""
+        if self._unparsed_branches is not None:
+            with self._MATERIALIZE_LOCK:
+                if self._unparsed_branches:  # empty while they are being parsed, by this thread as the lock is held
+                    parser, branch_starts = self._unparsed_branches
+                    self._unparsed_branches = ()
+                    self._structure_changed()  # rather than inserting each parsed node into the cached orders
+                    errors = []
+                    for ix in branch_starts:
+                        num_children = len(self._children)
+                        try:
+                            parser.parse_variation(self, ix)
+                        except ParseError as e:  # drop the broken variation, but keep parsing the others
+                            del self._children[num_children:]
+                            self._structure_changed()
+                            errors.append(e)
+                    self._unparsed_branches = None
+                    parser.report_errors(errors)
+        return self._children
+
+    @children.setter
+    def children(self, children: List["SGFNode"]):
+        """Sets the child nodes. Use this rather than modifying the list in place, so cached traversals are updated."""
+        with self._MATERIALIZE_LOCK:
+            self._unparsed_branches = None
+            self._children = children
+        self._structure_changed()
+
+    @property
+    def tree_index(self) -> TreeIndex:
+        """Returns the traversal index of the tree this node is in, created on first use."""
+        root = self.root
+        if root._tree_index is None:
+            root._tree_index = TreeIndex(root)
+        return root._tree_index
+
+    def _structure_changed(self):
+        index = self._root._tree_index
+        if index is not None:
+            index.structure_changed()
+
+    @property
+    def main_child(self) -> Optional["SGFNode"]:
+        """Returns the first child in SGF order, without parsing lazily loaded side variations."""
+        children = self._children or self.children
+        return children[0] if children else None
+
     @property
     def ordered_children(self):
         return self.order_children(self.children)
@@ -124,55 +431,96 @@ class SGFNode:
 
     def sgf(self, **xargs) -> str:
         """Generates an SGF, calling sgf_properties on each node with the given xargs, so it can filter relevant properties if needed."""
+        buffer = io.StringIO()
+        self.write_sgf(buffer, **xargs)
+        return buffer.getvalue()
+
+    def sgf_cache_key(self) -> Any:
+        """For hooking into in a subclass: anything that changes the node's sgf_properties output should change this key.
+        Returning None means the node is always re-serialized."""
+        return self._version
+
+    def write_sgf(self, f, incremental=False, **xargs):
+        """Streams the SGF to the file-like object f, node by node.
+        If incremental, serialized nodes are cached, and only nodes whose sgf_cache_key changed since the
+        previous incremental write are serialized again, along with nodes whose `properties` dict was handed out."""
+        xargs_key = repr(sorted(xargs.items())) if incremental else None
 
         def node_sgf_str(node):
-            return ";" + "".join(
+            key = node.sgf_cache_key() if incremental and isinstance(node._properties, tuple) else None
+            if key is not None:
+                key = (xargs_key, key)
+                if node._sgf_cache is not None and node._sgf_cache[0] == key:
+                    return node._sgf_cache[1]
+            node_str = ";" + "".join(
                 [
                     prop + "".join(f"[{self._escape_value(v)}]" for v in values)
                     for prop, values in node.sgf_properties(**xargs).items()
                     if values
                 ]
             )
+            if key is not None:
+                node._sgf_cache = (key, node_str)
+            return node_str
 
         stack = [")", self, "("]
-        sgf_str = ""
         while stack:
             item = stack.pop()
             if isinstance(item, str):
-                sgf_str += item
+                f.write(item)
             else:
-                sgf_str += node_sgf_str(item)
-                if len(item.children) == 1:
-                    stack.append(item.children[0])
-                elif item.children:
-                    stack += sum([[")", c, "("] for c in item.ordered_children[::-1]], [])
-        return sgf_str
+                f.write(node_sgf_str(item))
+                children = item.children
+                if len(children) == 1:
+                    stack.append(children[0])
+                elif children:
+                    for c in item.ordered_children[::-1]:
+                        stack += [")", c, "("]
 
     def add_list_property(self, property: str, values: List):
         """Add some values to the property list."""
         # SiZe[19] ==> SZ[19] etc. for old SGF
         normalized_property = re.sub("[a-z]", "", property)
-        self._clear_cache()
-        self.properties[normalized_property] += values
+        self._clear_cache(normalized_property)
+        if isinstance(self._properties, tuple):
+            self._store_values(normalized_property, self.get_list_property(normalized_property, []) + values)
+        else:
+            self._properties[normalized_property] += values
 
     def get_list_property(self, property, default=None) -> Any:
         """Get the list of values for a property."""
-        return self.properties.get(property, default)
+        store = self._properties
+        if isinstance(store, tuple):
+            for i in range(0, len(store), 2):
+                if store[i] == property:
+                    values = store[i + 1]
+                    return [values] if isinstance(values, str) else list(values)
+            return default
+        return store.get(property, default)
 
     def set_property(self, property: str, value: Any):
         """Add some values to the property. If not a list, it will be made into a single-value list."""
         if not isinstance(value, list):
             value = [value]
-        self._clear_cache()
-        self.properties[property] = value
+        self._clear_cache(property)
+        self._store_values(property, value)
 
     def get_property(self, property, default=None) -> Any:
         """Get the first value of the property, typically when exactly one is expected."""
-        return self.properties.get(property, [default])[0]
+        return self.get_list_property(property, [default])[0]
 
     def clear_property(self, property) -> Any:
         """Removes property if it exists."""
-        return self.properties.pop(property, None)
+        self._clear_cache(property)
+        store = self._properties
+        if isinstance(store, tuple):
+            values = self.get_list_property(property)
+            for i in range(0, len(store), 2):
+                if store[i] == property:
+                    self._properties = store[:i] + store[i + 2 :]
+                    break
+            return values
+        return store.pop(property, None)
 
     @property
     def parent(self) -> Optional["SGFNode"]:
@@ -182,25 +530,29 @@ class SGFNode:
     @parent.setter
     def parent(self, parent_node):
         self._parent = parent_node
-        self._root = None
+        self._root = parent_node.root if parent_node is not None else self
         self._depth = None
 
     @property
     def root(self) -> "SGFNode":
         """Returns the root of the tree, cached for speed"""
-        if self._root is None:
-            self._root = self.parent.root if self.parent else self
         return self._root
 
     @property
     def depth(self) -> int:
         """Returns the depth of this node, where root is 0, cached for speed"""
         if self._depth is None:
-            moves = self.moves
-            if self.is_root:
-                self._depth = 0
-            else:  # no increase on placements etc
-                self._depth = self.parent.depth + len(moves)
+            uncached = []
+            node = self
+            while node._depth is None and node.parent is not None:  # no recursion, trees can be very deep
+                uncached.append(node)
+                node = node.parent
+            if node._depth is None:
+                node._depth = 0  # root
+            depth = node._depth
+            for node in reversed(uncached):
+                depth += len(node.moves)  # no increase on placements etc
+                node._depth = depth
         return self._depth
 
     @property
@@ -305,28 +657,41 @@ class SGFNode:
     @property
     def empty(self) -> bool:
         """Returns true if node has no children or properties"""
-        return not self.children and not self.properties
+        return not self.children and not self._properties
 
     @property
-    def nodes_in_tree(self) -> List:
-        """Returns all nodes in the tree rooted at this node"""
-        stack = [self]
+    def nodes_in_tree(self) -> Sequence["SGFNode"]:
+        """Returns all nodes in the tree rooted at this node, in breadth first order"""
+        if self.is_root:
+            return self.tree_index.breadth_first()
+        return self._walk_breadth_first()
+
+    @property
+    def nodes_in_preorder(self) -> Sequence["SGFNode"]:
+        """Returns all nodes in the tree rooted at this node, in depth first preorder"""
+        if self.is_root:
+            return self.tree_index.preorder()
+        return self._walk_preorder()
+
+    def _walk_breadth_first(self) -> List:
+        nodes = [self]
+        for node in nodes:  # extended while iterating
+            nodes.extend(node.children)
+        return nodes
+
+    def _walk_preorder(self) -> List:
         nodes = []
+        stack = [self]
         while stack:
-            item = stack.pop(0)
-            nodes.append(item)
-            stack += item.children
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(reversed(node.children))
         return nodes
 
     @property
     def nodes_from_root(self) -> List:
         """Returns all nodes from the root up to this node, i.e. the moves played in the current branch of the game"""
-        nodes = [self]
-        n = self
-        while not n.is_root:
-            n = n.parent
-            nodes.append(n)
-        return nodes[::-1]
+        return list(self.tree_index.path_from_root(self))
 
     def play(self, move) -> "SGFNode":
         """Either find an existing child or create a new one with the given move."""
@@ -338,15 +703,15 @@ class SGFNode:
     @property
     def initial_player(self):  # player for first node
         root = self.root
-        if "PL" in root.properties:  # explicit
+        if root.get_list_property("PL") is not None:  # explicit
             return "B" if self.root.get_property("PL").upper().strip() == "B" else "W"
         elif root.children:  # child exist, use it if not placement
             for child in root.children:
                 for color in "BW":
-                    if color in child.properties:
+                    if child.get_list_property(color) is not None:
                         return color
         # b move or setup with only black moves like handicap
-        if "AB" in self.properties and "AW" not in self.properties:
+        if self.get_list_property("AB") is not None and self.get_list_property("AW") is None:
             return "W"
         else:
             return "B"
@@ -356,9 +721,9 @@ class SGFNode:
         """Returns player to move"""
         if self.is_root:
             return self.initial_player
-        elif "B" in self.properties:
+        elif self.get_list_property("B") is not None:
             return "W"
-        elif "W" in self.properties:
+        elif self.get_list_property("W") is not None:
             return "B"
         else:  # only placements, find a parent node with a real move. TODO: better placement support
             return self.parent.next_player
@@ -366,7 +731,8 @@ class SGFNode:
     @property
     def player(self):
         """Returns player that moved last. nb root is considered white played if no handicap stones are placed"""
-        if "B" in self.properties or ("AB" in self.properties and "W" not in self.properties):
+        get = self.get_list_property
+        if get("B") is not None or (get("AB") is not None and get("W") is None):
             return "B"
         else:
             return "W"
@@ -410,15 +776,22 @@ class SGF:
 
     _NODE_CLASS = SGFNode  # Class used for SGF Nodes, can change this to something that inherits from SGFNode
     # https://xkcd.com/1171/
-    SGFPROP_PAT = re.compile(r"\s*(?:\(|\)|;|(\w+)((\s*\[([^\]\\]|\\.)*\])+))", flags=re.DOTALL)
+    SGFPROP_PAT = re.compile(r"\s*(?:\(|\)|;|(\w+)((?:\s*\[(?:[^\]\\]|\\.)*\])+))", flags=re.DOTALL)
+    SGF_CLOSE_AT_END_PAT = re.compile(r"\s*\)\s*\Z")
+    BRANCH_TOKEN_PAT = re.compile(r"[()]|\[(?:[^\]\\]|\\.)*\]", flags=re.DOTALL)  # skips over property values
     SGF_PAT = re.compile(r"\(;.*\)", flags=re.DOTALL)
+    GAME_START_PAT = re.compile(rb"\(\s*;")
+    GAME_TOKEN_PAT = re.compile(rb"[()]|\[(?:[^\]\\]|\\.)*\]", flags=re.DOTALL)  # skips over property values
 
     @classmethod
-    def parse_sgf(cls, input_str) -> SGFNode:
-        """Parse a string as SGF."""
+    def parse_sgf(cls, input_str, lazy=False, on_error=None) -> SGFNode:
+        """Parse a string as SGF. If lazy, only the main line of each variation is parsed up front,
+        and side variations are parsed when the `children` of the node they branch from are first accessed.
+        Side variations that fail to parse are then left out, and the error is passed to `on_error`, or raised
+        from that first access if it is not given."""
         match = re.search(cls.SGF_PAT, input_str)
         clipped_str = match.group() if match else input_str
-        root = cls(clipped_str).root
+        root = cls(clipped_str, lazy=lazy, on_error=on_error).root
         # Fix weird FoxGo server KM values
         if "foxwq" in root.get_list_property("AP", []):
             if int(root.get_property("HA", 0)) >= 1:
@@ -431,7 +804,7 @@ class SGF:
         return root
 
     @classmethod
-    def parse_file(cls, filename, encoding=None) -> SGFNode:
+    def parse_file(cls, filename, encoding=None, lazy=False, on_error=None) -> SGFNode:
         is_gib = filename.lower().endswith(".gib")
         is_ngf = filename.lower().endswith(".ngf")
 
@@ -439,30 +812,78 @@ class SGF:
         with open(filename, "rb") as f:
             bin_contents = f.read()
             if not encoding:
-                if is_gib or is_ngf or b"AP[foxwq]" in bin_contents:
+                if is_gib or is_ngf:
                     encoding = "utf8"
                 else:  # sgf
-                    match = re.search(rb"CA\[(.*?)\]", bin_contents)
-                    if match:
-                        encoding = match[1].decode("ascii", errors="ignore")
-                    else:
-                        encoding = chardet.detect(bin_contents[:300])["encoding"]
-                        # workaround for some compatibility issues for Windows-1252 and GB2312 encodings
-                        if encoding == "Windows-1252" or encoding == "GB2312":
-                            encoding = "GBK"
-            try:
-                decoded = bin_contents.decode(encoding=encoding, errors="ignore")
-            except LookupError:
-                decoded = bin_contents.decode(encoding=cls.DEFAULT_ENCODING, errors="ignore")
+                    encoding = cls._detect_encoding(bin_contents)
+            decoded = cls._decode(bin_contents, encoding)
             if is_ngf:
                 return cls.parse_ngf(decoded)
             if is_gib:
                 return cls.parse_gib(decoded)
             else:  # sgf
-                return cls.parse_sgf(decoded)
+                return cls.parse_sgf(decoded, lazy=lazy, on_error=on_error)
 
-    def __init__(self, contents):
+    @classmethod
+    def iter_games(cls, filename, encoding=None, lazy=False) -> Iterator[SGFNode]:
+        """Iterate over the games in an SGF collection file, yielding the parsed root of each game in turn.
+        The file is memory-mapped and game boundaries are found as the iteration proceeds, so only one game
+        is held in memory at a time. Encoding is detected per game if not given."""
+        with open(filename, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+                for start, end in cls._game_spans(contents):
+                    bin_contents = contents[start:end]
+                    decoded = cls._decode(bin_contents, encoding or cls._detect_encoding(bin_contents))
+                    yield cls.parse_sgf(decoded, lazy=lazy)
+
+    @classmethod
+    def _game_spans(cls, contents) -> Iterator[Tuple[int, int]]:
+        """Yields (start, end) offsets of each top level game tree in the bytes-like contents."""
+        ix = 0
+        while True:
+            game_start = cls.GAME_START_PAT.search(contents, ix)
+            if not game_start:
+                return
+            ix = game_start.end()
+            depth = 1
+            while depth:
+                token = cls.GAME_TOKEN_PAT.search(contents, ix)
+                if not token:  # unterminated, let the parser report on it
+                    yield game_start.start(), len(contents)
+                    return
+                ix = token.end()
+                if token[0] == b"(":
+                    depth += 1
+                elif token[0] == b")":
+                    depth -= 1
+            yield game_start.start(), ix
+
+    @classmethod
+    def _detect_encoding(cls, bin_contents) -> str:
+        if b"AP[foxwq]" in bin_contents:
+            return "utf8"
+        match = re.search(rb"CA\[(.*?)\]", bin_contents)
+        if match:
+            return match[1].decode("ascii", errors="ignore")
+        encoding = chardet.detect(bin_contents[:300])["encoding"]
+        # workaround for some compatibility issues for Windows-1252 and GB2312 encodings
+        if encoding == "Windows-1252" or encoding == "GB2312":
+            encoding = "GBK"
+        return encoding
+
+    @classmethod
+    def _decode(cls, bin_contents, encoding) -> str:
+        try:
+            return bin_contents.decode(encoding=encoding, errors="ignore")
+        except (LookupError, TypeError):
+            return bin_contents.decode(encoding=cls.DEFAULT_ENCODING, errors="ignore")
+
+    def __init__(self, contents, lazy=False, on_error=None):
         self.contents = contents
+        self.lazy = lazy
+        self.on_error = on_error
         try:
             self.ix = self.contents.index("(") + 1
         except ValueError:
@@ -471,30 +892,70 @@ class SGF:
         self._parse_branch(self.root)
 
     def _parse_branch(self, current_move: SGFNode):
-        while self.ix < len(self.contents):
-            match = re.match(self.SGFPROP_PAT, self.contents[self.ix :])
+        """Parses the remainder of the tree in a single pass. Tokens are matched in place at the current offset,
+        and variations are tracked on an explicit stack, so parsing is linear in the input size."""
+        contents = self.contents
+        end = len(contents)
+        branch_points = []  # nodes to return to when the current variation closes
+        while self.ix < end:
+            match = self.SGFPROP_PAT.match(contents, self.ix)
             if not match:
                 break
-            self.ix += len(match[0])
-            matched_item = match[0].strip()
-            if matched_item == ")":
-                return
-            if matched_item == "(":
-                self._parse_branch(self._NODE_CLASS(parent=current_move))
-            elif matched_item == ";":
-                # ignore ;) for old SGF
-                useless = self.ix < len(self.contents) and self.contents[self.ix :].strip() == ")"
-                # ignore ; that generate empty nodes
-                if not (current_move.empty or useless):
+            self.ix = match.end()
+            if match[1] is None:  # single character token
+                token = contents[self.ix - 1]
+                if token == ")":
+                    if not branch_points:
+                        return
+                    current_move = branch_points.pop()
+                elif token == "(":
+                    if self.lazy and current_move._children:  # side variation, main line is already parsed
+                        self._skip_variation(current_move)
+                        continue
+                    branch_points.append(current_move)
                     current_move = self._NODE_CLASS(parent=current_move)
+                else:  # ;
+                    # ignore ;) for old SGF
+                    useless = self.SGF_CLOSE_AT_END_PAT.match(contents, self.ix) is not None
+                    # ignore ; that generate empty nodes
+                    if not (current_move.empty or useless):
+                        current_move = self._NODE_CLASS(parent=current_move)
             else:
                 property, value = match[1], match[2].strip()[1:-1]
                 values = re.split(r"\]\s*\[", value)
                 current_move.add_list_property(property, [SGFNode._unescape_value(v) for v in values])
-        if self.ix < len(self.contents):
-            raise ParseError(f"Parse Error: unexpected character at {self.contents[self.ix:self.ix+25]}")
+        if self.ix < end:
+            raise ParseError(f"Parse Error: unexpected character at {contents[self.ix:self.ix+25]}")
         raise ParseError("Parse Error: expected ')' at end of input.")
 
+    def _skip_variation(self, parent: SGFNode):
+        """Records the variation starting at the current offset as unparsed on its parent, and skips past it."""
+        if parent._unparsed_branches is None:
+            parent._unparsed_branches = (self, [])
+        parent._unparsed_branches[1].append(self.ix)
+        depth = 1
+        while depth:
+            token = self.BRANCH_TOKEN_PAT.search(self.contents, self.ix)
+            if not token:
+                raise ParseError("Parse Error: expected ')' at end of input.")
+            self.ix = token.end()
+            if token[0] == "(":
+                depth += 1
+            elif token[0] == ")":
+                depth -= 1
+
+    def parse_variation(self, parent: SGFNode, ix: int):
+        """Parses a variation previously skipped by a lazy parse, starting just after its '('."""
+        self.ix = ix
+        self._parse_branch(self._NODE_CLASS(parent=parent))
+
+    def report_errors(self, errors: List[ParseError]):
+        """Reports errors in variations parsed after a lazy parse, raising the first if there is no `on_error`."""
+        if errors and self.on_error is None:
+            raise errors[0]
+        for error in errors:
+            self.on_error(error)
+
     # NGF parser adapted from https://github.com/fohristiwhirl/gofish/
     @classmethod
     def parse_ngf(cls, ngf):
@@ -1,10 +1,12 @@
 import heapq
+from array import array
 import math
 from pathlib import Path
 import random
 import struct
 import sys
-from typing import List, Tuple, TypeVar
+import threading
+from typing import Dict, List, Optional, Tuple, TypeVar
 
 import importlib.resources as pkg_resources
 
@@ -65,7 +67,14 @@ def pack_floats(float_list):
 def unpack_floats(str, num):
     if not str:
         return None
-    return struct.unpack(f"{num}e", str)
+    return compact_floats(struct.unpack(f"{num}e", str))
+
+
+def compact_floats(float_list):
+    """Ownership and policy as 32 bit floats, which take a sixth of the memory of a list of Python floats"""
+    if float_list is None:
+        return None
+    return array("f", float_list)
 
 
 def format_visits(n):
@@ -79,7 +88,7 @@ def format_visits(n):
 
 
 def json_truncate_arrays(data, lim=20):
-    if isinstance(data, list):
+    if isinstance(data, (list, array)):
         if data and isinstance(data[0], dict):
             return [json_truncate_arrays(d) for d in data]
         if len(data) > lim:
@@ -95,3 +104,25 @@ def weighted_selection_without_replacement(items: List[Tuple], pick_n: int) -> L
     """For a list of tuples where the second element is a weight, returns random items with those weights, without replacement."""
     elt = [(math.log(random.random()) / (item[1] + 1e-18), item) for item in items]  # magic
     return [e[1] for e in heapq.nlargest(pick_n, elt)]  # NB fine if too small
+
+
+class PendingUpdate:
+    """Merges update requests made while one is pending into a single request, OR-ing their flags."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flags = None
+
+    def request(self, **flags) -> bool:
+        """Returns True for the first request since the last `take`, which should be dispatched, False if merged."""
+        with self._lock:
+            pending = self._flags
+            merged = pending or {}
+            self._flags = {key: bool(merged.get(key) or flags.get(key)) for key in {*merged, *flags}}
+            return pending is None
+
+    def take(self) -> Optional[Dict]:
+        """Returns the merged flags of all requests since the last `take`, or None if there were none."""
+        with self._lock:
+            flags, self._flags = self._flags, None
+            return flags
@@ -27,8 +27,8 @@ class Graph(Widget):
     def initialize_from_game(self, root):
         self.nodes = [root]
         node = root
-        while node.children:
-            node = node.ordered_children[0]
+        while node.main_child:  # as loaded, without parsing variations left for later by a lazy load
+            node = node.main_child
             self.nodes.append(node)
         self.highlighted_index = 0
         self.redraw_trigger()
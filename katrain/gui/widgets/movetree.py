@@ -77,10 +77,10 @@ class MoveTreeCanvas(Widget):
                 via = [v for m, v in parent.shortcuts_to if m == selected_node]
                 selected_node.remove_shortcut()
                 if via:  # should always be
-                    parent.children.remove(via[0])
+                    parent.children = [c for c in parent.children if c is not via[0]]
             else:
                 parent = selected_node.parent
-                parent.children.remove(selected_node)
+                parent.children = [c for c in parent.children if c is not selected_node]
             self.set_game_node(parent)
         self.is_open = False
 
@@ -99,8 +99,7 @@ class MoveTreeCanvas(Widget):
         if selected_node and selected_node.parent:
             node = selected_node
             while node.parent is not None:
-                node.parent.children.remove(node)
-                node.parent.children.insert(0, node)
+                node.parent.children = [node] + [c for c in node.parent.children if c is not node]
                 node = node.parent
             self.set_game_node(selected_node)
         self.is_open = False
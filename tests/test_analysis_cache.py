@@ -0,0 +1,158 @@
+import pytest
+
+from katrain.core.analysis_cache import AnalysisCache
+from katrain.core.board_state import BoardState
+from katrain.core.engine import KataGoEngine
+from katrain.core.game_node import GameNode
+from katrain.core.sgf_parser import Move
+
+
+def branch(moves, size=19, komi=6.5):
+    node = GameNode(properties={"SZ": size, "KM": komi, "RU": "japanese"})
+    for i, coords in enumerate(moves):
+        node = node.play(Move(coords, player="BW"[i % 2]))
+    return node
+
+
+def mock_analysis(node, visits, move, ownership_point=None):
+    szx, szy = node.board_size
+    ownership = None
+    if ownership_point is not None:
+        ownership = [0.0] * (szx * szy)
+        x, y = ownership_point
+        ownership[(szy - 1 - y) * szx + x] = 1.0  # arrays start at the top row
+    return {
+        "id": "QUERY:1",
+        "moveInfos": [{"move": move.gtp(), "order": 0, "visits": visits, "pv": [move.gtp(), "pass"]}],
+        "rootInfo": {"visits": visits, "winrate": 0.6, "scoreLead": 2.5},
+        "ownership": ownership,
+    }
+
+
+class MockEngine:
+    requested_visits = KataGoEngine.requested_visits
+
+    def __init__(self, cache):
+        self.analysis_cache = cache
+        self.config = {"max_visits": 100, "fast_visits": 10, "_enable_ownership": False}
+        self.katrain = None
+        self.requests = []
+
+    def analysis_settings(self):
+        return {"wideRootNoise": 0.0}
+
+    def request_analysis(self, node, callback, **kwargs):
+        self.requests.append((node, callback))
+
+
+def wait_for_lookups(cache):
+    cache.submit(lambda: None).result()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = AnalysisCache(str(tmp_path / "analysis.sqlite"), max_bytes=1024 * 1024)
+    yield cache
+    cache.close()
+
+
+class TestAnalysisCache:
+    def test_canonical_hash_symmetries(self):
+        moves = [(3, 3), (15, 16), (2, 13), (16, 2)]
+        hashes = set()
+        for permutation in BoardState.symmetries(19, 19):
+            node = branch([(permutation[y * 19 + x] % 19, permutation[y * 19 + x] // 19) for x, y in moves])
+            hashes.add(node.canonical_position_hash()[0])
+        assert len(hashes) == 1
+        assert branch(moves).canonical_position_hash()[0] != branch(moves[:3]).canonical_position_hash()[0]
+        assert len(BoardState.symmetries(9, 13)) == 4
+
+    def test_keys_without_replaying(self, cache, monkeypatch):
+        root = GameNode(properties={"SZ": 19, "RU": "japanese"})
+        node = root
+        for i in range(60):
+            node = node.play(Move((i % 19, 2 * (i // 19)), player="BW"[i % 2]))
+        root.compute_position_hashes()
+        expected = [n.canonical_position_hash() for n in root.nodes_in_tree]
+
+        def replay_board(node):
+            raise AssertionError("replayed")
+
+        monkeypatch.setattr(GameNode, "replay_board", replay_board)
+        assert [cache.key(n)[1] for n in root.nodes_in_tree] == [symmetry for _, symmetry in expected]
+        monkeypatch.undo()
+        for n in root.nodes_in_tree:
+            n._position_hashes = None
+        assert [n.canonical_position_hash() for n in root.nodes_in_tree] == expected  # same when replayed per branch
+
+    def test_symmetric_hit(self, cache):
+        node = branch([(3, 3), (15, 16)])
+        mirrored = branch([(15, 3), (3, 16)])
+        cache.put(node, mock_analysis(node, 200, Move((2, 15)), ownership_point=(3, 3)))
+        result = cache.get(mirrored, visits=100, ownership=True)
+        assert result["moveInfos"][0]["move"] == Move((16, 15)).gtp()
+        assert result["moveInfos"][0]["pv"] == [Move((16, 15)).gtp(), "pass"]
+        assert result["ownership"][(18 - 3) * 19 + 15] == 1.0
+        assert sum(result["ownership"]) == 1.0
+        assert result["rootInfo"]["visits"] == 200
+        assert (cache.hits, cache.misses) == (1, 0)
+
+    def test_visits_and_ownership(self, cache):
+        node = branch([(3, 3)])
+        assert cache.get(node, visits=10) is None
+        cache.put(node, mock_analysis(node, 100, Move((15, 15))))
+        assert cache.get(node, visits=100) is not None
+        assert cache.get(node, visits=101) is None
+        assert cache.get(node, visits=10, ownership=True) is None
+        cache.put(node, mock_analysis(node, 50, Move((3, 15))))  # fewer visits does not replace
+        assert cache.get(node, visits=10)["moveInfos"][0]["move"] == Move((15, 15)).gtp()
+        assert cache.get(branch([(3, 3)], komi=7.5), visits=10) is None
+        assert cache.get(node, visits=10, settings={"wideRootNoise": 0.04}) is None
+        assert (cache.hits, cache.misses) == (2, 5)
+
+        cut_short = branch([(9, 9)])
+        cache.put(cut_short, mock_analysis(cut_short, 30, Move((3, 3))))  # e.g. stopped by maxTime at 30 of 100 visits
+        assert cache.get(cut_short, visits=30) is not None
+        assert cache.get(cut_short, visits=100) is None
+
+    def test_eviction_and_persistence(self, tmp_path):
+        filename = str(tmp_path / "analysis.sqlite")
+        cache = AnalysisCache(filename, max_bytes=1024 * 1024)
+        nodes = [branch([(x, 0)]) for x in range(10)]  # distinct up to symmetry
+        for i, node in enumerate(nodes):
+            cache.put(node, mock_analysis(node, 10, Move((9, 9)), ownership_point=(9, 9)))
+            cache.get(nodes[0], visits=10)  # recently used
+            if i == 0:
+                cache.max_bytes = 4 * cache.num_bytes
+        assert cache.num_bytes <= cache.max_bytes
+        assert 1 < len(cache) < len(nodes)
+        assert cache.get(nodes[0], visits=10) is not None
+        assert cache.get(nodes[1], visits=10) is None
+        cache.close()
+
+        reopened = AnalysisCache(filename, max_bytes=cache.max_bytes)
+        assert reopened.get(nodes[0], visits=10) is not None
+        assert reopened.num_bytes == cache.num_bytes
+        reopened.close()
+
+    def test_analyze_uses_cache(self, cache):
+        engine = MockEngine(cache)
+        node = branch([(3, 3), (15, 15)])
+        node.analyze(engine)
+        wait_for_lookups(cache)
+        assert len(engine.requests) == 1
+        engine.requests[0][1](mock_analysis(node, 50, Move((15, 3))), True)  # partial results are not stored
+        assert cache.get(node, visits=1) is None
+        engine.requests[0][1](mock_analysis(node, 100, Move((15, 3))), False)
+        assert node.analysis_exists
+
+        other_player = branch([(3, 3), (15, 15), None])  # same stones, white to move
+        other_player.analyze(engine)
+        wait_for_lookups(cache)
+        assert len(engine.requests) == 2
+        rotated = branch([(3, 15), (15, 3)])
+        rotated.analyze(engine, analyze_fast=True)
+        wait_for_lookups(cache)
+        assert len(engine.requests) == 2
+        assert rotated.analysis_exists
+        assert list(rotated.analysis["moves"]) == [Move((15, 15)).gtp()]
@@ -0,0 +1,63 @@
+import os
+
+from katrain.core.base_katrain import KaTrainBase
+from katrain.core.batch_analysis import PARTIAL_SUFFIX, BatchAnalysis, output_filename
+from katrain.core.engine import KataGoEngine, QueryQueue
+from katrain.core.sgf_parser import SGF
+
+
+class InstantEngine:
+    """Answers every query immediately."""
+
+    requested_visits = KataGoEngine.requested_visits
+
+    def __init__(self):
+        self.config = {"max_visits": 10, "_enable_ownership": False}
+        self.queries = {}
+        self.write_queue = QueryQueue()
+        self.num_requests = 0
+
+    def request_analysis(self, analysis_node, callback, **kwargs):
+        self.num_requests += 1
+        analysis_node.analysis_visits_requested = 10
+        callback({"rootInfo": {"visits": 10, "winrate": 0.5, "scoreLead": 0.5}, "moveInfos": []}, False)
+
+
+def copy_game(tmp_path, name):
+    with open(os.path.join("tests", "data", name), encoding="utf-8") as f:
+        sgf = f.read()
+    filename = os.path.join(tmp_path, "games", name)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write(sgf)
+    return filename
+
+
+def test_output_filename():
+    assert output_filename("/games/2024/a.gib", "/games", "out") == os.path.join("out", "2024", "a.sgf")
+
+
+def test_analyzes_and_resumes(tmp_path):
+    katrain = KaTrainBase(force_package_config=True, debug_level=0)
+    filenames = [copy_game(tmp_path, "ogs.sgf"), copy_game(tmp_path, "panda1.sgf")]
+    output_dir = os.path.join(tmp_path, "out")
+    engine = InstantEngine()
+    batch = BatchAnalysis(katrain, engine, filenames, output_dir, max_games=1)
+    assert batch.run(poll_interval=0.1) == 0
+    assert batch.num_games == 2 and batch.num_positions == engine.num_requests
+    assert batch.num_visits == 10 * batch.num_positions
+
+    output = os.path.join(output_dir, "ogs.sgf")
+    root = SGF.parse_file(output)
+    assert all(node.get_list_property("KT") for node in root.nodes_in_tree)
+    assert not os.path.exists(output + PARTIAL_SUFFIX)
+
+    batch = BatchAnalysis(katrain, engine, filenames, output_dir)  # done before
+    assert not batch.todo
+
+    os.remove(output)
+    os.rename(os.path.join(output_dir, "panda1.sgf"), output + PARTIAL_SUFFIX)  # as if interrupted
+    engine.num_requests = 0
+    batch = BatchAnalysis(katrain, engine, filenames[:1], output_dir)
+    assert batch.run(poll_interval=0.1) == 0
+    assert engine.num_requests == 0  # all positions loaded from the checkpoint
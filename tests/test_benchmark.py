@@ -0,0 +1,156 @@
+"""Benchmarks of the analysis pipeline against the fake KataGo, run with KATRAIN_BENCHMARK=1 and pytest -s to see results.
+
+They measure query throughput and end-to-end latency of engine.py, memory used by analysis stored in game_node.py,
+and how much GUI update work arrives at the message loop, all without KataGo or a GPU.
+"""
+
+import os
+import statistics
+import threading
+import time
+import tracemalloc
+
+import pytest
+
+from katrain.core.base_katrain import KaTrainBase
+from katrain.core.engine import KataGoEngine
+from katrain.core.fake_katago import fake_katago_command
+from katrain.core.game import Game
+from katrain.core.game_node import GameNode
+from katrain.core.sgf_parser import Move
+from katrain.core.utils import PendingUpdate
+
+pytestmark = pytest.mark.skipif(not os.environ.get("KATRAIN_BENCHMARK"), reason="slow benchmark")
+
+
+class CountingKaTrain(KaTrainBase):
+    """Counts update_state calls, and the messages for the GUI message loop they are merged into, as the GUI does."""
+
+    def __init__(self):
+        super().__init__(force_package_config=True, debug_level=0)
+        self.num_updates = 0
+        self.num_messages = 0
+        self.pending_update = PendingUpdate()
+
+    def update_state(self, redraw_board=False):
+        self.num_updates += 1
+        if self.pending_update.request(redraw_board=redraw_board):
+            self.num_messages += 1
+
+    def message_loop(self, stop, frame_time=1 / 60):
+        while not stop.is_set():
+            self.pending_update.take()
+            time.sleep(frame_time)  # as if refreshing the GUI
+
+
+def fake_engine(katrain, **options):
+    config = {
+        **katrain.config("engine"),
+        "backend": "custom",
+        "altcommand": fake_katago_command(**options),
+        "analysis_cache_mb": 0,
+        "max_queries_in_flight": 64,
+    }
+    return KataGoEngine(katrain, config)
+
+
+def game_nodes(num_moves, size=19):
+    nodes = [GameNode(properties={"SZ": size})]
+    for i in range(num_moves):
+        nodes.append(nodes[-1].play(Move((i % size, (i // size) % size), player="BW"[i % 2])))
+    return nodes
+
+
+def wait_until(condition, timeout=300):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.001)
+    return condition()
+
+
+def test_query_throughput():
+    katrain = CountingKaTrain()
+    engine = fake_engine(katrain, threads=4)
+    nodes = game_nodes(2000)
+    done = []
+    try:
+        start = time.perf_counter()
+        for node in nodes:
+            engine.request_analysis(node, lambda analysis, partial: done.append(1), visits=10)
+        assert wait_until(lambda: len(done) == len(nodes))
+        seconds = time.perf_counter() - start
+        metrics = list(engine.callback_dispatcher.callback_metrics().values())[0]
+    finally:
+        engine.shutdown(finish=False)
+    print(f"Throughput: {len(nodes)} queries in {seconds:.2f}s, {len(nodes) / seconds:.0f} queries/s")
+    print(f"Message loop: {katrain.num_updates / len(nodes):.2f} update_state calls per result")
+    print(
+        f"Callbacks: {1000 * metrics['mean_time']:.3f}ms mean, waited {1000 * metrics['mean_wait']:.2f}ms in the queue"
+    )
+
+
+def test_latency():
+    katrain = CountingKaTrain()
+    latency = 0.005
+    engine = fake_engine(katrain, latency=latency, threads=1)
+    timings = []
+    try:
+        for node in game_nodes(200):
+            received = threading.Event()
+            start = time.perf_counter()
+            engine.request_analysis(node, lambda analysis, partial: received.set(), visits=10)
+            assert received.wait(timeout=10)
+            timings.append(time.perf_counter() - start - latency)
+    finally:
+        engine.shutdown(finish=False)
+    timings.sort()
+    print(
+        f"Latency overhead: median {1000 * statistics.median(timings):.2f}ms, "
+        f"95th percentile {1000 * timings[int(0.95 * len(timings))]:.2f}ms"
+    )
+
+
+def test_analysis_memory():
+    katrain = CountingKaTrain()
+    engine = fake_engine(katrain, threads=4)
+    nodes = game_nodes(300)
+    try:
+        tracemalloc.start()
+        Game(katrain, engine, move_tree=nodes[0])
+        assert wait_until(lambda: all(node.analysis_complete for node in nodes))
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        engine.shutdown(finish=False)
+    print(
+        f"Memory: {current / len(nodes) / 1024:.1f} KB per analyzed node, peak {peak / 1e6:.1f} MB "
+        f"for {len(nodes)} nodes with ownership and policy"
+    )
+
+
+def test_pondering_load():
+    katrain = CountingKaTrain()
+    engine = fake_engine(katrain, visits_per_second=2000, threads=8)
+    nodes = game_nodes(64)
+    results = []
+    stop = threading.Event()
+    threading.Thread(target=katrain.message_loop, args=(stop,), daemon=True).start()
+    try:
+        start = time.perf_counter()
+        for node in nodes:
+            engine.request_analysis(
+                node,
+                lambda analysis, partial: results.append(partial),
+                visits=1000,
+                time_limit=False,
+                report_every=0.05,
+            )
+        assert wait_until(lambda: results.count(False) == len(nodes))
+        seconds = time.perf_counter() - start
+    finally:
+        stop.set()
+        engine.shutdown(finish=False)
+    print(
+        f"Partial results: {len(results)} in {seconds:.2f}s, {katrain.num_updates} update_state calls "
+        f"merged into {katrain.num_messages} messages, {katrain.num_messages / seconds:.0f} per second"
+    )
@@ -1,8 +1,12 @@
+import os
+import random
+
 import pytest
 
 from katrain.core.base_katrain import KaTrainBase
+from katrain.core.board_state import BoardState
 from katrain.core.engine import BaseEngine
-from katrain.core.game import Game, IllegalMoveException, Move, KaTrainSGF
+from katrain.core.game import BoardSnapshotCache, Game, IllegalMoveException, Move, KaTrainSGF
 from katrain.core.game_node import GameNode
 
 
@@ -140,3 +144,146 @@ class TestBoard:
                     b.play(Move.from_gtp("B19", player="W"))
                 assert 4 == len(b.stones)
                 assert 0 == len(b.prisoners)
+
+    def test_board_snapshot_cache(self):
+        file = os.path.join(os.path.dirname(__file__), "data/LS vs AG - G4 - English.sgf")
+        game = Game(MockKaTrain(force_package_config=True), MockEngine(), move_tree=KaTrainSGF.parse_file(file))
+        nodes = list(game.root.nodes_in_tree)
+        replayed = []
+        validate_move = game._validate_move_and_update_chains
+        game._validate_move_and_update_chains = lambda move, ignore_ko: replayed.append(move) or validate_move(
+            move, ignore_ko
+        )
+
+        def state():
+            return game.board, game.chains, game.prisoners, game.last_capture
+
+        random.seed(0)
+        for node in random.sample(nodes, 50) + nodes[::-1]:
+            game.set_current_node(node)
+            cached_state = state()
+            game._board_cache = BoardSnapshotCache(max_bytes=0)
+            game.set_current_node(node)
+            assert cached_state == state()
+            game._board_cache = cache = BoardSnapshotCache(max_bytes=1024 * 1024)
+
+        deepest = max(nodes, key=lambda n: n.depth)
+        game.set_current_node(deepest)
+        replayed.clear()
+        for node in deepest.nodes_from_root[::-1]:  # undo all the way, each step is a short replay
+            game.set_current_node(node)
+            assert len(replayed) <= BoardSnapshotCache.SNAPSHOT_INTERVAL
+            replayed.clear()
+        assert 0 < cache.num_bytes <= cache.max_bytes
+
+        game.set_current_node(deepest.parent)
+        deepest.parent.set_property("AB", ["aa"])  # changes all positions below
+        game.set_current_node(deepest)
+        assert "B" == game.chains[game.board[18][0]][0].player
+
+    @pytest.mark.parametrize("board_size", [(9, 9), (19, 19), (7, 13), (52, 52)])
+    def test_board_state_matches_flood_fill(self, board_size):
+        width, height = board_size
+
+        def reference_play(stones, move):  # straightforward flood fill implementation, suicide allowed
+            stones = {**stones, move.coords: move.player}
+
+            def chain_and_liberties(coords):
+                chain, liberties, stack = {coords}, set(), [coords]
+                while stack:
+                    x, y = stack.pop()
+                    for nb in [(x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)]:
+                        if 0 <= nb[0] < width and 0 <= nb[1] < height:
+                            if nb not in stones:
+                                liberties.add(nb)
+                            elif stones[nb] == stones[coords] and nb not in chain:
+                                chain.add(nb)
+                                stack.append(nb)
+                return chain, liberties
+
+            x, y = move.coords
+            captured = set()
+            for nb in [(x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)]:
+                if stones.get(nb, move.player) != move.player:
+                    chain, liberties = chain_and_liberties(nb)
+                    if not liberties:
+                        captured |= chain
+            if not captured:
+                chain, liberties = chain_and_liberties(move.coords)
+                if not liberties:
+                    captured = chain
+            return {c: p for c, p in stones.items() if c not in captured}, len(captured)
+
+        state = BoardState(board_size)
+        stones, num_prisoners = {}, 0
+        rng = random.Random(sum(board_size))
+        for _ in range(3 * width * height):
+            move = Move((rng.randrange(width), rng.randrange(height)), player=rng.choice("BW"))
+            if move.coords in stones:
+                with pytest.raises(IllegalMoveException, match="Space occupied"):
+                    state.play(move)
+                continue
+            expected_stones, num_captured = reference_play(stones, move)
+            if move.coords not in expected_stones and num_captured == 1:
+                with pytest.raises(IllegalMoveException, match="Single stone suicide"):
+                    state.play(move, ignore_ko=True, suicide_allowed=True)
+                continue
+            state.play(move, ignore_ko=True, suicide_allowed=True)
+            stones, num_prisoners = expected_stones, num_prisoners + num_captured
+            assert stones == {m.coords: m.player for m in state.stones()}
+            assert num_prisoners == len(state.prisoners)
+
+        board, chains = state.chain_view()
+        assert sorted(stones.items()) == sorted((m.coords, m.player) for c in chains for m in c)
+        assert all(board[m.coords[1]][m.coords[0]] == c for c, chain in enumerate(chains) for m in chain)
+        replayed = BoardState(board_size)
+        for move in state.stones():
+            replayed.play(move)
+        assert replayed.zobrist == state.zobrist
+
+    def test_position_hash(self):
+        def play_moves(root, moves):
+            game = Game(MockKaTrain(force_package_config=True), MockEngine(), move_tree=root)
+            for gtp in moves:
+                game.play(Move.from_gtp(gtp, player=game.current_node.next_player))
+            return game.current_node
+
+        root = GameNode(properties={"SZ": 19, "RU": "japanese"})
+        node = play_moves(root, ["D4", "Q16", "Q4"])
+        transposed = play_moves(root, ["Q4", "Q16", "D4"])
+        assert node is not transposed
+        assert node.position_hash == transposed.position_hash
+        assert node.parent.position_hash != transposed.parent.position_hash
+        assert node.position_hash != play_moves(root, ["D4", "Q16", "Q4", "pass", "pass"]).parent.position_hash
+
+        ko = play_moves(root, ["A2", "B2", "B1", "C1", "pass", "A1"])  # white captures, black can not retake
+        no_ko = play_moves(root, ["A2", "B2", "B1", "C1", "pass", "A1", "pass", "pass"])
+        assert ko.position_hash != no_ko.position_hash  # same stones and player to move, but the ko is gone
+
+        same_rules = play_moves(GameNode(properties={"SZ": 19, "RU": "jp"}), ["D4", "Q16", "Q4"])
+        other_rules = play_moves(GameNode(properties={"SZ": 19, "RU": "chinese"}), ["D4", "Q16", "Q4"])
+        assert node.position_hash == same_rules.position_hash
+        assert node.position_hash != other_rules.position_hash
+
+        # computed without a game, and kept up to date when placements change
+        loaded = KaTrainSGF.parse_sgf(root.sgf())
+        assert [n.position_hash for n in root.nodes_in_tree] == [n.position_hash for n in loaded.nodes_in_tree]
+        placed = loaded.children[0]
+        before = [n.position_hash for n in placed.nodes_in_tree]
+        placed.set_property("AW", ["aa"])
+        after = [n.position_hash for n in placed.nodes_in_tree]
+        assert all(b != a for b, a in zip(before, after))
+        assert loaded.position_hash == root.position_hash
+
+    def test_position_hash_of_setup_and_markup_nodes(self):
+        sgf = "(;GM[1]FF[4]SZ[19];B[dd];LB[dd:A];AB[pp];W[dp];C[markup only])"
+        assert [n.depth for n in KaTrainSGF.parse_sgf(sgf).nodes_in_tree] == [0, 1, 1, 1, 2, 2]
+        hashes, num_stones = [], []
+        for i in range(6):  # each from a fresh tree, so the branch up to it is replayed
+            node = KaTrainSGF.parse_sgf(sgf).nodes_in_tree[i]
+            hashes.append(node.position_hash)
+            num_stones.append(len(list(node.replay_board().stones())))
+        assert num_stones == [0, 1, 1, 2, 3, 3]
+        assert hashes[1] == hashes[2] != hashes[3]
+        assert hashes[4] == hashes[5]
+        assert hashes == [n.position_hash for n in KaTrainSGF.parse_sgf(sgf).nodes_in_tree]
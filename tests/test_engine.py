@@ -0,0 +1,284 @@
+import json
+import threading
+import time
+
+from katrain.core.base_katrain import KaTrainBase
+from katrain.core.constants import PRIORITY_GAME_ANALYSIS
+from katrain.core.engine import CallbackDispatcher, KataGoEngine
+from katrain.core.fake_katago import fake_katago_command
+from katrain.core.game import Game
+from katrain.core.game_node import GameNode
+from katrain.core.sgf_parser import Move
+
+
+def fake_engine(tmp_path, **config):
+    katrain = KaTrainBase(force_package_config=True, debug_level=0)
+    queries_log = tmp_path / "queries.jsonl"
+    queries_log.touch()
+    command = fake_katago_command(latency=0.01, threads=1, log=queries_log)
+    config = {**katrain.config("engine"), "backend": "custom", "altcommand": command, "analysis_cache_mb": 0, **config}
+    return KataGoEngine(katrain, config), queries_log
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_duplicate_queries_are_coalesced(tmp_path):
+    engine, queries_log = fake_engine(tmp_path)
+    nodes = [GameNode(properties={"SZ": 19})]
+    for i in range(5):
+        nodes.append(nodes[-1].play(Move((i, 3), player="BW"[i % 2])))
+    results = []
+    try:
+        for _ in range(3):  # e.g. analyze_all_nodes, navigation and a restart all asking for the same nodes
+            for node in nodes:
+                engine.request_analysis(node, lambda analysis, partial: results.append(analysis["turnNumber"]))
+        assert wait_until(lambda: len(results) == 3 * len(nodes))
+        assert sorted(results) == sorted(list(range(len(nodes))) * 3)
+        num_sent = len(queries_log.read_text().splitlines())
+        assert num_sent == len(nodes) < len(results)
+        assert engine.num_duplicate_queries == 2 * len(nodes)
+        assert wait_until(lambda: not engine.in_flight)
+
+        engine.request_analysis(nodes[0], lambda analysis, partial: results.append(analysis["turnNumber"]))
+        assert wait_until(lambda: len(results) == 3 * len(nodes) + 1)  # finished queries are sent again
+    finally:
+        engine.shutdown(finish=True)
+
+
+def test_duplicate_raises_priority(tmp_path):
+    engine, queries_log = fake_engine(tmp_path)
+    node = GameNode(properties={"SZ": 19})
+    query_ids = []
+    try:
+        with engine.thread_lock:  # hold the query before it is sent
+            engine.request_analysis(node, lambda analysis, partial: query_ids.append(analysis["id"]))
+            engine.request_analysis(node, lambda analysis, partial: query_ids.append(analysis["id"]), priority=100)
+        assert wait_until(lambda: len(query_ids) == 2)
+        assert query_ids[0] == query_ids[1]  # both answered by the query sent with the higher priority
+        assert [json.loads(line)["priority"] for line in queries_log.read_text().splitlines()] == [100]
+    finally:
+        engine.shutdown(finish=True)
+
+
+def test_branch_analysis(tmp_path):
+    engine, queries_log = fake_engine(tmp_path)
+    root = GameNode(properties={"SZ": 19})
+    main = [root]
+    for i in range(6):
+        main.append(main[-1].play(Move((i, 3), player="BW"[i % 2])))
+    main[2].add_list_property("AB", ["aa"])  # nodes above it can not share the branch's initial stones
+    variation = [main[3].play(Move((10, 10), player="W"))]
+    variation.append(variation[-1].play(Move((11, 10), player="B")))
+    try:
+        Game(KaTrainBase(force_package_config=True, debug_level=0), engine, move_tree=root)
+        assert wait_until(lambda: all(node.analysis_exists for node in main + variation) and engine.is_idle())
+        queries = [json.loads(line) for line in queries_log.read_text().splitlines()]
+        assert sorted(query["analyzeTurns"] for query in queries) == [[0], [1], [2, 3, 4, 5, 6], [4, 5]]
+        assert not engine.turns_remaining
+    finally:
+        engine.shutdown(finish=True)
+
+
+def test_query_window(tmp_path):
+    engine, queries_log = fake_engine(tmp_path, max_queries_in_flight=1)
+    nodes = [GameNode(properties={"SZ": 19})]
+    for i in range(5):
+        nodes.append(nodes[-1].play(Move((i, 3), player="BW"[i % 2])))
+    results = []
+    try:
+        with engine.thread_lock:  # the first query is taken from the queue, the rest wait for its results
+            for node in nodes[:-1]:
+                engine.request_analysis(
+                    node,
+                    lambda analysis, partial: results.append(analysis["turnNumber"]),
+                    priority=PRIORITY_GAME_ANALYSIS - 1,
+                )
+                assert wait_until(lambda: engine.write_queue.qsize() <= node.depth)  # the root's query is taken
+            engine.request_analysis(
+                nodes[-1],
+                lambda analysis, partial: results.append(analysis["turnNumber"]),
+                priority=PRIORITY_GAME_ANALYSIS,
+            )
+            assert engine.write_queue.qsize() == len(nodes) - 1
+            engine.terminate_queries(only_for_node=nodes[2], lock=False)  # not sent yet, so just dropped
+        assert wait_until(lambda: len(results) == len(nodes) - 1 and engine.is_idle())
+        assert results == [0, 5, 1, 3, 4]
+        assert [len(json.loads(line)["moves"]) for line in queries_log.read_text().splitlines()] == results
+        assert not engine.in_flight
+    finally:
+        engine.shutdown(finish=True)
+
+
+def test_urgent_queries_skip_the_window(tmp_path):
+    engine, queries_log = fake_engine(tmp_path, max_queries_in_flight=4)
+    nodes = [GameNode(properties={"SZ": 19})]
+    for i in range(40):
+        nodes.append(nodes[-1].play(Move((i % 19, 2 * (i // 19)), player="BW"[i % 2])))
+    branch_results, move_results = [], []
+    try:
+        engine.request_branch_analysis(  # fills the window with its turns
+            nodes,
+            lambda node, analysis, partial: branch_results.append(partial),
+            priority=PRIORITY_GAME_ANALYSIS,
+        )
+        engine.request_analysis(
+            nodes[5], lambda analysis, partial: None, priority=PRIORITY_GAME_ANALYSIS
+        )  # waits for capacity
+        assert wait_until(lambda: len(queries_log.read_text().splitlines()) == 1)
+        engine.request_analysis(nodes[-1], lambda analysis, partial: move_results.append(partial), priority=1000)
+        assert wait_until(lambda: len(queries_log.read_text().splitlines()) == 2)
+        assert json.loads(queries_log.read_text().splitlines()[1])["priority"] == 1000
+        assert engine.write_queue.qsize() == 1
+        assert wait_until(lambda: move_results and branch_results.count(False) < len(nodes))
+    finally:
+        engine.shutdown(finish=False)
+
+
+def test_analysis_near_current_node_first(tmp_path):
+    engine, queries_log = fake_engine(tmp_path, max_queries_in_flight=1)
+    root = GameNode(properties={"SZ": 19})
+    main = [root]
+    for i in range(30):
+        main.append(main[-1].play(Move((i % 19, i // 19), player="BW"[i % 2])))
+    variations = {}
+    for depth in [5, 15, 25]:
+        variations[depth] = main[depth].play(Move((18, 18), player="BW"[depth % 2]))
+        variations[depth] = variations[depth].play(Move((17, 18), player="WB"[depth % 2]))
+    try:
+        with engine.thread_lock:
+            game = Game(KaTrainBase(force_package_config=True, debug_level=0), engine, move_tree=root)
+            assert wait_until(lambda: engine.write_queue.qsize() == 5)  # the main line's first run was taken already
+            time.sleep(0.1)
+            game.set_current_node(variations[25])
+        assert wait_until(lambda: engine.is_idle() and all(node.analysis_exists for node in variations.values()))
+        queries = [json.loads(line) for line in queries_log.read_text().splitlines()]
+        assert [query["analyzeTurns"] for query in queries] == [
+            list(range(11)),
+            [26, 27],
+            list(range(11, 21)),
+            list(range(21, 31)),
+            [6, 7],
+            [16, 17],
+        ]
+    finally:
+        engine.shutdown(finish=True)
+
+
+def test_jumping_splits_the_branch_query(tmp_path, monkeypatch):
+    engine, queries_log = fake_engine(tmp_path, max_queries_in_flight=1)
+    main = [GameNode(properties={"SZ": 19})]
+    for i in range(120):
+        main.append(main[-1].play(Move((i % 19, 2 * (i // 19) % 19), player="BW"[i % 2])))
+    assert [[n.depth for n in run][::9] for run in Game.runs_around(main[41:81], 70)] == [[60, 69, 78], [50, 59], [41]]
+    analyzed = []
+    set_analysis = GameNode.set_analysis
+
+    def recording_set_analysis(node, *args, **kwargs):
+        set_analysis(node, *args, **kwargs)
+        if node.analysis_complete and node.depth not in analyzed:
+            analyzed.append(node.depth)
+
+    monkeypatch.setattr(GameNode, "set_analysis", recording_set_analysis)
+    try:
+        game = Game(KaTrainBase(force_package_config=True, debug_level=0), engine, move_tree=main[0])
+        assert wait_until(lambda: engine.write_queue.qsize() == 4)  # runs up to 20, 40, 80 and 160 moves from the root
+        game.set_current_node(main[70])
+        assert wait_until(lambda: engine.is_idle() and all(node.analysis_complete for node in main), timeout=30)
+        assert analyzed.index(70) < analyzed.index(45) and analyzed.index(70) < analyzed.index(90)
+        queries = [json.loads(line) for line in queries_log.read_text().splitlines()]
+        assert [q["analyzeTurns"][0] for q in queries if 70 in q.get("analyzeTurns", [])][-1] == 60
+    finally:
+        engine.shutdown(finish=True)
+
+
+class ReprioritizeCounter:
+    def __init__(self):
+        self.queued = True
+        self.num_reprioritized = 0
+
+    def request_analysis(self, *args, **kwargs):
+        pass
+
+    def has_pending_queries(self):
+        return self.queued
+
+    def reprioritize_queries(self, priority_fn):
+        self.num_reprioritized += 1
+
+
+def test_navigation_reprioritizes_at_most_once_per_interval():
+    engine = ReprioritizeCounter()
+    nodes = [GameNode(properties={"SZ": 19})]
+    for i in range(30):
+        nodes.append(nodes[-1].play(Move((i, 3), player="BW"[i % 2])))
+    game = Game(KaTrainBase(force_package_config=True, debug_level=0), engine, move_tree=nodes[0])
+    assert wait_until(lambda: engine.num_reprioritized == 1)  # after queueing analysis of all nodes
+    for node in nodes:  # e.g. holding an arrow key
+        game.set_current_node(node)
+    assert engine.num_reprioritized == 2
+    assert wait_until(lambda: engine.num_reprioritized == 3)  # once more for where it stopped
+    time.sleep(2 * game.PRIORITIZE_INTERVAL)
+    assert engine.num_reprioritized == 3
+
+    engine.queued = False  # nothing left to re-prioritize
+    game.set_current_node(nodes[0])
+    assert engine.num_reprioritized == 3
+
+
+def test_callback_dispatcher():
+    engine = KataGoEngine.__new__(KataGoEngine)  # only its katrain is used
+    engine.katrain = KaTrainBase(force_package_config=True, debug_level=0)
+    dispatcher = CallbackDispatcher(engine, num_threads=2)
+    blocked, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow_callback(analysis, partial):
+        blocked.set()
+        release.wait(timeout=10)
+        calls.append(("A", analysis))
+
+    def callback(analysis, partial):
+        calls.append((partial, analysis))
+
+    dispatcher.dispatch("A", "Q1", slow_callback, 0, False)
+    assert blocked.wait(timeout=10)
+    for i in range(1, 4):  # queued behind the slow callback for the same node
+        dispatcher.dispatch("A", "Q1", callback, i, True, partial=True)
+    dispatcher.dispatch("A", "Q1", callback, 4, False)
+    dispatcher.dispatch("B", "Q2", callback, 5, False)  # not held up by another node
+    assert wait_until(lambda: (False, 5) in calls)
+    assert dispatcher.qsize() == 2 and dispatcher.num_superseded == 2
+    release.set()
+    assert wait_until(dispatcher.is_idle)
+    assert calls == [(False, 5), ("A", 0), (True, 3), (False, 4)]  # in order, with only the latest partial result
+    metrics = dispatcher.callback_metrics()
+    assert metrics["test_callback_dispatcher.<locals>.callback"]["calls"] == 3
+    assert metrics["test_callback_dispatcher.<locals>.slow_callback"]["max_time"] > 0
+
+
+class UpdateCounter(KaTrainBase):
+    def __init__(self):
+        super().__init__(force_package_config=True, debug_level=0)
+        self.num_updates = 0
+
+    def update_state(self, redraw_board=False):
+        self.num_updates += 1
+
+
+def test_handed_over_engine_updates_the_new_owner(tmp_path):
+    engine, _ = fake_engine(tmp_path)
+    gui = UpdateCounter()
+    engine.katrain = gui  # as when the engine started early is handed over to the GUI
+    node = GameNode(properties={"SZ": 19})
+    results = []
+    try:
+        engine.request_analysis(node, lambda analysis, partial: results.append(partial))
+        assert wait_until(lambda: False in results and engine.is_idle())
+        assert gui.num_updates >= 1
+    finally:
+        engine.shutdown(finish=True)
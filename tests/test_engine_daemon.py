@@ -0,0 +1,162 @@
+import json
+import socket
+import threading
+import time
+
+import pytest
+from websocket import WebSocketBadStatusException, create_connection
+
+from katrain.core.engine import QueryQueue
+from katrain.core.engine_daemon import EngineDaemon, engine_fingerprint, probe_daemon
+from katrain.core.remote_engine import DaemonKataGoEngine
+
+
+class FakeKaTrain:
+    def log(self, message, level):
+        pass
+
+    def __call__(self, *args):
+        pass
+
+
+class FakeEngine:
+    def __init__(self):
+        self.write_queue = QueryQueue()
+        self.terminated = []
+        self.alive = True
+
+    def terminate_queries(self, only_for_node=None):
+        self.write_queue.remove(lambda query, node: node is only_for_node)
+        self.terminated.append(only_for_node)
+
+    def terminate_query(self, query_id, ignore_further_results=True):
+        self.terminated.append(query_id)
+
+    def check_alive(self):
+        return self.alive
+
+    def is_idle(self):
+        return self.write_queue.empty()
+
+    def shutdown(self, finish=False):
+        self.alive = False
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+@pytest.fixture
+def daemon():
+    daemon = EngineDaemon(FakeKaTrain(), "fingerprint", port=0)
+    engine = FakeEngine()
+    thread = threading.Thread(target=daemon.serve, args=(engine,), daemon=True)
+    thread.start()
+    yield daemon
+    daemon.stop()
+    thread.join(timeout=5)
+
+
+def connect(daemon):
+    return create_connection(f"ws://127.0.0.1:{daemon.port}/fingerprint", timeout=5)
+
+
+def test_routes_results_by_client(daemon):
+    engine = daemon.engine
+    first, second = connect(daemon), connect(daemon)
+    first.send(json.dumps({"id": "QUERY:1", "analyzeTurns": [0, 1]}))
+    second.send(json.dumps({"id": "QUERY:1", "analyzeTurns": [0]}))
+    assert wait_until(lambda: engine.write_queue.qsize() == 2)
+    sent = [engine.write_queue.get(block=False) for _ in range(2)]
+    assert sorted(query["id"] for query, *_ in sent) == ["C1:QUERY:1", "C2:QUERY:1"]
+
+    for query, on_result, on_error, _, client in sent:
+        on_result({"id": query["id"], "turnNumber": 0}, False)
+    assert json.loads(first.recv()) == {"id": "QUERY:1", "turnNumber": 0}
+    assert json.loads(second.recv()) == {"id": "QUERY:1", "turnNumber": 0}
+    clients = {client.name: client for *_, client in sent}
+    assert list(clients["C1"].queries) == ["QUERY:1"]  # one turn to go
+    assert not clients["C2"].queries
+
+    first.close()
+    assert wait_until(lambda: clients["C1"] in engine.terminated)
+    second.close()
+
+
+def test_terminate(daemon):
+    ws = connect(daemon)
+    ws.send(json.dumps({"id": "QUERY:1", "analyzeTurns": [0]}))
+    ws.send(json.dumps({"id": "QUERY:2", "analyzeTurns": [0]}))
+    engine = daemon.engine
+    assert wait_until(lambda: engine.write_queue.qsize() == 2)
+    engine.write_queue.get(block=False)  # QUERY:1 is sent to KataGo, QUERY:2 is still queued
+
+    ws.send(json.dumps({"id": "QUERY:3", "action": "terminate", "terminateId": "QUERY:1"}))
+    assert json.loads(ws.recv())["terminateId"] == "QUERY:1"
+    assert engine.terminated == ["C1:QUERY:1"]
+    ws.send(json.dumps({"id": "QUERY:4", "action": "terminate", "terminateId": "QUERY:2"}))
+    ws.recv()
+    assert engine.write_queue.empty() and engine.terminated == ["C1:QUERY:1"]
+
+    ws.send(json.dumps({"id": "QUERY:5", "action": "clear_cache"}))
+    assert "error" in json.loads(ws.recv())
+    ws.close()
+
+
+def test_engine_settings_must_match(daemon):
+    assert probe_daemon(daemon.port, "fingerprint") == "fingerprint"
+    with pytest.raises(WebSocketBadStatusException):  # a web page
+        create_connection(f"ws://127.0.0.1:{daemon.port}/fingerprint", timeout=5, origin="https://example.com")
+    ws = connect(daemon)
+    with pytest.raises(WebSocketBadStatusException):
+        create_connection(f"ws://127.0.0.1:{daemon.port}/", timeout=5)
+    assert probe_daemon(daemon.port, "other") == "fingerprint"
+    time.sleep(0.5)
+    assert probe_daemon(daemon.port, "fingerprint") == "fingerprint"  # still in use
+    ws.close()
+    assert probe_daemon(daemon.port, "other") == "fingerprint"  # unused, so it stops for the new settings
+    assert wait_until(lambda: probe_daemon(daemon.port, "fingerprint") is None)
+
+
+def test_not_a_daemon():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        sock.listen()
+        port = sock.getsockname()[1]
+        threading.Thread(target=lambda: sock.accept()[0].sendall(b"HTTP/1.1 404 Not Found\r\n\r\n")).start()
+        assert probe_daemon(port, "fingerprint") == ""
+    assert probe_daemon(port, "fingerprint") is None
+
+
+def test_attach_in_background():
+    config = {"model": "model.bin.gz", "max_visits": 10, "analysis_cache_mb": 0, "allow_recovery": False}
+    daemon = EngineDaemon(FakeKaTrain(), engine_fingerprint(config), port=0)
+    thread = threading.Thread(target=daemon.serve, args=(FakeEngine(),), daemon=True)
+    thread.start()
+    engine = DaemonKataGoEngine(FakeKaTrain(), {**config, "daemon": True, "daemon_port": daemon.port})
+    results = []
+    engine.send_query({"analyzeTurns": [0]}, lambda analysis, partial: results.append(analysis), None)
+    assert engine.check_alive()  # while attaching
+    assert wait_until(lambda: daemon.engine.write_queue.qsize() == 1)
+    query, on_result, *_ = daemon.engine.write_queue.get(block=False)
+    on_result({"id": query["id"], "rootInfo": {"visits": 1}, "moveInfos": []}, False)
+    assert wait_until(lambda: results) and results[0]["id"] == "QUERY:1"
+    engine.shutdown(finish=None)
+    daemon.stop()
+    thread.join(timeout=5)
+
+
+def test_stops_when_idle():
+    daemon = EngineDaemon(FakeKaTrain(), "fingerprint", port=0, idle_timeout=0.2)
+    engine = FakeEngine()
+    thread = threading.Thread(target=daemon.serve, args=(engine,), daemon=True)
+    thread.start()
+    ws = connect(daemon)
+    time.sleep(0.5)
+    assert thread.is_alive()  # a client is connected
+    ws.close()
+    thread.join(timeout=5)
+    assert not thread.is_alive() and not engine.alive
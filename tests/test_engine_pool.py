@@ -0,0 +1,111 @@
+import time
+
+from katrain.core.engine import KataGoEngine
+from katrain.core.engine_pool import EnginePool
+from katrain.core.game_node import GameNode
+from katrain.core.sgf_parser import Move
+
+
+class FakeKaTrain:
+    def __init__(self):
+        self.calls = []
+
+    def log(self, message, level):
+        pass
+
+    def __call__(self, *args):
+        self.calls.append(args)
+
+
+class FakeWorker:
+    requested_visits = KataGoEngine.requested_visits
+
+    def __init__(self, config):
+        self.config = config
+        self.requests = []
+        self.num_restarts = 0
+
+    def open_analysis_cache(self, engine_id):
+        return None
+
+    def request_analysis(self, analysis_node, callback, error_callback=None, **kwargs):
+        self.requests.append((analysis_node, callback, error_callback, kwargs))
+
+    def finish(self, i=0):
+        node, callback, _, _ = self.requests.pop(i)
+        callback({"rootInfo": {"visits": 1}, "moveInfos": []}, False)
+
+    def is_idle(self):
+        return not self.requests
+
+    def restart(self):
+        self.num_restarts += 1
+        self.requests = []
+
+
+class FakePool(EnginePool):
+    def _create_worker(self, index):
+        return FakeWorker(self.config)
+
+
+def pool_and_katrain(num_workers=3):
+    katrain = FakeKaTrain()
+    pool = FakePool(katrain, {"max_visits": 100, "fast_visits": 10, "allow_recovery": True}, num_workers)
+    return pool, katrain
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_balances_outstanding_visits():
+    pool, _ = pool_and_katrain()
+    nodes = [GameNode(properties={"SZ": 19}) for _ in range(4)]
+    pool.request_analysis(nodes[0], lambda *args: None)  # max visits
+    pool.request_analysis(nodes[1], lambda *args: None, analyze_fast=True)
+    pool.request_analysis(nodes[2], lambda *args: None, visits=20)
+    pool.request_analysis(nodes[3], lambda *args: None, analyze_fast=True)
+    assert [len(worker.requests) for worker in pool.workers] == [1, 2, 1]
+    assert [pool.outstanding_visits(i) for i in range(3)] == [100, 20, 20]
+
+    pool.workers[0].finish()
+    pool.request_analysis(nodes[1], lambda *args: None, visits=50)
+    assert [len(worker.requests) for worker in pool.workers] == [1, 2, 1]
+    assert pool.outstanding_visits(0) == 50
+    assert not pool.is_idle()
+
+
+def test_refinement_stays_on_worker():
+    pool, _ = pool_and_katrain()
+    node = GameNode(properties={"SZ": 19})
+    other = GameNode(properties={"SZ": 19})
+    pool.request_analysis(other, lambda *args: None, visits=1000)
+    pool.request_analysis(node, lambda *args: None, visits=1000)
+    assert len(pool.workers[1].requests) == 1
+    pool.request_analysis(node, lambda *args: None, find_alternatives=True)
+    pool.request_analysis(node, lambda *args: None, next_move=Move((3, 3), player="B"))
+    assert len(pool.workers[1].requests) == 3
+    pool.request_analysis(node, lambda *args: None)  # a new normal query is balanced again
+    assert len(pool.workers[2].requests) == 1
+
+
+def test_restarts_dead_worker():
+    pool, katrain = pool_and_katrain(num_workers=2)
+    results = []
+    node = GameNode(properties={"SZ": 19})
+    pool.request_analysis(node, lambda analysis, partial: results.append(analysis))
+    worker = pool.workers[0]
+    pool.worker_failed(0, "died")
+    assert wait_until(lambda: worker.num_restarts == 1 and len(worker.requests) == 1)
+    worker.finish()
+    assert len(results) == 1
+    assert pool.is_idle()
+
+    for _ in range(EnginePool.MAX_RESTARTS + 1):
+        assert wait_until(lambda: 0 not in pool._restarting)
+        pool.worker_failed(0, "died again")
+    assert wait_until(lambda: worker.num_restarts == EnginePool.MAX_RESTARTS + 1)
+    assert [call[0] for call in katrain.calls] == ["engine_recovery_popup"]
@@ -0,0 +1,107 @@
+import io
+import json
+import threading
+import time
+
+from katrain.core.fake_katago import FakeKataGo
+
+
+def query(query_id, turns=(0,), **kwargs):
+    return {
+        "id": query_id,
+        "moves": [["B", "D4"], ["W", "Q16"]],
+        "rules": "japanese",
+        "boardXSize": 19,
+        "boardYSize": 19,
+        "analyzeTurns": list(turns),
+        "maxVisits": 100,
+        **kwargs,
+    }
+
+
+def results(out):
+    return [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+def run_queued(engine):
+    """Searches everything queued on this thread, in the order the engine picks."""
+    engine.closed = True
+    engine._search_thread()
+
+
+def test_turns_and_payloads():
+    out = io.StringIO()
+    FakeKataGo(out=out).run(
+        [json.dumps(query("A", turns=[0, 1, 2], includeOwnership=True, includeMovesOwnership=True, includePolicy=True))]
+    )
+    by_turn = {result["turnNumber"]: result for result in results(out)}
+    assert sorted(by_turn) == [0, 1, 2]
+    for result in by_turn.values():
+        assert result["rootInfo"]["visits"] == 100 and not result["isDuringSearch"]
+        assert sum(move["visits"] for move in result["moveInfos"]) == 100
+        assert len(result["ownership"]) == 361 and len(result["policy"]) == 362
+        assert all(len(move["ownership"]) == 361 for move in result["moveInfos"])
+    assert by_turn[2]["rootInfo"]["currentPlayer"] == "B"
+    assert "D4" not in [move["move"] for move in by_turn[1]["moveInfos"]]
+
+    again = io.StringIO()
+    FakeKataGo(out=again).run([json.dumps(query("B", turns=[1]))])
+    assert results(again)[0]["moveInfos"] == [
+        {k: v for k, v in move.items() if k != "ownership"} for move in by_turn[1]["moveInfos"]
+    ]  # deterministic
+
+
+def test_priorities():
+    out = io.StringIO()
+    engine = FakeKataGo(out=out)
+    for query_id, priority in [("low", 0), ("high", 10), ("middle", 5)]:
+        engine.handle(json.dumps(query(query_id, priority=priority)))
+    run_queued(engine)
+    assert [result["id"] for result in results(out)] == ["high", "middle", "low"]
+
+
+def test_errors_and_actions():
+    out = io.StringIO()
+    engine = FakeKataGo(out=out)
+    engine.handle(json.dumps({"id": "A", "moves": []}))
+    engine.handle(json.dumps({"id": "B", "action": "query_version"}))
+    engine.handle("not json")
+    first, second, third = results(out)
+    assert first["id"] == "A" and first["field"] == "rules"
+    assert second["version"] == "fake"
+    assert "error" in third
+
+
+def test_report_during_search_and_terminate():
+    out = io.StringIO()
+    engine = FakeKataGo(visits_per_second=1000, threads=1, out=out)
+    thread = threading.Thread(target=engine.run, args=([],))
+    engine.handle(json.dumps(query("A", maxVisits=200, reportDuringSearchEvery=0.05)))
+    engine.handle(json.dumps(query("B", turns=[0, 1])))
+    thread.start()
+    thread.join()
+    reports = [result for result in results(out) if result["id"] == "A"]
+    assert len(reports) >= 3 and reports[-1]["rootInfo"]["visits"] == 200 and not reports[-1]["isDuringSearch"]
+    assert all(report["isDuringSearch"] for report in reports[:-1])
+    visits = [report["rootInfo"]["visits"] for report in reports]
+    assert visits == sorted(visits)
+
+    out = io.StringIO()
+    engine = FakeKataGo(visits_per_second=100, threads=1, out=out)
+    threading.Thread(target=engine._search_thread, daemon=True).start()
+    engine.handle(json.dumps(query("A", turns=[0, 1])))
+    time.sleep(0.2)
+    engine.handle(json.dumps({"id": "T", "action": "terminate", "terminateId": "A"}))
+    time.sleep(0.1)
+    by_turn = {result.get("turnNumber"): result for result in results(out) if result["id"] == "A"}
+    assert 0 < by_turn[0]["rootInfo"]["visits"] < 100  # stopped early
+    assert by_turn[1]["noResults"]  # never started
+    assert any(result.get("terminateId") == "A" for result in results(out))
+
+
+def test_max_time():
+    out = io.StringIO()
+    start = time.time()
+    FakeKataGo(visits_per_second=100, out=out).run([json.dumps(query("A", overrideSettings={"maxTime": 0.1}))])
+    assert time.time() - start < 0.5
+    assert results(out)[0]["rootInfo"]["visits"] < 100
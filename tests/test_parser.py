@@ -1,9 +1,20 @@
+import io
+import json
+import math
 import os
+import pickle
+import random
+import time
+import tracemalloc
 from unittest.mock import MagicMock
 
+import pytest
+
 from katrain.core.base_katrain import KaTrainBase
 from katrain.core.game import Game, KaTrainSGF
-from katrain.core.sgf_parser import SGF, SGFNode
+from katrain.core.game_node import GameNode
+from katrain.core.sgf_import import find_game_files, parse_files
+from katrain.core.sgf_parser import SGF, Move, ParseError, SGFNode
 
 
 def test_simple():
@@ -195,3 +206,286 @@ def test_placements():
     print(root.properties)
     assert 6 == len(root.clear_placements)
     assert 25 + 14 * 14 == len(root.placements)
+
+
+def _generate_sgf(min_size):
+    comment = "C[" + "lorem ipsum \\] dolor " * 8 + "]"
+    moves = [f";{'BW'[i % 2]}[{Move.SGF_COORD[i % 19]}{Move.SGF_COORD[(i // 19) % 19]}]{comment}" for i in range(361)]
+    parts = ["(;GM[1]FF[4]SZ[19]"]
+    size = len(parts[0])
+    i = 0
+    while size < min_size:
+        part = moves[i % 361] + (f"({moves[(i + 7) % 361]})" if i % 10 == 0 else "")  # variation every 10 moves
+        parts.append(part)
+        size += len(part)
+        i += 1
+    return "".join(parts) + ")"
+
+
+def _time_parse(sgf, repeats=3):
+    best = math.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        SGF.parse_sgf(sgf)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+@pytest.mark.skipif(not os.environ.get("KATRAIN_BENCHMARK"), reason="slow benchmark, timing based")
+def test_parse_scaling():
+    timings = []
+    for size in [1_000, 64_000, 1_000_000, 10_000_000, 50_000_000]:
+        sgf = _generate_sgf(size)
+        seconds = _time_parse(sgf, repeats=3 if size < 10_000_000 else 1)
+        timings.append((len(sgf), seconds))
+        print(f"Parsed {len(sgf)/1000:.0f} KB in {seconds:.3f}s: {len(sgf) / seconds / 1e6:.2f} MB/s")
+    (reference_size, reference_time), (largest_size, largest_time) = timings[1], timings[-1]
+    # quadratic parsing would make time per byte grow with the size ratio, linear keeps it about flat
+    assert largest_time / largest_size < 3 * reference_time / reference_size
+
+
+def test_iter_games(tmp_path):
+    games = [
+        "(;GM[1]FF[4]SZ[19]PB[first]C[comment with ( and \\] inside];B[dp](;W[pp])(;W[dd]))",
+        "(;GM[1]FF[4]CA[UTF-8]SZ[13]PB[second];B[dd];W[gg])",
+        "(;GM[1]FF[4]SZ[9]PB[third];B[ee])",
+    ]
+    file = tmp_path / "collection.sgf"
+    file.write_text("header text (not a game)\n" + "\n".join(games) + "\n", encoding="utf-8")
+    roots = list(SGF.iter_games(str(file)))
+    assert ["first", "second", "third"] == [root.get_property("PB") for root in roots]
+    assert [(19, 19), (13, 13), (9, 9)] == [root.board_size for root in roots]
+    assert games == [root.sgf() for root in roots]
+
+    empty_file = tmp_path / "empty.sgf"
+    empty_file.write_bytes(b"")
+    assert [] == list(SGF.iter_games(str(empty_file)))
+
+
+def test_parse_files_bulk(tmp_path):
+    data_dir = os.path.join(os.path.dirname(__file__), "data")
+    broken_file = tmp_path / "broken.sgf"
+    broken_file.write_text("(;GM[1]SZ[19];B[dd]", encoding="utf-8")
+    filenames = find_game_files([data_dir, str(broken_file)])
+    assert 9 == len(filenames)
+
+    records = list(parse_files(filenames, max_workers=2))
+    assert filenames == [r.filename for r in records]
+    errors = [r for r in records if r.error]
+    assert [str(broken_file)] == [r.filename for r in errors]
+    assert "ParseError" in errors[0].error
+
+    gib = next(r for r in records if r.filename.endswith("test.gib"))
+    assert ["wildsim1"] == gib.properties["PW"]
+    assert ("B", "Q16") == gib.moves[0]
+    assert pickle.loads(pickle.dumps(gib)).moves == gib.moves
+
+
+def test_lazy_variations():
+    input_sgf = (
+        "(;GM[1]FF[4]SZ[19](;B[dp];W[pp](;B[pj])(;PL[B]AW[jp]C[with ( and \\]];B[aa](;W[bb])(;W[cc])))(;B[pd];W[dd]))"
+    )
+    eager_root = SGF.parse_sgf(input_sgf)
+    root = SGF.parse_sgf(input_sgf, lazy=True)
+    assert root._unparsed_branches is not None
+    node = root
+    main_line = []
+    while node is not None:
+        main_line.append(node)
+        node = node.main_child
+    assert ["dp", "pp", "pj"] == [n.get_property("B") or n.get_property("W") for n in main_line[1:]]
+    assert all(n._unparsed_branches is not None for n in [root, main_line[2]])
+
+    assert 2 == len(root.children)
+    assert ["dp", "pd"] == [c.get_property("B") for c in root.children]
+    assert root._unparsed_branches is None
+    assert len(eager_root.nodes_in_tree) == len(root.nodes_in_tree)
+    assert input_sgf == root.sgf() == eager_root.sgf()
+
+    root = SGF.parse_sgf(input_sgf, lazy=True)
+    SGFNode(parent=root, move=Move.from_gtp("K10", player="B"))  # e.g. playing a new move, after those in the file
+    assert ["dp", "pd", "jj"] == [c.get_property("B") for c in root.children]
+    assert root._unparsed_branches is None
+
+
+def test_lazy_variation_errors():
+    input_sgf = "(;GM[1]FF[4]SZ[19](;B[dp];W[pp])(;B[pd];W[dd]!)(;B[dd]))"
+    with pytest.raises(ParseError):
+        SGF.parse_sgf(input_sgf)
+
+    root = SGF.parse_sgf(input_sgf, lazy=True)
+    with pytest.raises(ParseError):
+        root.children
+    assert ["dp", "dd"] == [c.get_property("B") for c in root.children]  # others are kept, and the error is gone
+    assert 4 == len(root.nodes_in_tree)
+
+    errors = []
+    root = SGF.parse_sgf(input_sgf, lazy=True, on_error=errors.append)
+    assert ["dp", "dd"] == [c.get_property("B") for c in root.children]
+    assert 1 == len(errors) and isinstance(errors[0], ParseError)
+
+
+def test_incremental_write(tmp_path, monkeypatch):
+    file = os.path.join(os.path.dirname(__file__), "data/LS vs AG - G4 - English.sgf")
+    root = KaTrainSGF.parse_file(file)
+    full_sgf = root.sgf()
+
+    serialized = []
+    sgf_properties = GameNode.sgf_properties
+
+    def counting_sgf_properties(node, **xargs):
+        serialized.append(node)
+        return sgf_properties(node, **xargs)
+
+    monkeypatch.setattr(GameNode, "sgf_properties", counting_sgf_properties)
+    buffer = io.StringIO()
+    root.write_sgf(buffer, incremental=True)
+    assert full_sgf == buffer.getvalue()
+    num_nodes = len(serialized)
+    assert len(root.nodes_in_tree) == num_nodes
+
+    serialized.clear()
+    changed_node = root.children[0].children[0]
+    changed_node.note = "changed"
+    changed_node.set_property("MA", ["dd"])
+    buffer = io.StringIO()
+    root.write_sgf(buffer, incremental=True)
+    assert {root, changed_node} == set(serialized)
+    assert root.sgf() == buffer.getvalue()
+    assert "MA[dd]" in buffer.getvalue() and "C[changed]" in buffer.getvalue()
+
+    edited_node = root.children[0]
+    properties = edited_node.properties
+    root.write_sgf(io.StringIO(), incremental=True)
+    properties["TR"] = ["ee"]  # in place, after the node was cached
+    properties["MA"].append("ff")
+    buffer = io.StringIO()
+    root.write_sgf(buffer, incremental=True)
+    assert root.sgf() == buffer.getvalue()
+    assert "TR[ee]" in buffer.getvalue() and "MA[ff]" in buffer.getvalue()
+
+    game = Game(KaTrainBase(force_package_config=True, debug_level=0), MagicMock(), root)
+    filename = str(tmp_path / "out" / "game.sgf")
+    game.write_sgf(filename)
+    assert game.sgf_filename == filename
+    assert os.listdir(tmp_path / "out") == ["game.sgf"]
+    assert len(game.root.nodes_in_tree) == len(KaTrainSGF.parse_file(filename).nodes_in_tree)
+
+
+def test_interned_moves():
+    move = Move.from_gtp("Q16", player="W")
+    assert move is Move((15, 15), player="W") is Move([15, 15], player="W")
+    assert move is Move.from_sgf("pd", (19, 19), player="W")
+    assert move is pickle.loads(pickle.dumps(move))
+    assert move != Move.from_gtp("Q16", player="B")
+    assert move.sgf((19, 19)) == "pd" and move.gtp() == "Q16"
+    assert Move.from_gtp("pass").is_pass and Move.from_sgf("tt", (19, 19)).is_pass
+    with pytest.raises(AttributeError):
+        move.coords = (3, 3)
+    policy_moves = Move.policy_moves((9, 13))
+    assert len(policy_moves) == 9 * 13 + 1 and policy_moves[-1][1].is_pass
+    assert sorted(ix for ix, _ in policy_moves) == list(range(9 * 13 + 1))
+    assert dict(policy_moves)[0] is Move.from_sgf("aa", (9, 13))  # policy starts at the top left
+
+
+def test_node_memory():
+    moves = [f";{'BW'[i % 2]}[{Move.SGF_COORD[i % 19]}{Move.SGF_COORD[(i // 19) % 19]}]" for i in range(361)]
+    parts = ["(;GM[1]FF[4]SZ[19]"]
+    for i in range(20_000):  # joseki/problem style tree: variations and some markup
+        markup = "LB[pd:A][qc:B]TR[dd]" if i % 5 == 0 else ""
+        parts.append(moves[i % 361] + markup + (f"({moves[(i + 7) % 361]})" if i % 10 == 0 else ""))
+    sgf = "".join(parts) + ")"
+
+    tracemalloc.start()
+    try:
+        root = KaTrainSGF.parse_sgf(sgf)
+        bytes_per_node = tracemalloc.get_traced_memory()[0] / len(root.nodes_in_tree)
+    finally:
+        tracemalloc.stop()
+    print(f"{bytes_per_node:.0f} bytes per node")
+    assert bytes_per_node < 360  # about 1080 with dict based nodes
+
+    node = root.children[0].children[0]
+    assert isinstance(node._properties, tuple) and node.get_property("W") == "ha"
+    node.comment()
+    assert isinstance(node._properties, tuple)  # reading does not switch to a dict
+    node.set_property("TR", ["aa", "bb"])
+    assert ["aa", "bb"] == node.get_list_property("TR")
+    node.properties["TR"].append("cc")  # switches to a dict, which can be modified in place
+    assert {"W": ["ha"], "TR": ["aa", "bb", "cc"]} == node.sgf_properties()
+    assert ["aa", "bb", "cc"] == node.clear_property("TR")
+    assert node.analysis is root.analysis and not node.analysis_exists
+
+
+def test_tree_index():
+    root = SGF.parse_sgf("(;SZ[19]" + "".join(f";{'BW'[i % 2]}[{Move.SGF_COORD[i % 19]}a]" for i in range(5000)) + ")")
+    node = root
+    while node.children:
+        node = node.children[0]
+    assert 5000 == node.depth  # deep trees do not recurse
+    assert 5001 == len(node.nodes_from_root) and root is node.nodes_from_root[0]
+    assert tuple(node.nodes_from_root) == root.nodes_in_tree == root.nodes_in_preorder
+
+    root = SGF.parse_sgf("(;GM[1](;B[aa](;W[bb];B[cc])(;W[dd]))(;B[ee]))")
+    a, e = root.children
+    b, d = a.children
+    assert (root, a, e, b, d, b.children[0]) == root.nodes_in_tree
+    assert (root, a, b, b.children[0], d, e) == root.nodes_in_preorder
+    assert [root, a, d] == d.nodes_from_root
+
+    f = SGFNode(parent=d, move=Move.from_sgf("ff", (19, 19), player="B"))  # added nodes are indexed
+    assert (root, a, e, b, d, b.children[0], f) == root.nodes_in_tree
+    assert [root, a, d, f] == f.nodes_from_root and 3 == f.depth
+    a.children = [d, b]  # reordered
+    assert (root, a, e, d, b, f, b.children[0]) == root.nodes_in_tree
+    root.children = [e]  # deleted
+    assert (root, e) == root.nodes_in_tree == root.nodes_in_preorder
+
+
+def test_tree_index_insertions(monkeypatch):
+    rng = random.Random(42)
+    root = SGFNode(properties={"SZ": 19})
+    nodes = [root]
+    for _ in range(20):
+        nodes.append(SGFNode(parent=rng.choice(nodes)))
+    assert root.nodes_in_tree is root.nodes_in_tree  # shared, not copied
+    root.nodes_in_preorder
+
+    walk_breadth_first, walk_preorder = SGFNode._walk_breadth_first, SGFNode._walk_preorder
+    monkeypatch.setattr(SGFNode, "_walk_breadth_first", lambda self: pytest.fail("rebuilt breadth first order"))
+    monkeypatch.setattr(SGFNode, "_walk_preorder", lambda self: pytest.fail("rebuilt preorder"))
+    for _ in range(200):
+        nodes.append(SGFNode(parent=rng.choice(nodes)))
+        assert tuple(walk_breadth_first(root)) == root.nodes_in_tree
+        assert tuple(walk_preorder(root)) == root.nodes_in_preorder
+
+
+def test_compact_analysis():
+    root = GameNode(properties={"SZ": 19})
+    node = root.play(Move((3, 3), player="B"))
+    ownership = [i / 361 for i in range(361)]
+    move_info = {"move": "Q16", "order": 0, "visits": 10, "winrate": 0.5, "scoreLead": 1.0, "pv": ["Q16"]}
+    analysis = {
+        "moveInfos": [{**move_info, "ownership": ownership}],
+        "rootInfo": {"visits": 10, "winrate": 0.5, "scoreLead": 1.0},
+        "ownership": ownership,
+        "policy": [1 / 362] * 362,
+    }
+    node.set_analysis(analysis)
+    assert analysis["ownership"] is ownership and analysis["moveInfos"][0]["ownership"] is ownership  # not modified
+    assert node.ownership[100] == pytest.approx(100 / 361) and len(node.policy) == 362
+    assert node.candidate_moves[0]["ownership"][360] == pytest.approx(360 / 361)
+    assert node.policy_ranking[0][0] == pytest.approx(1 / 362)
+
+    other = root.play(Move((15, 15), player="B"))
+    tracemalloc.start()
+    other.set_analysis(json.loads(json.dumps(analysis)))
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert used < 3 * 362 * 32 / 2  # float32 arrays rather than lists of float objects
+
+    node.analysis_from_sgf = node.sgf_properties(save_analysis=True)["KT"]
+    node.clear_analysis()
+    assert node.load_analysis()
+    assert list(node.ownership) == pytest.approx(ownership, abs=1e-3)  # stored as half precision
+    assert node.analysis["moves"]["Q16"]["visits"] == 10
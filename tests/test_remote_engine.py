@@ -5,15 +5,19 @@ These use an in-process fake WebSocket so no network/server is needed:
 whose recv()/send()/close() we drive from the test thread.
 """
 
+import json
 import queue
 import threading
 import time
 
 import pytest
-from websocket import WebSocketException
+from websocket import ABNF, WebSocketException
 
 from katrain.core import remote_engine
-from katrain.core.remote_engine import RemoteKataGoEngine
+from katrain.core.base_katrain import KaTrainBase
+from katrain.core.game_node import GameNode
+from katrain.core.remote_engine import RemoteEnginePool, RemoteKataGoEngine, make_engine
+from katrain.core.sgf_parser import Move
 
 
 class FakeWS:
@@ -39,6 +43,9 @@ class FakeWS:
         self.closed = True
         self._recv.put(WebSocketException("closed"))
 
+    def respond(self, message):
+        self._recv.put((ABNF.OPCODE_TEXT, json.dumps(message).encode()))
+
     def drop(self):
         """Simulate the server/network dropping the connection."""
         self._recv.put(WebSocketException("connection lost"))
@@ -229,3 +236,87 @@ def test_new_game_clears_resend_backlog(monkeypatch, fast_backoff):
         assert all("foo" not in payload for payload in ws2.sent)
     finally:
         engine.shutdown()
+
+
+def test_reconnect_resends_only_unfinished_turns(monkeypatch, fast_backoff):
+    created = []
+
+    def factory(*args, **kwargs):
+        ws = FakeWS()
+        created.append(ws)
+        return ws
+
+    monkeypatch.setattr(remote_engine, "create_connection", factory)
+
+    katrain = FakeKatrain()
+    engine = RemoteKataGoEngine(katrain, {"remote_url": "ws://test", "allow_recovery": True})
+    turns = []
+    try:
+        ws1 = created[0]
+        query = {"foo": "bar", "analyzeTurns": [0, 1, 2]}
+        engine.send_query(query, lambda analysis, partial: turns.append(analysis["turnNumber"]), None)
+        assert wait_until(lambda: len(ws1.sent) == 1)
+        query_id = json.loads(ws1.sent[0])["id"]
+        ws1.respond({"id": query_id, "turnNumber": 1, "rootInfo": {"visits": 1}, "moveInfos": []})
+        assert wait_until(lambda: turns == [1])
+
+        ws1.drop()
+        assert wait_until(lambda: len(created) == 2 and len(created[1].sent) == 1)
+        ws2 = created[1]
+        assert json.loads(ws2.sent[0])["analyzeTurns"] == [0, 2]
+        assert engine.turns_remaining[query_id] == 2
+        for turn in [0, 2]:
+            ws2.respond({"id": query_id, "turnNumber": turn, "rootInfo": {"visits": 1}, "moveInfos": []})
+        assert wait_until(lambda: not engine.queries and not engine.sent_payloads)
+        assert wait_until(lambda: sorted(turns) == [0, 1, 2])
+    finally:
+        engine.shutdown()
+
+
+def test_pool_routes_queries_and_moves_them_off_a_dead_server(monkeypatch, fast_backoff):
+    monkeypatch.setattr(RemoteKataGoEngine, "RECONNECT_ATTEMPTS", 1)
+    created = {"ws://a": [], "ws://b": []}
+    refused = set()
+
+    def factory(url, *args, **kwargs):
+        if url in refused:
+            raise WebSocketException("connection refused")
+        ws = FakeWS()
+        created[url].append(ws)
+        return ws
+
+    monkeypatch.setattr(remote_engine, "create_connection", factory)
+
+    katrain = FakeKatrain()
+    config = KaTrainBase(force_package_config=True, debug_level=0).config("engine")
+    engine = make_engine(katrain, {**config, "remote_url": "ws://a, ws://b", "analysis_cache_mb": 0})
+    assert isinstance(engine, RemoteEnginePool)
+    nodes = [GameNode(properties={"SZ": 19})]
+    for i in range(3):
+        nodes.append(nodes[-1].play(Move((i, 3), player="BW"[i % 2])))
+    results = []
+    try:
+        ws_a, ws_b = created["ws://a"][0], created["ws://b"][0]
+        for node in nodes[:2]:  # the second goes to the other server, as the first has visits outstanding
+            engine.request_analysis(node, lambda analysis, partial: results.append(analysis))
+        assert wait_until(lambda: len(ws_a.sent) == 1 and len(ws_b.sent) == 1)
+
+        engine.record_speed(0, 1.0, 1000)
+        engine.record_speed(1, 1000.0, 1000)  # b is much slower
+        for node in nodes[2:]:
+            engine.request_analysis(node, lambda analysis, partial: results.append(analysis))
+        assert wait_until(lambda: len(ws_a.sent) == 3)
+        assert len(ws_b.sent) == 1
+
+        refused.add("ws://a")
+        ws_a.drop()  # and stays down, so its queries are moved to b
+        assert wait_until(lambda: len(ws_b.sent) == 4)
+        moved = [json.loads(payload) for payload in ws_b.sent[1:]]
+        sent_to_a = [json.loads(payload) for payload in ws_a.sent]
+        assert sorted(query["moves"] for query in moved) == sorted(query["moves"] for query in sent_to_a)
+        for query in [json.loads(payload) for payload in ws_b.sent]:
+            ws_b.respond({"id": query["id"], "turnNumber": 0, "rootInfo": {"visits": 10}, "moveInfos": []})
+        assert wait_until(lambda: len(results) == 4 and engine.is_idle())
+        assert popup_codes(katrain) == []
+    finally:
+        engine.shutdown()
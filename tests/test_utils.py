@@ -0,0 +1,13 @@
+from katrain.core.utils import PendingUpdate
+
+
+def test_pending_update():
+    pending = PendingUpdate()
+    assert pending.take() is None
+    assert pending.request(redraw_board=False)
+    assert not pending.request(redraw_board=True)  # merged
+    assert not pending.request()
+    assert pending.take() == {"redraw_board": True}
+    assert pending.take() is None
+    assert pending.request()
+    assert pending.take() == {}